@@ -4,12 +4,29 @@ import shutil
 import sys
 import time
 import cv2
+import numpy as np
 
+import Utils.coarse_functions as coarse
 import Utils.conversion_functions as conversion
 import Utils.etc_functions as etc
 import Utils.raster_functions as raster
 import Utils.stitcher_functions as stitcher
 import Utils.upload_functions as uploader
+from Utils.budget_functions import ScanBudget, select_revisit_flakes
+from Utils.catalog_functions import FlakeCatalog
+from Utils.codec_functions import write_image
+from Utils.flatfield_functions import FlatfieldEstimator
+from Utils.focus_functions import create_focus_map
+from Utils.mask_functions import export_flake_masks
+from Utils.prefilter_functions import EmptyTilePrefilter
+from Utils.prescreen_functions import (
+    compute_tile_scores,
+    load_score_threshold,
+    prescreen_scan_area_map,
+    prioritize_tiles,
+    report_prescreen,
+)
+from Utils.warmup_functions import measure_first_call_latency, start_warmup_thread
 from Drivers import CameraDriver, MicroscopeDriver, MotorDriver
 from GMMDetector import MaterialDetector
 
@@ -26,6 +43,34 @@ STANDARD_DEVIATION_THRESHOLD: float = 5  # Maximum Mahalanobis Distance
 SIZE_THRESHOLD: float = 200  # Flake size threshold in square micrometers (μm²)
 COMMENT: str = ""  # The Comment for the Scan
 USE_AUTO_AF: bool = True  # Wheter the AF should be automatically calibrated
+USE_SOFTWARE_AF: bool = False  # Focus the automatic calibration on the image sharpness instead of the hardware AF, which has to be switched off first
+USE_ADAPTIVE_OVERVIEW: bool = False  # Only raster the region around the first wafer at 2.5x, chips further than a frame away from it are missed
+USE_FOCUS_MAP: bool = False  # Predict the focus of every tile from a few measurements, the hardware AF has to be switched off first
+FOCUS_MAP_SAMPLES: int = 9  # The number of positions the focus map is measured at
+REFOCUS_INTERVAL: int = 50  # Every n-th tile refines the focus map, 0 never refocuses
+USE_PRESCREENING: bool = False  # Skip the tiles without contrast in the overview, needs Debug/evaluate_prescreen.py to be run first
+PRESCREEN_RECALL_TARGET: float = 0.98  # The fraction of flakes the prescreening should still find
+USE_COARSE_PASS: bool = False  # Search only around the candidates of a lenient 5x pass, if the cost model expects it to be faster
+COARSE_CANDIDATE_FRACTION: float = 0.3  # The expected fraction of the 20x tiles around 5x candidates, used by the cost model
+COARSE_STANDARD_DEVIATION_THRESHOLD: float = 10  # The lenient Mahalanobis Distance of the 5x pass
+COARSE_SIZE_THRESHOLD: float = 50  # The lenient size threshold of the 5x pass in square micrometers (μm²)
+SCAN_DURATION: float = None  # The hours the whole scan may take, e.g. until the instrument booking ends, None has no deadline
+TARGET_FLAKE_COUNT: int = None  # Stop the search once this many flakes of interest are found, None searches the whole map
+TARGET_THICKNESSES: list = None  # The thickness classes of the flakes of interest, e.g. ["1"] for monolayers, None counts every flake
+REVISIT_RESERVE: float = 15  # The minutes before the deadline the search stops, left for the revisits and the upload
+MAX_REVISITED_FLAKES: int = None  # Only revisit the highest ranked flakes, None revisits all that fit before the deadline
+YIELD_ORDER_BANDS: int = 4  # With a deadline or target the tiles are scanned in this many bands of decreasing overview score
+USE_FLY_SCAN: bool = False  # Capture the tiles while the stage sweeps each row instead of stop and go, the tiles are then not ordered by score
+FLY_SCAN_EXPOSURE: float = 0.0005  # The exposure of the fly scan in seconds, the gain compensates the shorter exposure
+FLY_SCAN_MAX_BLUR: float = 2  # The motion blur in pixels the velocity of the fly scan allows, more blurred frames are rejected
+OVERVIEW_CAPTURE_PROFILE: str = "rgb"  # The video format of the 2.5x overview, see CameraDriver.CAPTURE_PROFILES, check "binned" with Debug/benchmark_capture_profiles.py first
+FOCUS_CAPTURE_PROFILE: str = "rgb"  # The video format while the focus map is measured, "binned" frames transfer faster once checked on the camera
+TILE_CAPTURE_PROFILE: str = "rgb"  # The video format of the 20x search and the revisits, "raw" transfers a third of the data and is demosaiced on the host
+USE_STREAMING_FLATFIELD: bool = False  # Whether the flatfield is re-estimated from the scanned images
+USE_EMPTY_TILE_PREFILTER: bool = False  # Whether images without any candidate pixel skip the detection, needs Debug/evaluate_prefilter.py to show no missed flakes first
+EXPORT_FULL_FRAME_MASKS: bool = True  # Whether flake_mask.png is written for each flake before the upload
+USE_CHUNKED_UPLOAD: bool = False  # Upload file by file in resumable chunks instead of one zip, the server has to support it
+USE_BACKGROUND_UPLOAD: bool = False  # Upload the flakes during the scan, needs the chunked upload and a server supporting it
 SERVER_URL: str = "http://localhost:4999/upload"  # The URL of the Server where to send the POST Request to
 SCAN_DIRECTORY_ROOT: str = "C:/Path/to/the/scan/directory/root"  # The Root Directory where the Scans should be saved
 
@@ -54,6 +99,7 @@ overview_path = os.path.join(SCAN_DIRECTORY, "overview.png")
 overview_compressed_path = os.path.join(SCAN_DIRECTORY, "overview_compressed.jpg")
 overview_mask_path = os.path.join(SCAN_DIRECTORY, "mask.png")
 scan_area_path = os.path.join(SCAN_DIRECTORY, "scan_area_map.png")
+focus_map_path = os.path.join(SCAN_DIRECTORY, "focus_map.json")
 
 (
     contrast_params,
@@ -72,10 +118,13 @@ if os.path.exists(SCAN_DIRECTORY):
     sys.exit("Scan Directory already exists")
 else:
     os.makedirs(SCAN_DIRECTORY)
-cv2.imwrite(os.path.join(SCAN_DIRECTORY, "flatfield.png"), flatfield)
+write_image(os.path.join(SCAN_DIRECTORY, "flatfield.png"), flatfield, "flatfield")
 with open(scan_meta_path, "w") as fp:
     json.dump(META_DICT, fp, sort_keys=True, indent=4)
 
+# Compile the numba kernels in the background while the overview is taken
+warmup_thread = start_warmup_thread(image_shape=flatfield.shape, verbose=True)
+
 # Driver Initialization
 motor_driver = MotorDriver()
 camera_driver = CameraDriver()
@@ -88,7 +137,15 @@ model = MaterialDetector(
     standard_deviation_threshold=STANDARD_DEVIATION_THRESHOLD,
     used_channels=USED_CHANNELS,
 )
+prefilter = None
+if USE_EMPTY_TILE_PREFILTER:
+    prefilter = EmptyTilePrefilter(
+        contrast_dict=contrast_params,
+        standard_deviation_threshold=STANDARD_DEVIATION_THRESHOLD,
+        used_channels=USED_CHANNELS,
+    )
 
+camera_driver.set_capture_profile(OVERVIEW_CAPTURE_PROFILE)
 (
     low_magification_image_directory,
     low_magification_metadata_directory,
@@ -99,6 +156,7 @@ model = MaterialDetector(
     camera_driver=camera_driver,
     camera_settings=camera_settings,
     microscope_settings=microscope_settings,
+    adaptive=USE_ADAPTIVE_OVERVIEW,
 )
 
 (
@@ -119,6 +177,8 @@ shutil.rmtree(os.path.dirname(low_magification_image_directory))
 formatted_time = time.strftime("%H:%M:%S", time.gmtime(time.time() - START_TIME))
 print(f"Time to create overview image and map: {formatted_time}")
 
+# the flatfield and every 20x image are taken at full resolution
+camera_driver.set_capture_profile(TILE_CAPTURE_PROFILE)
 new_flatfield = etc.calibrate_scope(
     motor_driver=motor_driver,
     microscope_driver=microscope_driver,
@@ -128,13 +188,125 @@ new_flatfield = etc.calibrate_scope(
     microscope_settings=microscope_settings,
     scan_area_map=scan_area_map,
     use_auto_AF=USE_AUTO_AF,
+    use_software_AF=USE_SOFTWARE_AF,
     **magnification_params,
 )
 
 if new_flatfield is not None:
     flatfield = new_flatfield.copy()
-    cv2.imwrite(os.path.join(SCAN_DIRECTORY, "flatfield.png"), flatfield)
+    write_image(os.path.join(SCAN_DIRECTORY, "flatfield.png"), flatfield, "flatfield")
+
+focus_map = None
+if USE_FOCUS_MAP:
+    print("Measuring the Focus Map...")
+    camera_driver.set_capture_profile(FOCUS_CAPTURE_PROFILE)
+    focus_map = create_focus_map(
+        scan_area_map=scan_area_map,
+        motor_driver=motor_driver,
+        microscope_driver=microscope_driver,
+        camera_driver=camera_driver,
+        magnification_index=conversion.magnification_to_magnification_index(MAGNIFICATION),
+        num_samples=FOCUS_MAP_SAMPLES,
+        **magnification_params,
+    )
+    camera_driver.set_capture_profile(TILE_CAPTURE_PROFILE)
+
+# stop the search at the deadline or once enough flakes of interest are found
+scan_budget = None
+if SCAN_DURATION is not None or TARGET_FLAKE_COUNT is not None:
+    scan_budget = ScanBudget(
+        deadline=START_TIME + SCAN_DURATION * 3600 if SCAN_DURATION is not None else None,
+        target_count=TARGET_FLAKE_COUNT,
+        thicknesses=TARGET_THICKNESSES,
+        revisit_reserve=REVISIT_RESERVE * 60,
+    )
 
+# the overview scores the tiles for the prescreening and the order of a budgeted scan
+tile_scores = None
+if USE_PRESCREENING or scan_budget is not None:
+    print("Scoring the Tiles with the Overview...")
+    tile_scores = compute_tile_scores(
+        overview_image=cv2.imread(overview_path),
+        scan_area_map=scan_area_map,
+        overview_mask=cv2.imread(overview_mask_path, cv2.IMREAD_GRAYSCALE),
+        **magnification_params,
+    )
+
+if USE_PRESCREENING:
+    print("Prescreening the Scan Area Map with the Overview...")
+    prescreened_scan_area_map = prescreen_scan_area_map(
+        scan_area_map,
+        tile_scores,
+        load_score_threshold(PRESCREEN_RECALL_TARGET),
+    )
+    report_prescreen(scan_area_map, prescreened_scan_area_map)
+    scan_area_map = prescreened_scan_area_map
+    write_image(
+        os.path.join(SCAN_DIRECTORY, "scan_area_map_prescreened.png"),
+        scan_area_map,
+        "mask",
+    )
+
+if USE_COARSE_PASS and coarse.two_stage_pays_off(
+    scan_area_map=scan_area_map,
+    magnification_index=conversion.magnification_to_magnification_index(MAGNIFICATION),
+    candidate_fraction=COARSE_CANDIDATE_FRACTION,
+):
+    coarse_model = MaterialDetector(
+        contrast_dict=contrast_params,
+        size_threshold=conversion.micrometers_to_pixels_IDX(
+            COARSE_SIZE_THRESHOLD, coarse.COARSE_MAGNIFICATION_INDEX
+        ),
+        standard_deviation_threshold=COARSE_STANDARD_DEVIATION_THRESHOLD,
+        used_channels=USED_CHANNELS,
+    )
+    coarse_candidates = coarse.find_coarse_candidates(
+        scan_area_map=scan_area_map,
+        motor_driver=motor_driver,
+        microscope_driver=microscope_driver,
+        camera_driver=camera_driver,
+        camera_settings=camera_settings,
+        microscope_settings=microscope_settings,
+        model=coarse_model,
+        magnification_index=conversion.magnification_to_magnification_index(MAGNIFICATION),
+        focus_map=focus_map,
+        **magnification_params,
+    )
+    candidate_scan_area_map = coarse.candidates_to_scan_area_map(
+        coarse_candidates,
+        scan_area_map,
+        **magnification_params,
+    )
+    print(
+        f"Searching {np.count_nonzero(candidate_scan_area_map)} of {np.count_nonzero(scan_area_map)} tiles around the candidates"
+    )
+    scan_area_map = candidate_scan_area_map
+    write_image(
+        os.path.join(SCAN_DIRECTORY, "scan_area_map_candidates.png"),
+        scan_area_map,
+        "mask",
+    )
+
+# scan the most promising tiles first, so an early stop misses the fewest flakes
+tile_order = None
+if scan_budget is not None:
+    tile_order = prioritize_tiles(
+        scan_area_map, tile_scores, num_bands=YIELD_ORDER_BANDS
+    )
+
+# publish the overview and each flake while the scan is still running
+background_uploader = None
+if USE_CHUNKED_UPLOAD and USE_BACKGROUND_UPLOAD:
+    background_uploader = uploader.BackgroundUploader(SCAN_DIRECTORY, SERVER_URL)
+    background_uploader.submit([scan_meta_path, overview_compressed_path])
+
+flatfield_estimator = None
+if USE_STREAMING_FLATFIELD:
+    flatfield_estimator = FlatfieldEstimator(image_shape=flatfield.shape)
+
+# the kernels are compiled by now, the first tile only pays for the first call
+warmup_thread.join()
+measure_first_call_latency(image_shape=flatfield.shape, verbose=True)
 
 scan_area_time_start = time.time()
 print(f"Scanning for flakes in High Magnification...")
@@ -150,9 +322,30 @@ raster.search_scan_area_map(
     overview_image=overview_image,
     camera_settings=camera_settings,
     microscope_settings=microscope_settings,
+    flatfield_estimator=flatfield_estimator,
+    prefilter=prefilter,
+    background_uploader=background_uploader,
+    focus_map=focus_map,
+    refocus_interval=REFOCUS_INTERVAL,
+    tile_order=tile_order,
+    scan_budget=scan_budget,
+    fly_scan=USE_FLY_SCAN,
+    fly_scan_exposure=FLY_SCAN_EXPOSURE,
+    fly_scan_max_blur=FLY_SCAN_MAX_BLUR,
     **magnification_params,
 )
 
+if focus_map is not None:
+    with open(focus_map_path, "w") as fp:
+        json.dump(focus_map.to_dict(), fp, indent=4)
+
+if flatfield_estimator is not None and flatfield_estimator.is_ready:
+    write_image(
+        os.path.join(SCAN_DIRECTORY, "flatfield_estimated.png"),
+        flatfield_estimator.get_flatfield(),
+        "flatfield",
+    )
+
 formatted_time = time.strftime(
     "%H:%M:%S", time.gmtime(time.time() - scan_area_time_start)
 )
@@ -160,7 +353,23 @@ print(f"Elapsed Time: {formatted_time}")
 
 revisit_time_start = time.time()
 print("Revisiting each Flake to take Pictures...")
-for current_magnification_index in [3, 4, 5, 1, 2]:
+revisit_magnification_indices = [3, 4, 5, 1, 2]
+
+# with a budget only the highest ranked flakes which fit before the deadline are revisited
+revisit_directories = None
+if scan_budget is not None or MAX_REVISITED_FLAKES is not None:
+    flake_catalog = FlakeCatalog(SCAN_DIRECTORY)
+    revisit_directories = [
+        flake_catalog.get_directory(entry)
+        for entry in select_revisit_flakes(
+            flake_catalog.entries,
+            num_magnifications=len(revisit_magnification_indices),
+            scan_budget=scan_budget,
+            max_flakes=MAX_REVISITED_FLAKES,
+        )
+    ]
+
+for current_magnification_index in revisit_magnification_indices:
     raster.read_meta_and_center_flakes(
         scan_directory=SCAN_DIRECTORY,
         motor_driver=motor_driver,
@@ -169,6 +378,9 @@ for current_magnification_index in [3, 4, 5, 1, 2]:
         camera_settings=camera_settings,
         microscope_settings=microscope_settings,
         magnification_index=current_magnification_index,
+        focus_map=focus_map,
+        flake_directories=revisit_directories,
+        deadline=scan_budget.deadline if scan_budget is not None else None,
     )
 
 formatted_time = time.strftime(
@@ -179,8 +391,18 @@ print(f"Elapsed Time during revisiting: {formatted_time}")
 print("Turning off the Lamp on the Microscope to conserve the Lifetime...")
 microscope_driver.lamp_off()
 
+# the masks are stored run length encoded in the metadata, expand them for the upload
+if EXPORT_FULL_FRAME_MASKS:
+    print("Exporting the Flake Masks...")
+    export_flake_masks(SCAN_DIRECTORY)
+
 print("Uploading the Scan Directory...")
-uploader.upload_directory(SCAN_DIRECTORY, SERVER_URL)
+if background_uploader is not None:
+    background_uploader.finish()
+elif USE_CHUNKED_UPLOAD:
+    uploader.upload_directory_chunked(SCAN_DIRECTORY, SERVER_URL)
+else:
+    uploader.upload_directory(SCAN_DIRECTORY, SERVER_URL)
 
 formatted_time = time.strftime("%H:%M:%S", time.gmtime(time.time() - START_TIME))
 print(f"Total elapsed Time: {formatted_time}")
@@ -18,6 +18,7 @@ EXFOLIATED_MATERIAL: str = "MATERIAL"  # Your Material of choice
 CHIP_THICKNESS: str = "THICKNESS"  # The Thickness of the Wafer
 MAGNIFICATION: float = 20  # The Magnification used for the Scan
 USE_AUTO_AF: bool = True  # Using the Experimental Auto Focus Calibration
+USE_SOFTWARE_AF: bool = False  # Focus on the image sharpness instead of the hardware AF, which has to be switched off first
 COMMENT: str = ""  # The Comment for the Scan
 SCAN_DIRECTORY_ROOT: str = "C:/Path/to/the/scan/directory"
 
@@ -96,6 +97,7 @@ etc.calibrate_scope(
     microscope_settings=microscope_settings,
     scan_area_map=scan_area_map,
     use_auto_AF=USE_AUTO_AF,
+    use_software_AF=USE_SOFTWARE_AF,
     **magnification_params,
 )
 
@@ -0,0 +1,69 @@
+"""
+Measures the time to switch to each capture profile and the transfer time per frame, which decide the profile of each scan stage.
+Also prints the mean color of each profile, the raw profile should match the rgb profile, otherwise its bayer_pattern is wrong.
+"""
+import time
+
+import numpy as np
+
+USE_SIMULATED_DRIVERS = False  # Try the script without the microscope
+NUM_FRAMES = 20  # The frames measured per profile
+MAGNIFICATION_INDEX = 3  # The objective the frames are taken with
+
+EXPOSURE = 0.07
+GAIN = 0
+WHITE_BALANCE = (127, 64, 90)
+GAMMA = 100
+
+if USE_SIMULATED_DRIVERS:
+    from Drivers import (
+        SimulatedCameraDriver,
+        SimulatedMicroscopeDriver,
+        SimulatedMotorDriver,
+    )
+
+    motor = SimulatedMotorDriver(35, 34)
+    microscope = SimulatedMicroscopeDriver()
+    camera = SimulatedCameraDriver(motor, microscope)
+else:
+    from Drivers import CameraDriver, MicroscopeDriver
+
+    microscope = MicroscopeDriver()
+    camera = CameraDriver()
+    print("Available video formats:")
+    for video_format in camera.get_camera().GetVideoFormats():
+        print(f"  {video_format}")
+
+microscope.set_mag(MAGNIFICATION_INDEX)
+camera.set_properties(
+    exposure=EXPOSURE,
+    gain=GAIN,
+    white_balance=WHITE_BALANCE,
+    gamma=GAMMA,
+)
+
+print(
+    f"\n{'Profile':10} {'Switch [s]':>10} {'Frame [ms]':>10} {'FPS':>6} {'Shape':>15} {'Mean BGR':>18}"
+)
+for profile in camera.CAPTURE_PROFILES.keys():
+    switch_start = time.time()
+    camera.set_capture_profile(profile)
+    switch_time = time.time() - switch_start
+
+    # the first frame after the switch waits for the stream to start
+    camera.get_image()
+
+    frame_times = []
+    for _ in range(NUM_FRAMES):
+        frame_start = time.time()
+        image = camera.get_image()
+        frame_times.append(time.time() - frame_start)
+
+    frame_time = np.median(frame_times)
+    mean_color = tuple(np.round(image.reshape(-1, 3).mean(axis=0)).astype(int).tolist())
+    print(
+        f"{profile:10} {switch_time:10.2f} {frame_time * 1000:10.1f} {1 / frame_time:6.1f} {str(image.shape[:2]):>15} {str(mean_color):>18}"
+    )
+
+camera.set_capture_profile("rgb")
+camera.stop_camera()
@@ -0,0 +1,80 @@
+"""
+Measures the encode time against the file size of different codecs and settings on recorded tiles.
+Also measures the throughput of the threaded encoding used during the scan.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+import numpy as np
+
+from Utils.codec_functions import ARTIFACT_POLICIES, encode_image
+from Utils.etc_functions import sorted_alphanumeric
+
+IMAGE_DIRECTORY = "C:/Path/To/Scan/Directory/20x/Pictures"
+NUM_IMAGES = 20
+THREAD_COUNTS = [1, 2, 4]
+
+# (name, extension, overrides of the raw_tile policy)
+CODECS = [
+    ("PNG level 0", ".png", {"png_compression": 0}),
+    ("PNG level 1", ".png", {"png_compression": 1}),
+    ("PNG level 3 (OpenCV default)", ".png", {"png_compression": 3}),
+    ("PNG level 6", ".png", {"png_compression": 6}),
+    ("PNG level 9", ".png", {"png_compression": 9}),
+    (
+        "PNG level 1 RLE",
+        ".png",
+        {"png_compression": 1, "png_strategy": cv2.IMWRITE_PNG_STRATEGY_RLE},
+    ),
+    (
+        "PNG level 1 Huffman only",
+        ".png",
+        {"png_compression": 1, "png_strategy": cv2.IMWRITE_PNG_STRATEGY_HUFFMAN_ONLY},
+    ),
+    ("WebP lossless", ".webp", {"webp_quality": 101}),
+    ("WebP quality 90", ".webp", {"webp_quality": 90}),
+    ("JPEG quality 95", ".jpg", {"jpeg_quality": 95}),
+    ("JPEG quality 90", ".jpg", {"jpeg_quality": 90}),
+    ("JPEG quality 80", ".jpg", {"jpeg_quality": 80}),
+]
+
+if __name__ == "__main__":
+    image_names = sorted_alphanumeric(os.listdir(IMAGE_DIRECTORY))[:NUM_IMAGES]
+    images = [
+        cv2.imread(os.path.join(IMAGE_DIRECTORY, image_name))
+        for image_name in image_names
+    ]
+    raw_size = sum(image.nbytes for image in images)
+
+    print(f"Benchmarking on {len(images)} images of shape {images[0].shape}")
+    print(f"{'codec':>28} | {'encode':>9} | {'size':>9} | {'ratio':>6} | lossless")
+    for name, extension, overrides in CODECS:
+        encoded_size = 0
+        max_error = 0
+        start_time = time.time()
+        for image in images:
+            data = encode_image(image, extension, "raw_tile", **overrides)
+            encoded_size += len(data)
+        encode_time = (time.time() - start_time) / len(images)
+
+        # decoding is not timed, it is only used to check whether the codec is lossless
+        for image in images[:3]:
+            data = encode_image(image, extension, "raw_tile", **overrides)
+            decoded = cv2.imdecode(np.frombuffer(data, np.uint8), cv2.IMREAD_COLOR)
+            max_error = max(max_error, int(cv2.absdiff(image, decoded).max()))
+
+        print(
+            f"{name:>28} | {encode_time * 1000:7.1f}ms | {encoded_size / len(images) / 1024:7.0f}KB | {raw_size / encoded_size:5.2f}x | {'yes' if max_error == 0 else f'no (max error {max_error})'}"
+        )
+
+    # the scan encodes in background threads, OpenCV releases the GIL while encoding
+    print("")
+    print(f"Threaded encoding with the raw_tile policy {ARTIFACT_POLICIES['raw_tile']}")
+    for num_threads in THREAD_COUNTS:
+        start_time = time.time()
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            list(executor.map(lambda image: encode_image(image, ".png"), images))
+        elapsed_time = time.time() - start_time
+        print(f"{num_threads:>3} threads | {len(images) / elapsed_time:6.1f} images/s")
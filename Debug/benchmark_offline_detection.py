@@ -0,0 +1,72 @@
+"""
+Measures how the offline detection scales with the number of worker processes.
+Runs the detection on the first images of a recorded dataset for each process count.
+"""
+import json
+import os
+import time
+
+import cv2
+
+import Utils.conversion_functions as conversion
+from Utils.etc_functions import sorted_alphanumeric
+from Utils.offline_detection_functions import run_offline_detection
+
+IMAGE_DIRECTORY = "C:/Path/To/Scan/Directory/20x/Pictures"
+FLATFIELD_PATH = "C:/Path/To/Scan/Directory/flatfield.png"
+EXFOLIATED_MATERIAL = "MATERIAL"
+CHIP_THICKNESS = "THICKNESS"
+MAGNIFICATION = 20
+NUM_IMAGES = 400
+PROCESS_COUNTS = [1, 2, 4, 8, 12, 16]
+
+
+if __name__ == "__main__":
+    file_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    contrasts_path = os.path.join(
+        file_path,
+        "Parameters",
+        "GMM_Parameters",
+        f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}.json",
+    )
+    with open(contrasts_path) as f:
+        contrast_params = json.load(f)
+
+    flatfield = cv2.imread(FLATFIELD_PATH)
+
+    image_names = sorted_alphanumeric(os.listdir(IMAGE_DIRECTORY))[:NUM_IMAGES]
+    image_paths = [os.path.join(IMAGE_DIRECTORY, name) for name in image_names]
+
+    detector_kwargs = {
+        "size_threshold": conversion.micrometers_to_pixels(200, MAGNIFICATION),
+        "standard_deviation_threshold": 5,
+        "used_channels": "BGR",
+    }
+
+    def measure_images_per_second(num_processes: int) -> float:
+        start_time = time.time()
+        for _ in run_offline_detection(
+            image_paths=image_paths,
+            contrast_params=contrast_params,
+            flatfield=flatfield,
+            detector_kwargs=detector_kwargs,
+            use_prefilter=False,
+            num_processes=num_processes,
+        ):
+            pass
+        return len(image_paths) / (time.time() - start_time)
+
+    print(f"Benchmarking on {len(image_paths)} images, {os.cpu_count()} cores")
+
+    # the speedup is relative to a single process, measured even if it is not in PROCESS_COUNTS
+    single_process_rate = measure_images_per_second(1)
+    for num_processes in PROCESS_COUNTS:
+        if num_processes == 1:
+            images_per_second = single_process_rate
+        else:
+            images_per_second = measure_images_per_second(num_processes)
+        speedup = images_per_second / single_process_rate
+
+        print(
+            f"{num_processes:>3} processes | {images_per_second:6.2f} images/s | speedup: {speedup:5.2f}x | efficiency: {speedup / num_processes:6.1%}"
+        )
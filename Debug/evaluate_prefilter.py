@@ -0,0 +1,104 @@
+"""
+Measures the false negative rate and the speedup of the empty tile prefilter on a recorded dataset.
+A false negative is an image which the prefilter skips, but where the detector finds a flake.
+"""
+import json
+import os
+import time
+
+import cv2
+import numpy as np
+from GMMDetector import MaterialDetector
+
+import Utils.conversion_functions as conversion
+from Utils.etc_functions import sorted_alphanumeric
+from Utils.prefilter_functions import EmptyTilePrefilter
+from Utils.preprocessor_functions import remove_vignette_fast
+
+IMAGE_DIRECTORY = "C:/Path/To/Scan/Directory/20x/Pictures"
+FLATFIELD_PATH = "C:/Path/To/Scan/Directory/flatfield.png"
+EXFOLIATED_MATERIAL = "MATERIAL"
+CHIP_THICKNESS = "THICKNESS"
+MAGNIFICATION = 20
+USED_CHANNELS = "BGR"
+STANDARD_DEVIATION_THRESHOLD = 5
+SIZE_THRESHOLD = 200
+CONFIDENCE_THRESHOLD = 0.5
+STRIDES = [1, 4, 8, 16]
+
+file_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+contrasts_path = os.path.join(
+    file_path,
+    "Parameters",
+    "GMM_Parameters",
+    f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}.json",
+)
+with open(contrasts_path) as f:
+    contrast_params = json.load(f)
+
+flatfield = cv2.imread(FLATFIELD_PATH)
+flatfield_mean = np.array(cv2.mean(flatfield)[:-1])
+
+model = MaterialDetector(
+    contrast_dict=contrast_params,
+    size_threshold=conversion.micrometers_to_pixels(SIZE_THRESHOLD, MAGNIFICATION),
+    standard_deviation_threshold=STANDARD_DEVIATION_THRESHOLD,
+    used_channels=USED_CHANNELS,
+)
+prefilters = {
+    stride: EmptyTilePrefilter(
+        contrast_dict=contrast_params,
+        standard_deviation_threshold=STANDARD_DEVIATION_THRESHOLD,
+        used_channels=USED_CHANNELS,
+        stride=stride,
+    )
+    for stride in STRIDES
+}
+
+image_names = sorted_alphanumeric(os.listdir(IMAGE_DIRECTORY))
+num_images = len(image_names)
+
+detection_time = 0
+has_flake = np.zeros(num_images, dtype=bool)
+passed = {stride: np.zeros(num_images, dtype=bool) for stride in STRIDES}
+prefilter_time = {stride: 0 for stride in STRIDES}
+
+for idx, image_name in enumerate(image_names):
+    print(f"{idx + 1} / {num_images}", end="\r")
+
+    image = cv2.imread(os.path.join(IMAGE_DIRECTORY, image_name))
+    image = remove_vignette_fast(image, flatfield, flatfield_mean=flatfield_mean)
+
+    start_time = time.time()
+    detected_flakes = model(image)
+    detection_time += time.time() - start_time
+
+    has_flake[idx] = any(
+        1 - flake.false_positive_probability >= CONFIDENCE_THRESHOLD
+        for flake in detected_flakes
+    )
+
+    for stride, prefilter in prefilters.items():
+        start_time = time.time()
+        passed[stride][idx] = prefilter(image)
+        prefilter_time[stride] += time.time() - start_time
+
+print("")
+print(f"Images: {num_images} | Images with flakes: {np.count_nonzero(has_flake)}")
+print(f"Detection only: {detection_time / num_images * 1000:.1f}ms per image")
+
+for stride in STRIDES:
+    false_negatives = np.count_nonzero(has_flake & ~passed[stride])
+    false_negative_rate = false_negatives / max(np.count_nonzero(has_flake), 1)
+    skipped_fraction = 1 - np.count_nonzero(passed[stride]) / num_images
+
+    # the detection only runs on the images passing the prefilter
+    mean_detection_time = detection_time / num_images
+    filtered_time = (
+        prefilter_time[stride] + np.count_nonzero(passed[stride]) * mean_detection_time
+    )
+    speedup = detection_time / max(filtered_time, 1e-9)
+
+    print(
+        f"Stride {stride:>2} | skipped: {skipped_fraction:6.1%} | false negatives: {false_negatives} ({false_negative_rate:.2%}) | prefilter: {prefilter_time[stride] / num_images * 1000:.1f}ms per image | speedup: {speedup:.2f}x"
+    )
@@ -0,0 +1,109 @@
+"""
+Measures the recall and the time saved by the overview prescreening on recorded scans and writes its calibration.
+The recall is the fraction of the recorded flakes whose tile is still scanned, each scan is evaluated with the threshold calibrated on the other scans.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from Utils.catalog_functions import FlakeCatalog
+from Utils.prescreen_functions import (
+    CALIBRATION_PATH,
+    compute_tile_scores,
+    get_flake_tiles,
+    get_score_threshold,
+)
+
+SCAN_DIRECTORIES = [
+    "C:/Path/To/Scan/Directory/1",
+    "C:/Path/To/Scan/Directory/2",
+]
+MAGNIFICATION = 20
+RECALL_TARGETS = [1.0, 0.99, 0.98, 0.95, 0.9]
+SECONDS_PER_TILE = 0.5  # The time to move, capture and detect a single tile
+WRITE_CALIBRATION = True  # Write the calibration used by the scan scripts
+
+file_path = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+with open(
+    os.path.join(
+        file_path, "Parameters", "Scan_Magnification", f"{MAGNIFICATION}x.json"
+    )
+) as f:
+    magnification_params = json.load(f)
+
+scan_area_maps = []
+tile_scores = []
+flake_tile_scores = []
+for scan_directory in SCAN_DIRECTORIES:
+    print(f"Scoring {scan_directory}...")
+    overview_image = cv2.imread(os.path.join(scan_directory, "overview.png"))
+    overview_mask = cv2.imread(
+        os.path.join(scan_directory, "mask.png"), cv2.IMREAD_GRAYSCALE
+    )
+    scan_area_map = cv2.imread(
+        os.path.join(scan_directory, "scan_area_map.png"), cv2.IMREAD_GRAYSCALE
+    )
+
+    scores = compute_tile_scores(
+        overview_image,
+        scan_area_map,
+        overview_mask=overview_mask,
+        **magnification_params,
+    )
+
+    flake_positions = np.array(
+        [
+            [entry["position_x"], entry["position_y"]]
+            for entry in FlakeCatalog(scan_directory)
+        ]
+    ).reshape(-1, 2)
+    flake_tiles = get_flake_tiles(flake_positions, **magnification_params)
+    flake_tiles = np.clip(flake_tiles, 0, np.array(scores.shape) - 1)
+
+    scan_area_maps.append(scan_area_map)
+    tile_scores.append(scores)
+    flake_tile_scores.append(scores[flake_tiles[:, 0], flake_tiles[:, 1]])
+
+num_flakes = sum(len(scores) for scores in flake_tile_scores)
+print(f"Scans: {len(SCAN_DIRECTORIES)} | Flakes: {num_flakes}")
+
+for recall_target in RECALL_TARGETS:
+    found_flakes = 0
+    num_tiles = 0
+    num_kept = 0
+    for scan_index in range(len(SCAN_DIRECTORIES)):
+        # calibrate on the other scans, a single scan is calibrated on itself
+        other_scores = [
+            scores
+            for other_index, scores in enumerate(flake_tile_scores)
+            if other_index != scan_index or len(SCAN_DIRECTORIES) == 1
+        ]
+        threshold = get_score_threshold(np.concatenate(other_scores), recall_target)
+
+        in_scan_area = scan_area_maps[scan_index] != 0
+        found_flakes += np.count_nonzero(flake_tile_scores[scan_index] >= threshold)
+        num_tiles += np.count_nonzero(in_scan_area)
+        num_kept += np.count_nonzero(
+            in_scan_area & (tile_scores[scan_index] >= threshold)
+        )
+
+    recall = found_flakes / max(num_flakes, 1)
+    time_saved = (num_tiles - num_kept) * SECONDS_PER_TILE / len(SCAN_DIRECTORIES)
+    print(
+        f"Recall target {recall_target:5.1%} | measured recall: {recall:6.1%} | tiles kept: {num_kept / max(num_tiles, 1):6.1%} | saved per scan: ~{time_saved / 60:.1f} min"
+    )
+
+if WRITE_CALIBRATION:
+    with open(CALIBRATION_PATH, "w") as f:
+        json.dump(
+            {
+                "magnification": MAGNIFICATION,
+                "scan_directories": SCAN_DIRECTORIES,
+                "flake_tile_scores": np.concatenate(flake_tile_scores).tolist(),
+            },
+            f,
+            indent=4,
+        )
+    print(f"Calibration written to {CALIBRATION_PATH}")
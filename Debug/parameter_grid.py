@@ -1,17 +1,31 @@
+"""
+Finds the lamp and camera settings which give the target background intensity and records a sweep of images.
+The sweep skips settings the fitted model predicts as too dark or saturated and is ordered so the slow lamp voltage and aperture stop change as rarely as possible.
+"""
+import json
 import os
-import cv2
+import sys
 import time
 
-from Drivers.Camera_Driver.camera_class import camera_driver_class
-from Drivers.Microscope_Driver.microscope_class import (
-    microscope_driver_class,
+import numpy as np
+
+from Utils.codec_functions import write_image
+from Utils.illumination_functions import (
+    estimate_sweep_time,
+    find_illumination_settings,
+    get_exposure_settle_time,
+    order_sweep,
+    VOLTAGE_SETTLE_TIME,
+    APERTURE_SETTLE_TIME,
 )
 
-file_path = "Path/To/Save/Location"
-os.makedirs(file_path)
+FILE_PATH = "Path/To/Save/Location"
+USE_SIMULATED_DRIVERS = False  # Try the script without the microscope
 
-microscope = microscope_driver_class()
-camera = camera_driver_class()
+TARGET_INTENSITY = 180  # The mean background intensity of the brightest channel
+RUN_SWEEP = True  # Record the images of the whole grid after the search
+MIN_INTENSITY = 20  # Darker settings are skipped in the sweep
+MAX_SATURATED_FRACTION = 0.01  # More saturated settings are skipped in the sweep
 
 GAIN = 0
 WHITE_BALANCE = (127, 64, 90)
@@ -21,37 +35,97 @@ APERTURE_RANGE = [1.2, 2, 2.5, 3, 4, 5, 6, 7, 8, 8.5]
 EXPOSURE_RANGE = [0.01 * n for n in range(1, 50, 2)]
 VOLTAGE_RANGE = [n for n in range(4, 11)]
 
-i = 0
-max_i = len(APERTURE_RANGE) * len(EXPOSURE_RANGE) * len(VOLTAGE_RANGE)
+os.makedirs(FILE_PATH)
+
+if USE_SIMULATED_DRIVERS:
+    from Drivers import (
+        SimulatedCameraDriver,
+        SimulatedMicroscopeDriver,
+        SimulatedMotorDriver,
+    )
+
+    motor = SimulatedMotorDriver(35, 34)
+    microscope = SimulatedMicroscopeDriver()
+    camera = SimulatedCameraDriver(motor, microscope)
+else:
+    from Drivers import CameraDriver, MicroscopeDriver
+
+    microscope = MicroscopeDriver()
+    camera = CameraDriver()
+
+camera.set_properties(
+    gain=GAIN,
+    white_balance=WHITE_BALANCE,
+    gamma=GAMMA,
+)
+
+# 1. Search the settings for the target intensity
+start_time = time.time()
+best_settings, model = find_illumination_settings(
+    microscope_driver=microscope,
+    camera_driver=camera,
+    target_intensity=TARGET_INTENSITY,
+    voltage_steps=VOLTAGE_RANGE,
+    aperture_steps=APERTURE_RANGE,
+    exposure_range=(min(EXPOSURE_RANGE), max(EXPOSURE_RANGE)),
+)
+print(f"Search took {time.time() - start_time:.1f} s")
+
+with open(os.path.join(FILE_PATH, "best_settings.json"), "w") as f:
+    json.dump(
+        {
+            **best_settings,
+            "model_coefficients": model.coefficients.tolist(),
+        },
+        f,
+        indent=4,
+    )
 
-for voltage in VOLTAGE_RANGE:
-    microscope.set_lamp_voltage(voltage)
-    time.sleep(1)
+if not RUN_SWEEP:
+    sys.exit()
 
-    for aperture in APERTURE_RANGE:
+# 2. Record the grid, without the settings the model already knows to be useless
+settings = np.stack(
+    np.meshgrid(VOLTAGE_RANGE, APERTURE_RANGE, EXPOSURE_RANGE, indexing="ij"),
+    axis=-1,
+).reshape(-1, 3)
+predicted_intensities = model.predict(settings[:, 0], settings[:, 1], settings[:, 2])
+useful = (predicted_intensities >= MIN_INTENSITY) & (
+    model.predict_saturation(predicted_intensities) <= MAX_SATURATED_FRACTION
+)
+
+ordered_settings = order_sweep(settings[useful])
+print(
+    f"Sweeping {len(ordered_settings)} of {len(settings)} settings, estimated {estimate_sweep_time(ordered_settings) / 60:.1f} min instead of {estimate_sweep_time(settings) / 60:.1f} min for the full grid"
+)
+
+current_voltage, current_aperture = None, None
+for i, (voltage, aperture, exposure) in enumerate(ordered_settings.tolist(), 1):
+    print(
+        f"{i} / {len(ordered_settings)} : {i/len(ordered_settings) * 100:.2f}%",
+        end="\t\r",
+    )
+
+    settle_time = get_exposure_settle_time(exposure)
+    if voltage != current_voltage:
+        microscope.set_lamp_voltage(voltage)
+        settle_time = max(settle_time, VOLTAGE_SETTLE_TIME)
+    if aperture != current_aperture:
         microscope.set_lamp_aperture_stop(aperture)
-        time.sleep(1)
-
-        for exposure in EXPOSURE_RANGE:
-            i = i + 1
-            print(f"{i} / {max_i} : {i/max_i * 100:.2f}%", end="\t\r")
-            camera.set_properties(
-                exposure=exposure,
-                gain=GAIN,
-                white_balance=WHITE_BALANCE,
-                gamma=GAMMA,
-            )
-
-            time.sleep(0.6)
-
-            img = camera.get_image()
-
-            cam_props = camera.get_properties()
-            mic_props = microscope.get_properties()
-            all_props = {**cam_props, **mic_props}
-
-            picture_path = os.path.join(
-                file_path,
-                f"{round(all_props['light'],1):.1f}_{round(all_props['aperture'],1):.1f}_{round(all_props['exposure'],2):.2f}.png",
-            )
-            cv2.imwrite(picture_path, img)
+        settle_time = max(settle_time, APERTURE_SETTLE_TIME)
+    camera.set_properties(exposure=exposure)
+    current_voltage, current_aperture = voltage, aperture
+
+    time.sleep(settle_time)
+
+    img = camera.get_image()
+
+    cam_props = camera.get_properties()
+    mic_props = microscope.get_properties()
+    all_props = {**cam_props, **mic_props}
+
+    picture_path = os.path.join(
+        FILE_PATH,
+        f"{round(all_props['light'],1):.1f}_{round(all_props['aperture'],1):.1f}_{round(all_props['exposure'],2):.2f}.png",
+    )
+    write_image(picture_path, img, "raw_tile")
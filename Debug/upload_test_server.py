@@ -0,0 +1,163 @@
+"""
+A local stand-in for the upload server, used to test the chunked upload without the website.
+Implements the protocol of Utils.upload_functions.ChunkedUploader and stores the received files in STORAGE_DIRECTORY.
+The content of every received file is kept once in STORAGE_DIRECTORY/.blobs under its sha256 hash.
+FAILURE_RATE randomly drops requests to test the retries and the resuming.
+"""
+import hashlib
+import json
+import os
+import random
+import shutil
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, unquote, urlparse
+
+HOST = "localhost"
+PORT = 4999
+URL_PREFIX = "/upload"  # The path of the SERVER_URL
+STORAGE_DIRECTORY = "C:/Path/To/Upload/Storage"
+FAILURE_RATE = 0.0  # The fraction of requests answered with an error
+
+# the handler threads share the blob directory
+blob_lock = threading.Lock()
+
+
+def hash_file(path: str) -> str:
+    file_hash = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1024**2), b""):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+
+def get_blob_path(file_hash: str) -> str:
+    return os.path.join(STORAGE_DIRECTORY, ".blobs", file_hash)
+
+
+class UploadHandler(BaseHTTPRequestHandler):
+    def _send_json(self, status: int, data: dict):
+        body = json.dumps(data).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _resolve_path(self, relative_path: str) -> str:
+        storage_directory = os.path.abspath(STORAGE_DIRECTORY)
+        path = os.path.abspath(os.path.join(storage_directory, relative_path))
+
+        # never write outside of the storage directory
+        if os.path.commonpath([path, storage_directory]) != storage_directory:
+            raise ValueError(f"Invalid path {relative_path}")
+        return path
+
+    def _append_chunk(self, path: str, offset: int, body: bytes):
+        """Writes the chunk at the offset, returns the new size or None if the offset does not match the file"""
+        size = os.path.getsize(path) if os.path.exists(path) else 0
+        if offset != 0 and offset != size:
+            return None
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "r+b" if offset != 0 else "wb") as f:
+            f.seek(offset)
+            f.write(body)
+        return offset + len(body)
+
+    def _handle_manifest(self, scan_path: str, files: dict):
+        # assembles the scan from the blobs, files which are already up to date are skipped
+        missing_paths = []
+        for relative_path, file_hash in files.items():
+            path = self._resolve_path(os.path.join(scan_path, relative_path))
+            if os.path.exists(path) and hash_file(path) == file_hash:
+                continue
+            if not os.path.exists(get_blob_path(file_hash)):
+                missing_paths.append(relative_path)
+                continue
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            shutil.copyfile(get_blob_path(file_hash), path)
+
+        print(
+            f"Scan {os.path.basename(scan_path)} synchronized, {len(missing_paths)} files missing"
+        )
+        self._send_json(200, {"missing": missing_paths})
+
+    def do_POST(self):
+        url = urlparse(self.path)
+        query = parse_qs(url.query)
+        body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+        if random.random() < FAILURE_RATE:
+            self._send_json(503, {"error": "simulated failure"})
+            return
+
+        relative_path = unquote(url.path[len(URL_PREFIX) :].lstrip("/"))
+        try:
+            path = self._resolve_path(relative_path)
+        except ValueError as e:
+            self._send_json(400, {"error": str(e)})
+            return
+
+        if relative_path == "blobs/missing":
+            missing_hashes = [
+                file_hash
+                for file_hash in json.loads(body)["hashes"]
+                if not os.path.exists(get_blob_path(file_hash))
+            ]
+            self._send_json(200, {"missing": missing_hashes})
+            return
+
+        if relative_path.endswith("/manifest"):
+            try:
+                self._handle_manifest(
+                    os.path.dirname(relative_path), json.loads(body)["files"]
+                )
+            except ValueError as e:
+                self._send_json(400, {"error": str(e)})
+            return
+
+        offset = int(query.get("offset", ["0"])[0])
+        expected_size = int(query.get("size", ["-1"])[0])
+        is_blob = relative_path.startswith("blobs/")
+        if is_blob:
+            file_hash = os.path.basename(relative_path)
+            path = get_blob_path(file_hash) + ".part"
+
+        size = self._append_chunk(path, offset, body)
+        if size is None:
+            # a completed blob has no part file anymore, report the size of the blob
+            if is_blob and not os.path.exists(path):
+                path = get_blob_path(file_hash)
+            self._send_json(
+                409, {"size": os.path.getsize(path) if os.path.exists(path) else 0}
+            )
+            return
+
+        if is_blob and size >= expected_size:
+            # a blob is only accepted if its content matches its hash
+            if hash_file(path) != file_hash:
+                os.remove(path)
+                self._send_json(400, {"error": "hash mismatch"})
+                return
+            os.replace(path, get_blob_path(file_hash))
+        elif expected_size >= 0 and size >= expected_size:
+            # files uploaded by their path are kept as blobs as well
+            file_hash = hash_file(path)
+            with blob_lock:
+                if not os.path.exists(get_blob_path(file_hash)):
+                    shutil.copyfile(path, get_blob_path(file_hash))
+
+        self._send_json(200, {"size": size})
+
+    def log_message(self, format, *args):
+        pass
+
+
+if __name__ == "__main__":
+    os.makedirs(os.path.join(STORAGE_DIRECTORY, ".blobs"), exist_ok=True)
+    server = ThreadingHTTPServer((HOST, PORT), UploadHandler)
+    print(
+        f"Listening on http://{HOST}:{PORT}{URL_PREFIX}, storing in {STORAGE_DIRECTORY}"
+    )
+    server.serve_forever()
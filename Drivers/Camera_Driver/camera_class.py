@@ -1,5 +1,6 @@
 from Drivers.Interfaces.Camera_Interface import CameraDriverInterface
 import Drivers.Camera_Driver.tisgrabber.tisgrabber as IC
+from Utils.preprocessor_functions import create_white_balance_lut, demosaic_image
 import cv2
 import numpy as np
 import time
@@ -17,10 +18,47 @@ class CameraDriver(CameraDriverInterface):
         NULL_G=14,
         NULL_B=14,
     ):
+        # The video formats the camera can stream, switched with set_capture_profile
+        # binning is the number of sensor pixels averaged into one pixel of the frame
+        # bayer_pattern marks raw formats which are demosaiced on the host, the pattern is the one of the upside down buffer
+        self.CAPTURE_PROFILES = {
+            "rgb": {
+                "video_format": "RGB24 (1920x1200)",
+                "sink_format": "RGB24",
+                "frame_rate": 13.5,
+                "binning": 1,
+            },
+            "raw": {
+                "video_format": "BY8 (1920x1200)",
+                "sink_format": "Y800",
+                "frame_rate": 40,
+                "binning": 1,
+                "bayer_pattern": "GBRG",
+            },
+            "binned": {
+                "video_format": "RGB24 (960x600) [Binning 2x]",
+                "sink_format": "RGB24",
+                "frame_rate": 40,
+                "binning": 2,
+            },
+            "roi": {
+                "video_format": "RGB24 (960x600)",
+                "sink_format": "RGB24",
+                "frame_rate": 40,
+                "binning": 1,
+                "auto_center": True,
+            },
+        }
+        self.capture_profile = None
+        self.is_live = False
+
+        self.set_new_null_image(NULL_R, NULL_G, NULL_B)
+
         self.camera = self.__init_camera(cam_name)
 
-        self.null_image = np.full(
-            (1200, 1920, 3), np.array([NULL_B, NULL_G, NULL_R], dtype=np.uint8)
+        # the raw formats are white balanced on the host with the white balance of the camera
+        self.white_balance_lut = create_white_balance_lut(
+            self.get_properties()["white_balance"]
         )
 
         self.DEFAULT_PROPERTIES = {
@@ -74,20 +112,74 @@ class CameraDriver(CameraDriverInterface):
             print(f"No device found with the name {cam_name}, Choose Camera : ")
             Camera.ShowDeviceSelectionDialog()
 
-        # Set a video format
-        Camera.SetVideoFormat("RGB24 (1920x1200)")
+        self.camera = Camera
 
-        # Set a frame rate
-        Camera.SetFrameRate(13.5)
+        # Set the video format and start the live video
+        self.set_capture_profile("rgb")
+        return Camera
+
+    def set_capture_profile(self, profile: str):
+        """
+        Switches the video format of the camera without reopening the device\n
+        The live video is stopped, reconfigured and restarted, the exposure, gain and white balance are kept\n
+        Keeps the previous profile if the camera does not support the video format, without a previous profile a ValueError is raised\n
+        profile is a key of CAPTURE_PROFILES
+        """
+        if profile == self.capture_profile:
+            return
+
+        settings = self.CAPTURE_PROFILES[profile]
+        start_time = time.time()
+
+        if self.is_live:
+            self.camera.StopLive()
+            self.is_live = False
+
+        if self.camera.SetVideoFormat(settings["video_format"]) != 1:
+            print(
+                f"The camera does not support the video format {settings['video_format']}, available are: {self.camera.GetVideoFormats()}"
+            )
+            previous_profile = self.capture_profile
+            self.capture_profile = None
+            # without any working profile the camera can not deliver frames
+            if previous_profile is None:
+                raise ValueError(
+                    f"The camera does not support the video format {settings['video_format']} of the {profile} profile, check CAPTURE_PROFILES"
+                )
+            self.set_capture_profile(previous_profile)
+            return
+
+        # center the region of interest of a partial scan on the sensor
+        if settings.get("auto_center", False):
+            self.camera.SetPropertySwitch("Partial scan", "Auto-center", 1)
+
+        self.camera.SetFormat(IC.SinkFormats[settings["sink_format"]])
+        self.camera.SetFrameRate(settings["frame_rate"])
 
         # Start the live video stream, but show no own live video window. We will use OpenCV for this.
-        Camera.StartLive(0)
-        return Camera
+        self.camera.StartLive(0)
+        self.is_live = True
+        self.capture_profile = profile
+
+        # the null image and the demosaicing buffer follow the size of the frames
+        width = self.camera.get_video_format_width()
+        height = self.camera.get_video_format_height()
+        self.null_image = np.full((height, width, 3), self.null_values)
+        self.demosaic_buffer = np.empty((height, width, 3), dtype=np.uint8)
+
+        print(
+            f"Capture profile {profile} ({settings['video_format']}) set in {time.time() - start_time:.2f} s"
+        )
 
     def set_new_null_image(self, NULL_R, NULL_G, NULL_B):
-        self.null_image = np.full(
-            (1200, 1920, 3), np.array([NULL_B, NULL_G, NULL_R], dtype=np.uint8)
-        )
+        self.null_values = np.array([NULL_B, NULL_G, NULL_R], dtype=np.uint8)
+        self.null_image = np.full((1200, 1920, 3), self.null_values)
+
+    def get_null_values(self):
+        """
+        returns the null ("DUNKELSTROM") values of the camera in BGR
+        """
+        return self.null_values
 
     def get_camera(self):
         return self.camera
@@ -143,6 +235,7 @@ class CameraDriver(CameraDriverInterface):
             self.camera.SetPropertyValue("Gamma", "Value", gamma)
 
         if white_balance is not None:
+            self.white_balance_lut = create_white_balance_lut(white_balance)
             self.camera.SetPropertyValue(
                 "WhiteBalance", "White Balance Red", white_balance[0]
             )
@@ -161,6 +254,8 @@ class CameraDriver(CameraDriverInterface):
         'exposure' : the current exposure time in seconds\n
         'gamma' : the gamma of the image, 120 means 1.2 etc..\n
         'white_balance' : the rgb white balance in tuple form e.g. (64,64,64)\n
+        'capture_profile' : the current video format, a key of CAPTURE_PROFILES\n
+        'binning' : the number of sensor pixels binned into one pixel by the current video format\n
         'time' : the current time as unix timestamp
         """
         val_dict = {}
@@ -180,6 +275,13 @@ class CameraDriver(CameraDriverInterface):
 
         val_dict["white_balance"] = (WBr, WBg, WBb)
 
+        val_dict["capture_profile"] = self.capture_profile
+        val_dict["binning"] = (
+            1
+            if self.capture_profile is None
+            else self.CAPTURE_PROFILES[self.capture_profile]["binning"]
+        )
+
         val_dict["time"] = time.time()
 
         return val_dict
@@ -197,8 +299,7 @@ class CameraDriver(CameraDriverInterface):
         'time' : the current time as unix timestamp
         """
 
-        self.camera.SnapImage()
-        image = self.camera.GetImage()
+        image = self.get_raw_image()
 
         # flip the image to get the correct orientation
         image = cv2.flip(image, 0)
@@ -208,6 +309,26 @@ class CameraDriver(CameraDriverInterface):
 
         return image
 
+    def get_raw_image(self):
+        """
+        returns the unprocessed image as delivered by the camera\n
+        The image is upside down and still contains the null values\n
+        Raw Bayer frames are demosaiced and white balanced here\n
+        The returned array is a view on the buffer of the driver, it is only valid until the next image is taken
+        """
+        self.camera.SnapImage()
+        image = self.camera.GetImage()
+
+        bayer_pattern = self.CAPTURE_PROFILES[self.capture_profile].get("bayer_pattern")
+        if bayer_pattern is not None:
+            image = demosaic_image(
+                image,
+                bayer_pattern,
+                self.white_balance_lut,
+                out=self.demosaic_buffer,
+            )
+        return image
+
     def stop_camera(self):
         self.camera.StopLive()
 
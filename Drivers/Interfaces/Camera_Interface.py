@@ -32,6 +32,17 @@ class CameraDriverInterface(ABC):
         """
         pass
 
+    @abstractmethod
+    def set_capture_profile(self, profile: str):
+        """
+        Switches the video format of the camera without reopening it, e.g. to a binned format for the overview.
+
+        Args:
+            profile (str): A key of the `CAPTURE_PROFILES` of the driver. Binned profiles deliver smaller frames of the same field of view,
+            raw profiles are demosaiced on the host and deliver the same frames as the default "rgb" profile.
+        """
+        pass
+
     @abstractmethod
     def get_properties(self):
         """
@@ -39,7 +50,7 @@ class CameraDriverInterface(ABC):
 
         Returns:
             dict: A dictionary containing the current properties of the camera. Includes 'gain', 'exposure',
-            'gamma', 'white_balance', and 'time'.
+            'gamma', 'white_balance', 'capture_profile', 'binning' and 'time'.
         """
         pass
 
@@ -53,6 +64,27 @@ class CameraDriverInterface(ABC):
         """
         pass
 
+    @abstractmethod
+    def get_raw_image(self):
+        """
+        Captures and returns an unprocessed image from the camera.
+        The image is neither flipped nor corrected for the null values of the camera.
+
+        Returns:
+            ndarray: The raw image, only guaranteed to be valid until the next capture.
+        """
+        pass
+
+    @abstractmethod
+    def get_null_values(self):
+        """
+        Returns the null values (dark level) of the camera which are subtracted by `get_image`.
+
+        Returns:
+            ndarray: The null values in BGR.
+        """
+        pass
+
     @abstractmethod
     def stop_camera(self):
         """
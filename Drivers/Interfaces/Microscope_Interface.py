@@ -13,6 +13,26 @@ class MicroscopeDriverInterface(ABC):
         """
         pass
 
+    @abstractmethod
+    def set_z_height(self, height: float):
+        """
+        Moves the focus drive to an absolute height, only works if the hardware AF is not active.
+
+        Args:
+            height (float): The desired height in µm.
+        """
+        pass
+
+    @abstractmethod
+    def get_z_height(self) -> float:
+        """
+        Returns the current height of the focus drive.
+
+        Returns:
+            float: The height in µm.
+        """
+        pass
+
     @abstractmethod
     def lamp_on(self):
         """
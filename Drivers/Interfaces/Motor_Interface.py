@@ -20,12 +20,13 @@ class MotorDriverInterface(ABC):
         pass
 
     @abstractmethod
-    def abs_move(self, x: float, y: float):
+    def abs_move(self, x: float, y: float, wait_for_finish: bool = True):
         """Moves the motor to the specified position in absolute coordinates.
 
         Args:
             x (float): The desired x position.
             y (float): The desired y position.
+            wait_for_finish (bool, optional): Whether to return only once the position is reached. Defaults to True.
         """
         pass
 
@@ -38,3 +39,12 @@ class MotorDriverInterface(ABC):
             dy (float): The desired change in y position.
         """
         pass
+
+    @abstractmethod
+    def set_velocity(self, velocity: float = None):
+        """Sets the velocity of the following moves.
+
+        Args:
+            velocity (float, optional): The velocity of the x and y axis in mm/s. Defaults to None, the default velocity of the motor.
+        """
+        pass
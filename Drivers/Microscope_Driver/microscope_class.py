@@ -40,7 +40,10 @@ class MicroscopeDriver(MicroscopeDriverInterface):
             print("Already in Focus!")
 
     def get_z_height(self):
-        height = self.micro.ZDrive.Value()
+        """
+        Returns the Height in µm, the drive counts in pulses of 0.05 µm like `set_z_height`
+        """
+        height = self.micro.ZDrive.Value() / 20
         return height
 
     def lamp_on(self):
@@ -64,6 +64,9 @@ class MotorDriver(MotorDriverInterface):
 
         self.full_calibrate()
 
+        # the velocity after connecting, restored by set_velocity(None)
+        self.default_velocity = self._get_velocity()
+
     def _calibrate(self):
         # calibrate all axes
         error = self.m_Tango.LSX_Calibrate(self.LSID)
@@ -145,6 +148,53 @@ class MotorDriver(MotorDriverInterface):
 
         return (dx.value, dy.value)
 
+    def _get_velocity(self):
+        # the velocity of all 4 axes in revolutions per second
+        vx = c_double()
+        vy = c_double()
+        vz = c_double()
+        va = c_double()
+        error = self.m_Tango.LSX_GetVel(
+            self.LSID, byref(vx), byref(vy), byref(vz), byref(va)
+        )
+        if error > 0:
+            print("Error: GetVel " + str(error))
+
+        return (vx.value, vy.value, vz.value, va.value)
+
+    def _get_pitch(self):
+        # the spindle pitch of the x and y axis in mm per revolution
+        px = c_double()
+        py = c_double()
+        pz = c_double()
+        pa = c_double()
+        error = self.m_Tango.LSX_GetPitch(
+            self.LSID, byref(px), byref(py), byref(pz), byref(pa)
+        )
+        if error > 0:
+            print("Error: GetPitch " + str(error))
+
+        return (px.value, py.value)
+
+    def set_velocity(self, velocity: float = None):
+        """
+        Sets the velocity of the x and y axis in mm/s for the following moves\n
+        None restores the velocity after connecting\n
+        The Tango expects the velocity in revolutions per second, it is converted with the spindle pitch
+        """
+        vx, vy, vz, va = self._get_velocity()
+        if velocity is None:
+            vx, vy = self.default_velocity[:2]
+        else:
+            pitch_x, pitch_y = self._get_pitch()
+            vx, vy = velocity / pitch_x, velocity / pitch_y
+
+        error = self.m_Tango.LSX_SetVel(
+            self.LSID, c_double(vx), c_double(vy), c_double(vz), c_double(va)
+        )
+        if error > 0:
+            print("Error: SetVel " + str(error))
+
     def abs_move(self, x, y, silent: bool = True, wait_for_finish: bool = True):
         """
         moves to an absolute position, checks for max_y and max_y\n
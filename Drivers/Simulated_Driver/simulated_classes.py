@@ -0,0 +1,486 @@
+"""
+Simulated motor, microscope and camera, used to run and test the scan routines without the hardware\n
+The camera renders a synthetic sample at the current stage position, with a blur depending on the distance to the focal plane.
+"""
+import time
+
+import cv2
+import numpy as np
+
+from Drivers.Interfaces.Camera_Interface import CameraDriverInterface
+from Drivers.Interfaces.Microscope_Interface import MicroscopeDriverInterface
+from Drivers.Interfaces.Motor_Interface import MotorDriverInterface
+from Utils.conversion_functions import FOCUS_HEIGHTS, MICROMETER_PER_PIXEL
+from Utils.preprocessor_functions import demosaic_image
+
+# The depth of field of each objective in µm
+DEPTHS_OF_FIELD = {
+    1: 60,
+    2: 20,
+    3: 1.5,
+    4: 0.6,
+    5: 0.3,
+}
+
+
+class SimulatedSample:
+    """A plate with rectangular chips, each covered with elliptical flakes\n
+    The plate is slightly tilted, so the focal plane depends on the position.
+    """
+
+    def __init__(
+        self,
+        chips=((30, 30, 40, 38),),
+        flakes_per_square_millimeter: float = 100,
+        tilt=(0.4, -0.25),
+        seed: int = 0,
+    ):
+        """
+        Args:
+            chips (tuple, optional): The chips as (x_min, y_min, x_max, y_max) in mm. Defaults to one 10x8 mm chip.
+            flakes_per_square_millimeter (float, optional): The density of the flakes. Defaults to 100.
+            tilt (tuple, optional): The slope of the focal plane in x and y in µm per mm. Defaults to (0.4, -0.25).
+            seed (int, optional): The seed of the flake positions. Defaults to 0.
+        """
+        self.chips = np.array(chips, dtype=np.float64).reshape(-1, 4)
+        self.tilt = tilt
+
+        # BGR colors of the plate, the substrate and the flakes of each thickness
+        self.plate_color = np.array([40, 40, 40], dtype=np.float32)
+        self.substrate_color = np.array([190, 165, 180], dtype=np.float32)
+        self.flake_colors = np.array(
+            [[175, 150, 170], [155, 125, 160], [120, 95, 140]], dtype=np.float32
+        )
+
+        rng = np.random.default_rng(seed)
+        flakes = []
+        for x_min, y_min, x_max, y_max in self.chips:
+            num_flakes = int(
+                (x_max - x_min) * (y_max - y_min) * flakes_per_square_millimeter
+            )
+            flakes.append(
+                np.stack(
+                    [
+                        rng.uniform(x_min, x_max, num_flakes),
+                        rng.uniform(y_min, y_max, num_flakes),
+                        # the semi axes in mm
+                        rng.lognormal(np.log(0.005), 0.8, num_flakes),
+                        rng.lognormal(np.log(0.003), 0.8, num_flakes),
+                        rng.uniform(0, 180, num_flakes),
+                        rng.integers(0, len(self.flake_colors), num_flakes),
+                    ],
+                    axis=1,
+                )
+            )
+        self.flakes = np.concatenate(flakes) if flakes else np.zeros((0, 6))
+
+    def get_focus_height(self, x: float, y: float, magnification_index: int) -> float:
+        """Returns the z height in µm at which the sample is in focus"""
+        return FOCUS_HEIGHTS[magnification_index] + self.tilt[0] * x + self.tilt[1] * y
+
+    def render(
+        self,
+        center_x: float,
+        center_y: float,
+        micrometer_per_pixel: float,
+        shape=(1200, 1920),
+    ) -> np.ndarray:
+        """Renders the field of view around a stage position
+
+        Args:
+            center_x (float): The x position of the image center in mm
+            center_y (float): The y position of the image center in mm
+            micrometer_per_pixel (float): The resolution of the image
+            shape (tuple, optional): The height and width of the image. Defaults to (1200, 1920).
+
+        Returns:
+            (NxMx3 Array): The sharp image as float32
+        """
+        height, width = shape
+        pixel_per_millimeter = 1000 / micrometer_per_pixel
+        left = center_x - width / 2 / pixel_per_millimeter
+        top = center_y - height / 2 / pixel_per_millimeter
+
+        image = np.empty((height, width, 3), dtype=np.float32)
+        image[:] = self.plate_color
+
+        for x_min, y_min, x_max, y_max in self.chips:
+            x_start, x_end = np.clip(
+                np.round((np.array([x_min, x_max]) - left) * pixel_per_millimeter),
+                0,
+                width,
+            ).astype(int)
+            y_start, y_end = np.clip(
+                np.round((np.array([y_min, y_max]) - top) * pixel_per_millimeter),
+                0,
+                height,
+            ).astype(int)
+            image[y_start:y_end, x_start:x_end] = self.substrate_color
+
+        # only the flakes touching the field of view are drawn
+        margin = self.flakes[:, 2] if len(self.flakes) else 0
+        visible = (
+            (self.flakes[:, 0] + margin > left)
+            & (self.flakes[:, 0] - margin < left + width / pixel_per_millimeter)
+            & (self.flakes[:, 1] + margin > top)
+            & (self.flakes[:, 1] - margin < top + height / pixel_per_millimeter)
+        )
+        for x, y, axis_a, axis_b, angle, color_index in self.flakes[visible]:
+            cv2.ellipse(
+                image,
+                (
+                    int((x - left) * pixel_per_millimeter),
+                    int((y - top) * pixel_per_millimeter),
+                ),
+                (
+                    max(int(axis_a * pixel_per_millimeter), 1),
+                    max(int(axis_b * pixel_per_millimeter), 1),
+                ),
+                angle,
+                0,
+                360,
+                self.flake_colors[int(color_index)].tolist(),
+                thickness=-1,
+            )
+
+        return image
+
+
+class SimulatedMotorDriver(MotorDriverInterface):
+    """A stage which moves instantly\n
+    With a velocity set, a move which does not wait for its finish runs in the background at constant velocity, the position follows from the time since its start.
+    """
+
+    def __init__(self, x: float = 0, y: float = 0):
+        self.x = x
+        self.y = y
+        self.velocity = None
+        # the start time, start position, target and velocity of the running move
+        self.move = None
+
+    def _update(self):
+        if self.move is None:
+            return
+        self.x, self.y = self.get_pos_at(time.time())
+        if (self.x, self.y) == self.move[2]:
+            self.move = None
+
+    def get_pos_at(self, timestamp: float):
+        """The position of the stage at a unix time, following the running move"""
+        if self.move is None:
+            return (self.x, self.y)
+        start_time, (start_x, start_y), (target_x, target_y), velocity = self.move
+        distance = np.hypot(target_x - start_x, target_y - start_y)
+        progress = 1.0
+        if distance > 0:
+            progress = np.clip((timestamp - start_time) * velocity / distance, 0, 1)
+        if progress >= 1:
+            return (target_x, target_y)
+        return (
+            start_x + progress * (target_x - start_x),
+            start_y + progress * (target_y - start_y),
+        )
+
+    def get_pos(self):
+        self._update()
+        return (self.x, self.y)
+
+    def get_velocity(self):
+        """The current velocity of the stage in x and y in mm/s"""
+        self._update()
+        if self.move is None:
+            return (0.0, 0.0)
+        _, (start_x, start_y), (target_x, target_y), velocity = self.move
+        distance = np.hypot(target_x - start_x, target_y - start_y)
+        return (
+            velocity * (target_x - start_x) / distance,
+            velocity * (target_y - start_y) / distance,
+        )
+
+    def set_velocity(self, velocity: float = None):
+        # like the real stage, only the following moves use the new velocity
+        self.velocity = velocity
+
+    def abs_move(
+        self, x: float, y: float, silent: bool = True, wait_for_finish: bool = True
+    ):
+        self._update()
+        if self.velocity is None or wait_for_finish:
+            self.move = None
+            self.x = float(x)
+            self.y = float(y)
+        else:
+            self.move = (
+                time.time(),
+                (self.x, self.y),
+                (float(x), float(y)),
+                self.velocity,
+            )
+
+    def rel_move(self, dx: float, dy: float, silent: bool = True):
+        self.abs_move(self.x + dx, self.y + dy)
+        return True
+
+
+class SimulatedMicroscopeDriver(MicroscopeDriverInterface):
+    """A microscope with a motorized z drive and no hardware autofocus"""
+
+    def __init__(self):
+        self.nosepiece = 3
+        self.z_height = FOCUS_HEIGHTS[3]
+        self.voltage = 6.4
+        self.aperture = 2.3
+        self.is_lamp_on = True
+
+    def set_z_height(self, height: float):
+        # the same protection as the real driver
+        if 3500 < height < 6500:
+            self.z_height = float(height)
+
+    def get_z_height(self) -> float:
+        return self.z_height
+
+    def lamp_on(self):
+        self.is_lamp_on = True
+
+    def lamp_off(self):
+        self.is_lamp_on = False
+
+    def rotate_nosepiece_forward(self):
+        self.nosepiece = min(self.nosepiece + 1, 5)
+
+    def rotate_nosepiece_backward(self):
+        self.nosepiece = max(self.nosepiece - 1, 1)
+
+    def set_lamp_voltage(self, voltage: float):
+        self.voltage = voltage
+
+    def set_mag(self, mag_idx: int):
+        if 0 < mag_idx < 6:
+            self.nosepiece = mag_idx
+        else:
+            print(f"Wrong Mag Idx, you gave {mag_idx}, needs to be 1 to 5")
+
+    def set_lamp_aperture_stop(self, aperture_stop: float):
+        self.aperture = aperture_stop
+
+    def get_properties(self):
+        return {
+            "z_height": self.z_height,
+            "nosepiece": self.nosepiece,
+            "aperture": self.aperture,
+            "light": self.voltage,
+        }
+
+
+def _mosaic_image(image: np.ndarray, bayer_pattern: str) -> np.ndarray:
+    """Samples a color image like a sensor with the given Bayer pattern, the inverse of `demosaic_image`"""
+    channels = {"B": 0, "G": 1, "R": 2}
+    bayer_image = np.empty(image.shape[:2], dtype=image.dtype)
+    for index, (row, column) in enumerate([(0, 0), (0, 1), (1, 0), (1, 1)]):
+        bayer_image[row::2, column::2] = image[
+            row::2, column::2, channels[bayer_pattern[index]]
+        ]
+    return bayer_image
+
+
+class SimulatedCameraDriver(CameraDriverInterface):
+    """A camera which renders the sample at the position of the simulated stage\n
+    The image is blurred proportionally to the distance to the focal plane and along the motion of the stage during the exposure, its brightness follows the lamp and the exposure.
+    The capture profiles render binned frames at a lower resolution, crop the center for a region of interest and demosaic a Bayer mosaic for the raw format.
+    """
+
+    # binning is the number of sensor pixels averaged into one pixel, roi_fraction the part of the sensor width and height which is read out
+    CAPTURE_PROFILES = {
+        "rgb": {"binning": 1, "roi_fraction": 1},
+        "raw": {"binning": 1, "roi_fraction": 1, "bayer_pattern": "GBRG"},
+        "binned": {"binning": 2, "roi_fraction": 1},
+        "roi": {"binning": 1, "roi_fraction": 0.5},
+    }
+
+    def __init__(
+        self,
+        motor_driver: SimulatedMotorDriver,
+        microscope_driver: SimulatedMicroscopeDriver,
+        sample: SimulatedSample = None,
+        image_shape=(1200, 1920),
+        noise: float = 2.0,
+        null_values=(14, 14, 14),
+        seed: int = 0,
+    ):
+        """
+        Args:
+            motor_driver (SimulatedMotorDriver): The stage which decides the field of view
+            microscope_driver (SimulatedMicroscopeDriver): The microscope which decides the magnification, focus and illumination
+            sample (SimulatedSample, optional): The imaged sample. Defaults to a new SimulatedSample.
+            image_shape (tuple, optional): The height and width of the images. Defaults to (1200, 1920).
+            noise (float, optional): The standard deviation of the pixel noise. Defaults to 2.0.
+            null_values (tuple, optional): The dark level of the camera in BGR. Defaults to (14, 14, 14).
+            seed (int, optional): The seed of the noise. Defaults to 0.
+        """
+        self.motor_driver = motor_driver
+        self.microscope_driver = microscope_driver
+        self.sample = sample if sample is not None else SimulatedSample()
+        self.sensor_shape = image_shape
+        self.null_values = np.array(null_values, dtype=np.uint8)
+
+        # a fixed noise pattern is much cheaper than drawing new noise for every frame
+        rng = np.random.default_rng(seed)
+        self.sensor_noise_pattern = rng.normal(0, noise, (*image_shape, 3)).astype(
+            np.float32
+        )
+
+        self.capture_profile = None
+        self.set_capture_profile("rgb")
+
+        # the duration of the last capture, the frame is exposed in its middle like in a camera stream
+        self.capture_duration = 0.0
+
+        self.properties = {
+            "exposure": 0.07,
+            "gain": 0,
+            "white_balance": (127, 64, 90),
+            "gamma": 100,
+        }
+
+    def set_properties(
+        self,
+        exposure: float = None,
+        gain: int = None,
+        white_balance: tuple = None,
+        gamma: int = None,
+    ):
+        for key, value in [
+            ("exposure", exposure),
+            ("gain", gain),
+            ("white_balance", white_balance),
+            ("gamma", gamma),
+        ]:
+            if value is not None:
+                self.properties[key] = value
+
+    def set_capture_profile(self, profile: str):
+        if profile == self.capture_profile:
+            return
+        settings = self.CAPTURE_PROFILES[profile]
+        self.capture_profile = profile
+        self.binning = settings["binning"]
+        self.image_shape = tuple(
+            int(length * settings["roi_fraction"]) // self.binning
+            for length in self.sensor_shape
+        )
+        self.null_image = np.empty((*self.image_shape, 3), dtype=np.uint8)
+        self.null_image[:] = self.null_values
+        self.noise_pattern = self.sensor_noise_pattern[
+            : self.image_shape[0], : self.image_shape[1]
+        ]
+
+    def get_properties(self):
+        return {
+            **self.properties,
+            "capture_profile": self.capture_profile,
+            "binning": self.binning,
+            "time": time.time(),
+        }
+
+    def get_null_values(self):
+        return self.null_values
+
+    def get_brightness(self) -> float:
+        """The factor of the illumination relative to the default settings, the lamp voltage acts quadratically"""
+        if not self.microscope_driver.is_lamp_on:
+            return 0.0
+        return (
+            (self.microscope_driver.voltage / 6.4) ** 2
+            * (self.microscope_driver.aperture / 2.3)
+            * (self.properties["exposure"] / 0.07)
+            * 10 ** (self.properties["gain"] / 200)
+        )
+
+    def get_blur_sigma(self) -> float:
+        """The blur in pixels caused by the distance to the focal plane"""
+        magnification_index = self.microscope_driver.nosepiece
+        x, y = self.motor_driver.get_pos()
+        defocus = abs(
+            self.microscope_driver.get_z_height()
+            - self.sample.get_focus_height(x, y, magnification_index)
+        )
+        return (
+            min(2 * defocus / DEPTHS_OF_FIELD[magnification_index], 40) / self.binning
+        )
+
+    def get_motion_blur_kernel(self, max_length: int = 101) -> np.ndarray:
+        """The line the stage moves along during the exposure as a normalized kernel, None if it moves less than a pixel\n
+        The position of the stage is taken as the middle of the exposure.
+        """
+        if not hasattr(self.motor_driver, "get_velocity"):
+            return None
+        velocity_x, velocity_y = self.motor_driver.get_velocity()
+        pixel_per_millimeter = 1000 / (
+            MICROMETER_PER_PIXEL[self.microscope_driver.nosepiece] * self.binning
+        )
+        length_x = velocity_x * self.properties["exposure"] * pixel_per_millimeter
+        length_y = velocity_y * self.properties["exposure"] * pixel_per_millimeter
+        length = np.hypot(length_x, length_y)
+        if length < 1:
+            return None
+
+        scale = min(1.0, (max_length - 1) / length)
+        size = int(np.ceil(length * scale)) | 1
+        center = size // 2
+        kernel = np.zeros((size, size), dtype=np.float32)
+        cv2.line(
+            kernel,
+            (
+                int(round(center - length_x * scale / 2)),
+                int(round(center - length_y * scale / 2)),
+            ),
+            (
+                int(round(center + length_x * scale / 2)),
+                int(round(center + length_y * scale / 2)),
+            ),
+            1.0,
+        )
+        return kernel / kernel.sum()
+
+    def render(self) -> np.ndarray:
+        start_time = time.time()
+        if hasattr(self.motor_driver, "get_pos_at"):
+            x, y = self.motor_driver.get_pos_at(start_time + self.capture_duration / 2)
+        else:
+            x, y = self.motor_driver.get_pos()
+        image = self.sample.render(
+            x,
+            y,
+            MICROMETER_PER_PIXEL[self.microscope_driver.nosepiece] * self.binning,
+            self.image_shape,
+        )
+
+        blur_sigma = self.get_blur_sigma()
+        if blur_sigma > 0.3:
+            image = cv2.GaussianBlur(image, (0, 0), blur_sigma)
+
+        motion_blur_kernel = self.get_motion_blur_kernel()
+        if motion_blur_kernel is not None:
+            image = cv2.filter2D(image, -1, motion_blur_kernel)
+
+        image = image * self.get_brightness() + self.noise_pattern
+        image = np.clip(image, 0, 255).astype(np.uint8)
+        self.capture_duration = time.time() - start_time
+        return image
+
+    def get_raw_image(self):
+        # like the real camera, the raw image is upside down and contains the null values
+        image = cv2.flip(cv2.add(self.render(), self.null_image), 0)
+
+        bayer_pattern = self.CAPTURE_PROFILES[self.capture_profile].get("bayer_pattern")
+        if bayer_pattern is not None:
+            image = demosaic_image(_mosaic_image(image, bayer_pattern), bayer_pattern)
+        return image
+
+    def get_image(self):
+        image = cv2.flip(self.get_raw_image(), 0)
+        return cv2.subtract(image, self.null_image)
+
+    def stop_camera(self):
+        pass
@@ -1,9 +1,22 @@
-from .Camera_Driver.camera_class import CameraDriver
-from .Microscope_Driver.microscope_class import MicroscopeDriver
-from .Motor_Driver.motor_class import MotorDriver
-
 from .Interfaces.Motor_Interface import MotorDriverInterface
 from .Interfaces.Microscope_Interface import (
     MicroscopeDriverInterface,
 )
 from .Interfaces.Camera_Interface import CameraDriverInterface
+
+# The hardware drivers need the vendor libraries, without them only the simulated drivers are available
+try:
+    from .Camera_Driver.camera_class import CameraDriver
+    from .Microscope_Driver.microscope_class import MicroscopeDriver
+    from .Motor_Driver.motor_class import MotorDriver
+except (ImportError, OSError, AttributeError) as e:
+    print(
+        f"The hardware drivers could not be loaded, only the simulated drivers are available: {e}"
+    )
+
+from .Simulated_Driver.simulated_classes import (
+    SimulatedCameraDriver,
+    SimulatedMicroscopeDriver,
+    SimulatedMotorDriver,
+    SimulatedSample,
+)
@@ -1,15 +1,17 @@
+import argparse
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
-import numpy as np
-from GMMDetector import MaterialDetector
-from skimage.morphology import disk
 
+import Utils.conversion_functions as conversion
+from Utils.cache_functions import DetectionCache
+from Utils.codec_functions import write_image
 from Utils.etc_functions import fallback_convert, sorted_alphanumeric
-from Utils.marker_functions import mark_on_overview
-from Utils.preprocessor_functions import remove_vignette_fast
+from Utils.marker_functions import mark_all_on_overview
+from Utils.offline_detection_functions import run_offline_detection
 
 SCAN_DIRECTORY: str = "/Path/to/scan/directory"  # The Directory of the scan
 SCAN_NAME: str = "SCAN_NAME"  # The name of the folder
@@ -20,144 +22,208 @@ USED_CHANNELS: str = "BGR"  # The Channels which are used for the detection
 STANDARD_DEVIATION_THRESHOLD: float = 5  # Maximum Mahalanobis Distance
 SIZE_THRESHOLD: float = 200  # Flake size threshold in square micrometers (μm²)
 CONFIDENCE_THRESHOLD: float = 0.5  # Minimum confidence for a flake to be detected, it is the same as 1 - False Positive Probability
+USE_EMPTY_TILE_PREFILTER: bool = False  # Whether images without any candidate pixel skip the detection, needs Debug/evaluate_prefilter.py to show no missed flakes first
+NUM_PROCESSES: int = os.cpu_count()  # The number of worker processes running the detection
+USE_DETECTION_CACHE: bool = True  # Whether unchanged images are served from the results of previous runs
+DETECTION_CACHE_SIZE_GB: float = 5  # The maximum size of the detection cache, the oldest entries are removed first
 
-# Directory Paths
-file_path = os.path.dirname(os.path.abspath(__file__))
-scan_directory = os.path.join(SCAN_DIRECTORY, SCAN_NAME)
-
-# Defining directorys
-save_dir = os.path.join(scan_directory, f"{MAGNIFICATION}x", "Masked_Images")
-save_dir_meta = os.path.join(scan_directory, f"{MAGNIFICATION}x", "Masked_Images_Meta")
-image_dir = os.path.join(scan_directory, f"{MAGNIFICATION}x", "Pictures")
-meta_dir = os.path.join(scan_directory, f"{MAGNIFICATION}x", "Meta")
-overview_path = os.path.join(scan_directory, "overview.png")
-marked_overview_path = os.path.join(scan_directory, "overview_marked.png")
-scan_meta_data_path = os.path.join(scan_directory, "meta.json")
-
-# Creating non Existant Paths
-if not os.path.exists(save_dir):
-    os.makedirs(save_dir)
-if not os.path.exists(save_dir_meta):
-    os.makedirs(save_dir_meta)
-
-# Defining parameter Paths
-flatfield_path = os.path.join(
-    file_path,
-    "Parameters",
-    "Flatfields",
-    f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}_{MAGNIFICATION}x.png",
-)
-contrasts_path = os.path.join(
-    file_path,
-    "Parameters",
-    "Contrasts",
-    f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}.json",
-)
-
-image_names = sorted_alphanumeric(os.listdir(image_dir))
-meta_names = sorted_alphanumeric(os.listdir(meta_dir))
-num_images = len(image_names)
-
-overview_image = cv2.imread(overview_path)
-
-with open(contrasts_path) as f:
-    contrast_params = json.load(f)
-
-flatfield = cv2.imread(flatfield_path)
-if flatfield is not None:
-    flatfield_mean = np.array(cv2.mean(flatfield)[:-1])
-else:
-    raise ValueError(
-        f"No flatfield found at {flatfield_path}, please supply a flatfield for the used material and magnification"
+
+def parse_arguments():
+    parser = argparse.ArgumentParser(
+        description="Runs the flake detection on the 20x images of a recorded scan"
+    )
+    parser.add_argument("--scan-directory", default=SCAN_DIRECTORY)
+    parser.add_argument("--scan-name", default=SCAN_NAME)
+    parser.add_argument("--material", default=EXFOLIATED_MATERIAL)
+    parser.add_argument("--chip-thickness", default=CHIP_THICKNESS)
+    parser.add_argument("--magnification", type=int, default=MAGNIFICATION)
+    parser.add_argument("--used-channels", default=USED_CHANNELS)
+    parser.add_argument(
+        "--standard-deviation-threshold",
+        type=float,
+        default=STANDARD_DEVIATION_THRESHOLD,
+    )
+    parser.add_argument("--size-threshold", type=float, default=SIZE_THRESHOLD)
+    parser.add_argument(
+        "--confidence-threshold", type=float, default=CONFIDENCE_THRESHOLD
+    )
+    parser.add_argument(
+        "--prefilter",
+        dest="use_prefilter",
+        action="store_true",
+        default=USE_EMPTY_TILE_PREFILTER,
+    )
+    parser.add_argument("--processes", type=int, default=NUM_PROCESSES)
+    parser.add_argument(
+        "--no-cache",
+        dest="use_cache",
+        action="store_false",
+        default=USE_DETECTION_CACHE,
+    )
+    parser.add_argument(
+        "--cache-directory",
+        default=None,
+        help="Defaults to the Detection_Cache folder of the scan",
     )
+    parser.add_argument("--cache-size-gb", type=float, default=DETECTION_CACHE_SIZE_GB)
+    return parser.parse_args()
 
-start_time = time.time()
-current_flake_number = 0
-current_image_number = 0
-
-model = MaterialDetector(
-    contrast_dict=contrast_params,
-    size_threshold=SIZE_THRESHOLD,
-    standard_deviation_threshold=STANDARD_DEVIATION_THRESHOLD,
-    used_channels=USED_CHANNELS,
-)
-
-for idx, (image_name, meta_name) in enumerate(zip(image_names, meta_names)):
-    image_path = os.path.join(image_dir, image_name)
-    detected_flake = False
-
-    time_to_go = (time.time() - start_time) / (idx + 1) * (num_images - (idx + 1))
-    time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
-    print(
-        f"{(idx+1)} / {num_images} ({(idx+1) / num_images:.0%}) | Time to go: {time_string} | Time per Image {(time.time() - start_time) / (idx+1) * 1000:.0f}ms",
-        end="\r",
+
+def write_json(path, data):
+    with open(path, "w") as f:
+        json.dump(data, f, indent=4, sort_keys=True, default=fallback_convert)
+
+
+def main():
+    args = parse_arguments()
+
+    # Directory Paths
+    file_path = os.path.dirname(os.path.abspath(__file__))
+    scan_directory = os.path.join(args.scan_directory, args.scan_name)
+
+    # Defining directorys
+    magnification_directory = os.path.join(scan_directory, f"{args.magnification}x")
+    save_dir = os.path.join(magnification_directory, "Masked_Images")
+    save_dir_meta = os.path.join(magnification_directory, "Masked_Images_Meta")
+    image_dir = os.path.join(magnification_directory, "Pictures")
+    meta_dir = os.path.join(magnification_directory, "Meta")
+    cache_dir = args.cache_directory or os.path.join(
+        magnification_directory, "Detection_Cache"
+    )
+    overview_path = os.path.join(scan_directory, "overview.png")
+    marked_overview_path = os.path.join(scan_directory, "overview_marked.png")
+
+    # Creating non Existant Paths
+    if not os.path.exists(save_dir):
+        os.makedirs(save_dir)
+    if not os.path.exists(save_dir_meta):
+        os.makedirs(save_dir_meta)
+
+    # Defining parameter Paths
+    flatfield_path = os.path.join(
+        file_path,
+        "Parameters",
+        "Flatfields",
+        f"{args.material.lower()}_{args.chip_thickness}_{args.magnification}x.png",
     )
+    contrasts_path = os.path.join(
+        file_path,
+        "Parameters",
+        "GMM_Parameters",
+        f"{args.material.lower()}_{args.chip_thickness}.json",
+    )
+    magnification_params_path = os.path.join(
+        file_path,
+        "Parameters",
+        "Scan_Magnification",
+        f"{args.magnification}x.json",
+    )
+
+    image_names = sorted_alphanumeric(os.listdir(image_dir))
+    meta_names = sorted_alphanumeric(os.listdir(meta_dir))
+    image_paths = [os.path.join(image_dir, image_name) for image_name in image_names]
+    num_images = len(image_names)
 
-    image = cv2.imread(image_path)
-    image = remove_vignette_fast(image, flatfield, flatfield_mean=flatfield_mean)
-    detected_flakes = model(image)
+    overview_image = cv2.imread(overview_path)
 
-    for flake in detected_flakes:
-        if 1 - flake.false_positive_probability < CONFIDENCE_THRESHOLD:
-            continue
+    with open(contrasts_path) as f:
+        contrast_params = json.load(f)
+    with open(magnification_params_path) as f:
+        magnification_params = json.load(f)
 
-        detected_flake = True
-        current_flake_number += 1
+    flatfield = cv2.imread(flatfield_path)
+    if flatfield is None:
+        raise ValueError(
+            f"No flatfield found at {flatfield_path}, please supply a flatfield for the used material and magnification"
+        )
 
-        outline_flake = cv2.morphologyEx(
-            flake.mask,
-            cv2.MORPH_GRADIENT,
-            disk(1),
+    detector_kwargs = {
+        "size_threshold": conversion.micrometers_to_pixels(
+            args.size_threshold, args.magnification
+        ),
+        "standard_deviation_threshold": args.standard_deviation_threshold,
+        "used_channels": args.used_channels,
+    }
+
+    detection_cache = None
+    if args.use_cache:
+        detection_cache = DetectionCache(
+            cache_dir, max_size_bytes=int(args.cache_size_gb * 1024**3)
         )
-        image[outline_flake != 0] = [0, 0, 255]
-
-        cv2.putText(
-            image,
-            f"{flake.thickness}",
-            flake.center,
-            cv2.FONT_HERSHEY_SIMPLEX,
-            thickness=1,
-            fontScale=1,
-            color=(0, 0, 0),
+
+    start_time = time.time()
+    current_flake_number = 0
+    current_image_number = 0
+    flake_motor_positions = []
+    meta_writes = []
+
+    # the metadata is written in the background, the main process only collects the results
+    with ThreadPoolExecutor(max_workers=4) as meta_writer:
+        detection_results = run_offline_detection(
+            image_paths=image_paths,
+            contrast_params=contrast_params,
+            flatfield=flatfield,
+            detector_kwargs=detector_kwargs,
+            confidence_threshold=args.confidence_threshold,
+            use_prefilter=args.use_prefilter,
+            marked_image_directory=save_dir,
+            num_processes=args.processes,
+            cache=detection_cache,
         )
 
-        # remove the mask from the dict, since we want to save the metadata
-        flake_dict = flake.to_dict()
-        del flake_dict["mask"]
-
-        with open(
-            os.path.join(save_dir_meta, f"{current_flake_number}_{meta_name}"),
-            "w",
-        ) as f:
-            json.dump(
-                flake_dict,
-                f,
-                indent=4,
-                sort_keys=True,
-                default=fallback_convert,
+        for idx, flake_dicts in detection_results:
+            image_name = image_names[idx]
+            meta_name = meta_names[idx]
+
+            time_to_go = (
+                (time.time() - start_time) / (idx + 1) * (num_images - (idx + 1))
+            )
+            time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
+            print(
+                f"{(idx+1)} / {num_images} ({(idx+1) / num_images:.0%}) | Time to go: {time_string} | Time per Image {(time.time() - start_time) / (idx+1) * 1000:.0f}ms",
+                end="\r",
             )
 
-    # Run this only if a flake was found, where the FP Probability is below the threshold
-    if detected_flake:
-        current_image_number += 1
-        print(
-            f"A total of {len(detected_flakes)} flakes were found in image {image_name}"
-        )
+            # Run this only if a flake was found, where the FP Probability is below the threshold
+            if len(flake_dicts) == 0:
+                continue
+
+            for flake_dict in flake_dicts:
+                current_flake_number += 1
+                meta_write = meta_writer.submit(
+                    write_json,
+                    os.path.join(save_dir_meta, f"{current_flake_number}_{meta_name}"),
+                    flake_dict,
+                )
+                meta_writes.append(meta_write)
+
+            current_image_number += 1
+            print(
+                f"A total of {len(flake_dicts)} flakes were found in image {image_name}"
+            )
 
-        # extract the flake position and mark it on the overview image
-        meta_data = json.load(open(os.path.join(meta_dir, meta_name), "r"))
-        overview_image = mark_on_overview(
+            # extract the flake position, they are marked on the overview at the end
+            with open(os.path.join(meta_dir, meta_name), "r") as f:
+                meta_data = json.load(f)
+            flake_motor_positions.append(meta_data["motor_pos"])
+
+        # raise any error which occured while writing the metadata
+        for meta_write in meta_writes:
+            meta_write.result()
+
+    if overview_image is not None:
+        overview_image = mark_all_on_overview(
             overview_image=overview_image,
-            motor_pos=meta_data["motor_pos"],
+            motor_positions=flake_motor_positions,
+            x_offset=magnification_params["x_offset"],
+            y_offset=magnification_params["y_offset"],
         )
+        write_image(marked_overview_path, overview_image, "overview")
 
-        cv2.imwrite(
-            os.path.join(save_dir, f"{image_name}"),
-            image,
-        )
+    elapsed_time = time.time() - start_time
+    time_string = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
+    print(f"Total Elapsed Time: {time_string}")
 
-cv2.imwrite(marked_overview_path, overview_image)
 
-elapsed_time = time.time() - start_time
-time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
-print(f"Total Elapsed Time: {time_string}")
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,137 @@
+import csv
+import json
+import os
+import time
+
+import cv2
+
+import Utils.conversion_functions as conversion
+from Utils.etc_functions import sorted_alphanumeric
+from Utils.offline_detection_functions import (
+    create_detector_grid,
+    run_parameter_sweep,
+    summarize_parameter_sweep,
+)
+
+SCAN_DIRECTORY: str = "/Path/to/scan/directory"  # The Directory of the scan
+SCAN_NAME: str = "SCAN_NAME"  # The name of the folder
+EXFOLIATED_MATERIAL: str = "MATERIAL"  # The Material on the Wafer
+CHIP_THICKNESS: str = "THICKNESS"  # The Thickness of the Wafer
+MAGNIFICATION: int = 20  # The used Magnification to infer flake size
+USED_CHANNELS: list = ["BGR", "GR"]  # The Channels which are used for the detection
+STANDARD_DEVIATION_THRESHOLDS: list = [3, 4, 5]  # Maximum Mahalanobis Distances
+SIZE_THRESHOLDS: list = [100, 200, 400]  # Flake size thresholds in μm²
+CONFIDENCE_THRESHOLDS: list = [0.5, 0.7, 0.9]  # Applied after the detection
+USE_EMPTY_TILE_PREFILTER: bool = False  # Skip images without candidate pixels, evaluate it first
+NUM_PROCESSES: int = os.cpu_count()  # The number of worker processes
+
+
+def main():
+    # Directory Paths
+    file_path = os.path.dirname(os.path.abspath(__file__))
+    scan_directory = os.path.join(SCAN_DIRECTORY, SCAN_NAME)
+    image_dir = os.path.join(scan_directory, f"{MAGNIFICATION}x", "Pictures")
+    result_path = os.path.join(scan_directory, "parameter_sweep.csv")
+
+    # Defining parameter Paths
+    flatfield_path = os.path.join(
+        file_path,
+        "Parameters",
+        "Flatfields",
+        f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}_{MAGNIFICATION}x.png",
+    )
+    contrasts_path = os.path.join(
+        file_path,
+        "Parameters",
+        "GMM_Parameters",
+        f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}.json",
+    )
+
+    with open(contrasts_path) as f:
+        contrast_params = json.load(f)
+
+    flatfield = cv2.imread(flatfield_path)
+    if flatfield is None:
+        raise ValueError(
+            f"No flatfield found at {flatfield_path}, please supply a flatfield for the used material and magnification"
+        )
+
+    image_names = sorted_alphanumeric(os.listdir(image_dir))
+    image_paths = [os.path.join(image_dir, image_name) for image_name in image_names]
+    num_images = len(image_paths)
+
+    # the size thresholds are given in μm² but the detector works in pixels
+    parameter_grid = create_detector_grid(
+        size_thresholds=SIZE_THRESHOLDS,
+        standard_deviation_thresholds=STANDARD_DEVIATION_THRESHOLDS,
+        used_channels=USED_CHANNELS,
+    )
+    detector_grid = [
+        {
+            **parameters,
+            "size_threshold": conversion.micrometers_to_pixels(
+                parameters["size_threshold"], MAGNIFICATION
+            ),
+        }
+        for parameters in parameter_grid
+    ]
+    print(
+        f"Evaluating {len(detector_grid)} configurations x {len(CONFIDENCE_THRESHOLDS)} confidence thresholds on {num_images} images"
+    )
+
+    start_time = time.time()
+    sweep_results = {}
+    for idx, results in run_parameter_sweep(
+        image_paths=image_paths,
+        contrast_params=contrast_params,
+        flatfield=flatfield,
+        detector_grid=detector_grid,
+        use_prefilter=USE_EMPTY_TILE_PREFILTER,
+        num_processes=NUM_PROCESSES,
+    ):
+        sweep_results[idx] = results
+
+        time_to_go = (time.time() - start_time) / (idx + 1) * (num_images - (idx + 1))
+        time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
+        print(
+            f"{(idx+1)} / {num_images} ({(idx+1) / num_images:.0%}) | Time to go: {time_string}",
+            end="\r",
+        )
+    print("")
+
+    thickness_classes = list(contrast_params.keys())
+    rows = summarize_parameter_sweep(
+        sweep_results,
+        num_configurations=len(detector_grid),
+        confidence_thresholds=CONFIDENCE_THRESHOLDS,
+        thickness_classes=thickness_classes,
+    )
+
+    # replace the configuration index with the parameters in the units of the constants above
+    table = [{**parameter_grid[row.pop("configuration")], **row} for row in rows]
+
+    with open(result_path, "w", newline="") as f:
+        writer = csv.DictWriter(f, fieldnames=list(table[0].keys()))
+        writer.writeheader()
+        writer.writerows(table)
+
+    header = (
+        f"{'size':>6} {'std':>5} {'channels':>8} {'conf':>5} {'images':>7} {'flakes':>7} | "
+        + " ".join(f"{thickness:>6}" for thickness in thickness_classes)
+    )
+    print(header)
+    print("-" * len(header))
+    for row in table:
+        print(
+            f"{row['size_threshold']:>6.0f} {row['standard_deviation_threshold']:>5} {row['used_channels']:>8} {row['confidence_threshold']:>5} {row['images_with_flakes']:>7} {row['flakes']:>7} | "
+            + " ".join(f"{row[thickness]:>6}" for thickness in thickness_classes)
+        )
+
+    elapsed_time = time.time() - start_time
+    time_string = time.strftime("%H:%M:%S", time.gmtime(elapsed_time))
+    print(f"Results saved to {result_path}")
+    print(f"Total Elapsed Time: {time_string}")
+
+
+if __name__ == "__main__":
+    main()
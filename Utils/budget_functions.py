@@ -0,0 +1,169 @@
+"""
+Time budgeted and target count scans\n
+A scan can end at a deadline, e.g. the end of the instrument booking, or once enough flakes of interest are found.
+The search stops early and the revisits are limited to the highest ranked flakes which still fit into the remaining time.
+"""
+import time
+from typing import List
+
+import numpy as np
+
+from .etc_functions import OBJECTIVE_CHANGE_TIME
+
+SECONDS_PER_REVISIT = 1.5  # The time to move to a flake, settle and capture it at one magnification
+
+
+class ScanBudget:
+    """The deadline and the target of a scan\n
+    Flakes count towards the target if they match the same filters as FlakeCatalog.query.
+    """
+
+    def __init__(
+        self,
+        deadline: float = None,
+        target_count: int = None,
+        thicknesses: List[str] = None,
+        min_size: float = None,
+        min_confidence: float = None,
+        revisit_reserve: float = 0,
+    ):
+        """
+        Args:
+            deadline (float, optional): The unix time the scan has to be finished at, None has no deadline. Defaults to None.
+            target_count (int, optional): The search stops once this many flakes of interest are found, None searches everything. Defaults to None.
+            thicknesses (List[str], optional): The thickness classes of the flakes of interest. Defaults to None.
+            min_size (float, optional): The minimum size of the flakes of interest in square micrometers. Defaults to None.
+            min_confidence (float, optional): The minimum confidence of the flakes of interest. Defaults to None.
+            revisit_reserve (float, optional): The time in seconds before the deadline the search stops, left for the revisits and the upload. Defaults to 0.
+        """
+        self.deadline = deadline
+        self.target_count = target_count
+        self.thicknesses = (
+            {str(thickness) for thickness in thicknesses}
+            if thicknesses is not None
+            else None
+        )
+        self.min_size = min_size
+        self.min_confidence = min_confidence
+        self.revisit_reserve = revisit_reserve
+
+        self.num_found = 0
+
+    @classmethod
+    def from_duration(cls, duration: float, **kwargs) -> "ScanBudget":
+        """Creates a budget with a deadline the duration in seconds from now"""
+        return cls(deadline=time.time() + duration, **kwargs)
+
+    def matches(self, entry: dict) -> bool:
+        """Whether a flake is of interest
+
+        Args:
+            entry (dict): The index entry of the flake, see FlakeCatalog
+
+        Returns:
+            bool: True if the flake counts towards the target
+        """
+        return (
+            (self.thicknesses is None or str(entry["thickness"]) in self.thicknesses)
+            and (self.min_size is None or entry["size"] >= self.min_size)
+            and (
+                self.min_confidence is None
+                or 1 - entry["false_positive_probability"] >= self.min_confidence
+            )
+        )
+
+    def add(self, entry: dict):
+        """Counts a found flake if it is of interest"""
+        if self.matches(entry):
+            self.num_found += 1
+
+    def remaining_time(self) -> float:
+        """The seconds until the deadline, infinite without a deadline"""
+        if self.deadline is None:
+            return np.inf
+        return self.deadline - time.time()
+
+    def is_target_met(self) -> bool:
+        return self.target_count is not None and self.num_found >= self.target_count
+
+    def should_stop_search(self) -> bool:
+        """Whether the search should stop to keep the target or the deadline\n
+        Prints the reason once it stops.
+        """
+        if self.is_target_met():
+            print(f"\nFound {self.num_found} flakes of interest, stopping the search")
+            return True
+        if self.remaining_time() <= self.revisit_reserve:
+            print(
+                f"\nThe deadline is reached after {self.num_found} flakes of interest, stopping the search"
+            )
+            return True
+        return False
+
+
+def rank_flakes(
+    entries: List[dict],
+    scan_budget: ScanBudget = None,
+) -> List[dict]:
+    """Orders the flakes by their value for the user\n
+    Flakes of interest come first, then larger and more confident flakes.
+
+    Args:
+        entries (List[dict]): The index entries of the flakes, see FlakeCatalog
+        scan_budget (ScanBudget, optional): Decides which flakes are of interest. Defaults to None.
+
+    Returns:
+        List[dict]: The entries, the highest ranked first
+    """
+    if len(entries) == 0:
+        return []
+
+    is_of_interest = np.array(
+        [scan_budget is None or scan_budget.matches(entry) for entry in entries]
+    )
+    scores = np.array(
+        [(1 - entry["false_positive_probability"]) * entry["size"] for entry in entries]
+    )
+    order = np.lexsort((-scores, ~is_of_interest))
+    return [entries[index] for index in order]
+
+
+def select_revisit_flakes(
+    entries: List[dict],
+    num_magnifications: int,
+    scan_budget: ScanBudget = None,
+    max_flakes: int = None,
+    seconds_per_revisit: float = SECONDS_PER_REVISIT,
+    objective_change_time: float = OBJECTIVE_CHANGE_TIME,
+) -> List[dict]:
+    """Selects the highest ranked flakes which can be revisited at every magnification before the deadline
+
+    Args:
+        entries (List[dict]): The index entries of the flakes, see FlakeCatalog
+        num_magnifications (int): The number of magnifications every flake is revisited with
+        scan_budget (ScanBudget, optional): The deadline and the flakes of interest. Defaults to None.
+        max_flakes (int, optional): The maximum number of revisited flakes, None revisits all that fit. Defaults to None.
+        seconds_per_revisit (float, optional): The time per flake and magnification. Defaults to SECONDS_PER_REVISIT.
+        objective_change_time (float, optional): The time per magnification change. Defaults to OBJECTIVE_CHANGE_TIME.
+
+    Returns:
+        List[dict]: The selected entries, the highest ranked first
+    """
+    ranked_entries = rank_flakes(entries, scan_budget)
+
+    num_flakes = len(ranked_entries)
+    if max_flakes is not None:
+        num_flakes = min(num_flakes, max_flakes)
+
+    if scan_budget is not None:
+        available_time = (
+            scan_budget.remaining_time() - num_magnifications * objective_change_time
+        )
+        affordable_flakes = available_time / (num_magnifications * seconds_per_revisit)
+        num_flakes = int(np.clip(min(num_flakes, affordable_flakes), 0, num_flakes))
+
+    if num_flakes < len(ranked_entries):
+        print(
+            f"Revisiting the {num_flakes} highest ranked of {len(ranked_entries)} flakes"
+        )
+    return ranked_entries[:num_flakes]
@@ -0,0 +1,165 @@
+"""
+A content addressed cache for detection results, so unchanged images do not need to be detected again
+"""
+import hashlib
+import json
+import os
+import time
+from typing import List, Optional
+
+import numpy as np
+
+
+def hash_bytes(data: bytes) -> str:
+    return hashlib.sha1(data).hexdigest()
+
+
+def hash_array(array: np.ndarray) -> str:
+    return hash_bytes(np.ascontiguousarray(array).tobytes())
+
+
+def hash_parameters(parameters: dict) -> str:
+    """Hashes a json serializable dict independent of the key order"""
+    return hash_bytes(json.dumps(parameters, sort_keys=True, default=str).encode())
+
+
+def create_entry_key(image_hash: str, flatfield_hash: str, parameter_hash: str) -> str:
+    return hash_bytes(f"{image_hash}_{flatfield_hash}_{parameter_hash}".encode())
+
+
+def save_cache_entry(entry_path: str, flake_dicts: List[dict]) -> int:
+    """Saves the detected flakes of an image
+
+    Args:
+        entry_path (str): The path of the entry
+        flake_dicts (List[dict]): The dicts of the flakes with the encoded masks
+
+    Returns:
+        int: The size of the entry in bytes
+    """
+    data = json.dumps(flake_dicts, default=_to_builtin).encode()
+
+    # write to a temporary file first, so other processes never see half written entries
+    temporary_path = f"{entry_path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as f:
+        f.write(data)
+    os.replace(temporary_path, entry_path)
+
+    return len(data)
+
+
+def load_cache_entry(entry_path: str) -> Optional[List[dict]]:
+    """Loads the detected flakes of an image
+
+    Args:
+        entry_path (str): The path of the entry
+
+    Returns:
+        Optional[List[dict]]: The dicts of the flakes with the encoded masks, None if there is no entry
+    """
+    try:
+        with open(entry_path, "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def _to_builtin(o):
+    if isinstance(o, np.generic):
+        return o.item()
+    if isinstance(o, np.ndarray):
+        return o.tolist()
+    raise TypeError
+
+
+class DetectionCache:
+    """Keeps track of the cached detection results in a directory\n
+    The entries are keyed by the hash of the image, the flatfield and the detection parameters.
+    The index remembers the hash of each image file by its size and modification time, so unchanged files are not read again.
+    Least recently used entries are evicted once the cache exceeds its maximum size.
+    """
+
+    def __init__(self, cache_directory: str, max_size_bytes: int = 5 * 1024**3):
+        """
+        Args:
+            cache_directory (str): The directory where the entries are stored
+            max_size_bytes (int, optional): The maximum size of all entries. Defaults to 5 GB.
+        """
+        self.cache_directory = cache_directory
+        self.max_size_bytes = max_size_bytes
+        self.index_path = os.path.join(cache_directory, "index.json")
+
+        if not os.path.exists(cache_directory):
+            os.makedirs(cache_directory)
+
+        self.entries = {}
+        self.file_hashes = {}
+        if os.path.exists(self.index_path):
+            with open(self.index_path, "r") as f:
+                index = json.load(f)
+            self.entries = index["entries"]
+            self.file_hashes = index["file_hashes"]
+
+    def get_entry_path(self, entry_key: str) -> str:
+        return os.path.join(self.cache_directory, f"{entry_key}.json")
+
+    def lookup_file_hash(self, file_path: str) -> Optional[str]:
+        """Returns the known hash of a file if the file did not change since it was hashed"""
+        known_hash = self.file_hashes.get(os.path.abspath(file_path))
+        if known_hash is None:
+            return None
+
+        stat = os.stat(file_path)
+        if [stat.st_size, stat.st_mtime_ns] != known_hash[:2]:
+            return None
+        return known_hash[2]
+
+    def remember_file_hash(self, file_path: str, file_hash: str):
+        stat = os.stat(file_path)
+        self.file_hashes[os.path.abspath(file_path)] = [
+            stat.st_size,
+            stat.st_mtime_ns,
+            file_hash,
+        ]
+
+    def touch(self, entry_key: str, size: int):
+        """Marks an entry as used"""
+        self.entries[entry_key] = {"size": size, "last_access": time.time()}
+
+    def get_size(self) -> int:
+        return sum(entry["size"] for entry in self.entries.values())
+
+    def evict(self) -> List[str]:
+        """Removes the least recently used entries until the cache is smaller than its maximum size
+
+        Returns:
+            List[str]: The keys of the removed entries
+        """
+        total_size = self.get_size()
+        evicted_keys = []
+
+        entries_by_age = sorted(
+            self.entries.items(), key=lambda item: item[1]["last_access"]
+        )
+        for entry_key, entry in entries_by_age:
+            if total_size <= self.max_size_bytes:
+                break
+
+            entry_path = self.get_entry_path(entry_key)
+            if os.path.exists(entry_path):
+                os.remove(entry_path)
+
+            total_size -= entry["size"]
+            del self.entries[entry_key]
+            evicted_keys.append(entry_key)
+
+        return evicted_keys
+
+    def save(self):
+        """Evicts old entries and writes the index to disk"""
+        self.evict()
+
+        temporary_path = f"{self.index_path}.tmp"
+        with open(temporary_path, "w") as f:
+            json.dump({"entries": self.entries, "file_hashes": self.file_hashes}, f)
+        os.replace(temporary_path, self.index_path)
@@ -0,0 +1,173 @@
+"""
+An index of all flakes of a scan, so the flakes can be iterated and filtered without walking the directory tree
+"""
+import json
+import os
+from typing import Generator, List
+
+from .etc_functions import walk_flake_directories
+
+# One line per flake, kept in the scan directory
+INDEX_NAME = "flake_index.jsonl"
+
+# The keys of the flake metadata which are copied into the index
+INDEX_KEYS = [
+    "chip_id",
+    "position_x",
+    "position_y",
+    "size",
+    "thickness",
+    "aspect_ratio",
+    "max_sidelength",
+    "false_positive_probability",
+]
+
+
+def create_index_entry(
+    scan_directory: str,
+    flake_directory: str,
+    flake_meta_data: dict,
+) -> dict:
+    """Creates the index entry of a flake from its metadata
+
+    Args:
+        scan_directory (str): The directory of the scan
+        flake_directory (str): The directory of the flake
+        flake_meta_data (dict): The metadata of the flake as saved in its meta.json
+
+    Returns:
+        dict: The entry with the keys of INDEX_KEYS, the 'flake_id' and the 'directory' relative to the scan directory
+    """
+    relative_directory = os.path.relpath(flake_directory, scan_directory)
+    entry = {key: flake_meta_data["flake"][key] for key in INDEX_KEYS}
+    entry["flake_id"] = int(os.path.basename(flake_directory).split("_")[-1])
+    entry["directory"] = relative_directory.replace(os.sep, "/")
+    return entry
+
+
+class FlakeCatalog:
+    """The flakes of a scan in the order they were found\n
+    New flakes are appended to the index file, so it is always up to date even if the scan is interrupted.
+    A missing index is rebuilt from the flake directories.
+    """
+
+    def __init__(self, scan_directory: str):
+        """
+        Args:
+            scan_directory (str): The directory of the scan
+        """
+        self.scan_directory = scan_directory
+        self.index_path = os.path.join(scan_directory, INDEX_NAME)
+        self.entries: List[dict] = []
+
+        if os.path.exists(self.index_path):
+            self._load()
+        elif os.path.isdir(scan_directory):
+            self.rebuild()
+
+    def _load(self):
+        is_damaged = False
+        with open(self.index_path, "r") as f:
+            for line in f:
+                # the last line is incomplete if the scan crashed while writing it
+                try:
+                    self.entries.append(json.loads(line))
+                except json.JSONDecodeError:
+                    is_damaged = True
+
+        # new entries would be appended to the incomplete line
+        if is_damaged:
+            self._write()
+
+    def _write(self):
+        temporary_path = f"{self.index_path}.tmp"
+        with open(temporary_path, "w") as f:
+            for entry in self.entries:
+                f.write(json.dumps(entry) + "\n")
+        os.replace(temporary_path, self.index_path)
+
+    def rebuild(self) -> int:
+        """Recreates the index from the metadata of all flake directories
+
+        Returns:
+            int: The number of indexed flakes
+        """
+        self.entries = []
+        for flake_directory in walk_flake_directories(self.scan_directory):
+            with open(os.path.join(flake_directory, "meta.json"), "r") as f:
+                flake_meta_data = json.load(f)
+            self.entries.append(
+                create_index_entry(
+                    self.scan_directory, flake_directory, flake_meta_data
+                )
+            )
+        self._write()
+
+        return len(self.entries)
+
+    def add(self, flake_directory: str, flake_meta_data: dict) -> dict:
+        """Adds a flake to the index
+
+        Args:
+            flake_directory (str): The directory of the flake
+            flake_meta_data (dict): The metadata of the flake as saved in its meta.json
+
+        Returns:
+            dict: The index entry of the flake
+        """
+        entry = create_index_entry(
+            self.scan_directory, flake_directory, flake_meta_data
+        )
+        self.entries.append(entry)
+        with open(self.index_path, "a") as f:
+            f.write(json.dumps(entry) + "\n")
+        return entry
+
+    def get_directory(self, entry: dict) -> str:
+        """Returns the absolute path of the flake directory of an entry"""
+        return os.path.join(self.scan_directory, *entry["directory"].split("/"))
+
+    def query(
+        self,
+        min_size: float = None,
+        max_size: float = None,
+        thicknesses: List[str] = None,
+        min_confidence: float = None,
+    ) -> List[dict]:
+        """Returns the entries of all flakes matching the filters, None disables a filter
+
+        Args:
+            min_size (float, optional): The minimum size in square micrometers. Defaults to None.
+            max_size (float, optional): The maximum size in square micrometers. Defaults to None.
+            thicknesses (List[str], optional): The accepted thickness classes. Defaults to None.
+            min_confidence (float, optional): The minimum confidence, i.e. 1 - false positive probability. Defaults to None.
+
+        Returns:
+            List[dict]: The matching entries in the order the flakes were found
+        """
+        if thicknesses is not None:
+            thicknesses = {str(thickness) for thickness in thicknesses}
+
+        return [
+            entry
+            for entry in self.entries
+            if (min_size is None or entry["size"] >= min_size)
+            and (max_size is None or entry["size"] <= max_size)
+            and (thicknesses is None or str(entry["thickness"]) in thicknesses)
+            and (
+                min_confidence is None
+                or 1 - entry["false_positive_probability"] >= min_confidence
+            )
+        ]
+
+    def walk_flake_directories(self, **filters) -> Generator[str, None, None]:
+        """Yields the absolute paths of the flake directories, takes the same filters as `query`"""
+        entries = self.query(**filters) if filters else self.entries
+        for entry in entries:
+            yield self.get_directory(entry)
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def __iter__(self):
+        return iter(self.entries)
@@ -0,0 +1,281 @@
+"""
+An optional coarse pass at 5x before the 20x search\n
+The 5x objective covers the area of 16 tiles of the 20x objective in a single image.
+A lenient detector marks candidate regions at 5x, only the 20x tiles around those candidates are searched afterwards.
+"""
+from typing import Type
+
+import numpy as np
+
+from Drivers import (
+    CameraDriverInterface,
+    MicroscopeDriverInterface,
+    MotorDriverInterface,
+)
+from GMMDetector import MaterialDetector
+
+from .etc_functions import OBJECTIVE_CHANGE_TIME
+from .focus_functions import FocusMap
+from .raster_functions import image_generator
+from .transform_functions import create_pixel_to_stage_transform
+import Utils.conversion_functions as conversion
+
+COARSE_MAGNIFICATION_INDEX = 2  # 5x
+
+
+def get_coarse_factor(
+    magnification_index: int,
+    coarse_magnification_index: int = COARSE_MAGNIFICATION_INDEX,
+) -> int:
+    """The number of fine tiles along each axis covered by one coarse tile
+
+    Args:
+        magnification_index (int): The magnification index of the search
+        coarse_magnification_index (int, optional): The magnification index of the coarse pass. Defaults to COARSE_MAGNIFICATION_INDEX.
+
+    Returns:
+        int: The factor, 4 for 5x and 20x
+    """
+    return max(
+        int(
+            round(
+                conversion.MICROMETER_PER_PIXEL[coarse_magnification_index]
+                / conversion.MICROMETER_PER_PIXEL[magnification_index]
+            )
+        ),
+        1,
+    )
+
+
+def create_coarse_scan_area_map(
+    scan_area_map: np.ndarray,
+    coarse_factor: int,
+) -> np.ndarray:
+    """Creates the scan area map of the coarse pass from the scan area map of the search\n
+    The coarse tile (i, j) is centered on the fine tile (factor * i, factor * j), it is scanned if it overlaps any fine tile of the map.
+    So the coarse pass covers exactly the area of the search, without a separate calibration of the coarse objective in the overview.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map of the search
+        coarse_factor (int): The factor from get_coarse_factor
+
+    Returns:
+        (Array): The coarse scan area map, about N/factor x M/factor with the chip labels of the fine map
+    """
+    # the fine tiles a coarse tile overlaps, half tiles at the border included
+    reach = coarse_factor // 2
+    height, width = scan_area_map.shape
+    coarse_height = (height - 1 + reach) // coarse_factor + 1
+    coarse_width = (width - 1 + reach) // coarse_factor + 1
+    padded = np.pad(
+        scan_area_map,
+        (
+            (reach, coarse_height * coarse_factor - height + reach),
+            (reach, coarse_width * coarse_factor - width + reach),
+        ),
+    )
+
+    coarse_map = np.zeros((coarse_height, coarse_width), dtype=scan_area_map.dtype)
+    for dy in range(2 * reach + 1):
+        for dx in range(2 * reach + 1):
+            shifted = padded[
+                dy : dy + coarse_height * coarse_factor : coarse_factor,
+                dx : dx + coarse_width * coarse_factor : coarse_factor,
+            ]
+            np.maximum(coarse_map, shifted, out=coarse_map)
+    return coarse_map
+
+
+def find_coarse_candidates(
+    scan_area_map: np.ndarray,
+    motor_driver: Type[MotorDriverInterface],
+    microscope_driver: Type[MicroscopeDriverInterface],
+    camera_driver: Type[CameraDriverInterface],
+    camera_settings: dict,
+    microscope_settings: dict,
+    model: MaterialDetector,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    magnification_index: int = 3,
+    coarse_magnification_index: int = COARSE_MAGNIFICATION_INDEX,
+    wait_time: float = 0.2,
+    focus_map: FocusMap = None,
+    **kwargs,
+) -> np.ndarray:
+    """Scans the area of the scan area map with the coarse objective and returns the candidates of the lenient detector
+
+    Args:
+        scan_area_map (NxM Array): The scan area map of the search
+        motor_driver (Type[MotorDriverInterface]): The Motordriver
+        microscope_driver (Type[MicroscopeDriverInterface]): The Microscope Driver
+        camera_driver (Type[CameraDriverInterface]): The Camera Driver
+        camera_settings (dict): The settings for the camera, needs the coarse magnification index
+        microscope_settings (dict): The settings for the microscope, needs the coarse magnification index
+        model (MaterialDetector): The lenient detector, its size threshold in pixels of the coarse objective
+        view_field_x (float, optional): the x View Field of the search magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the search magnification in mm. Defaults to 0.4613.
+        magnification_index (int, optional): The magnification index of the search. Defaults to 3.
+        coarse_magnification_index (int, optional): The magnification index of the coarse pass. Defaults to COARSE_MAGNIFICATION_INDEX.
+        wait_time (float, optional): The time to wait after moving before taking a picture in seconds. Defaults to 0.2.
+        focus_map (FocusMap, optional): Predicts the focus height of every tile, the hardware AF has to be off. Defaults to None.
+
+    Returns:
+        (Nx3 Array): The x and y stage position of each candidate and its radius in mm
+    """
+    coarse_factor = get_coarse_factor(magnification_index, coarse_magnification_index)
+    coarse_scan_area_map = create_coarse_scan_area_map(scan_area_map, coarse_factor)
+    millimeter_per_pixel = (
+        conversion.MICROMETER_PER_PIXEL[coarse_magnification_index] / 1000
+    )
+
+    print(
+        f"Coarse pass over {np.count_nonzero(coarse_scan_area_map)} tiles instead of {np.count_nonzero(scan_area_map)}..."
+    )
+
+    image_gen = image_generator(
+        scan_area_map=coarse_scan_area_map,
+        motor_driver=motor_driver,
+        microscope_driver=microscope_driver,
+        camera_driver=camera_driver,
+        view_field_x=view_field_x * coarse_factor,
+        view_field_y=view_field_y * coarse_factor,
+        magnification_index=coarse_magnification_index,
+        camera_settings=camera_settings,
+        microscope_settings=microscope_settings,
+        wait_time=wait_time,
+        focus_map=focus_map,
+    )
+
+    candidates = [np.zeros((0, 3))]
+    for image, image_props in image_gen:
+        if image is None:
+            continue
+
+        detected_flakes = model(image)
+        if len(detected_flakes) == 0:
+            continue
+
+        pixel_to_stage = create_pixel_to_stage_transform(
+            coarse_magnification_index, image_props["motor_pos"], image.shape
+        )
+        centers = pixel_to_stage(np.array([flake.center for flake in detected_flakes]))
+        radii = (
+            np.array([flake.max_sidelength for flake in detected_flakes])
+            * millimeter_per_pixel
+            / 2
+        )
+        candidates.append(np.column_stack([centers, radii]))
+
+    candidates = np.concatenate(candidates)
+    print(f"\nCoarse pass found {len(candidates)} candidates")
+    return candidates
+
+
+def candidates_to_scan_area_map(
+    candidates: np.ndarray,
+    scan_area_map: np.ndarray,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    margin: float = 0.05,
+    **kwargs,
+) -> np.ndarray:
+    """Keeps only the tiles of the scan area map which overlap a candidate\n
+    The tile ranges of all candidates are marked at once with a 2D difference array.
+
+    Args:
+        candidates (Nx3 Array): The x and y stage position and the radius of each candidate in mm
+        scan_area_map (NxM Array): The scan area map of the search
+        view_field_x (float, optional): the x View Field of the search magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the search magnification in mm. Defaults to 0.4613.
+        margin (float, optional): Added to the radius of each candidate in mm, covers the offset between the objectives. Defaults to 0.05.
+
+    Returns:
+        (NxM Array): The scan area map of the tiles around the candidates, with the chip labels
+    """
+    height, width = scan_area_map.shape
+    candidates = np.asarray(candidates, dtype=np.float64).reshape(-1, 3)
+    radii = candidates[:, 2] + margin
+
+    # the tile k covers [(k - 0.5) * view_field, (k + 0.5) * view_field]
+    x_start = np.floor((candidates[:, 0] - radii) / view_field_x + 0.5).astype(int)
+    x_end = np.ceil((candidates[:, 0] + radii) / view_field_x - 0.5).astype(int)
+    y_start = np.floor((candidates[:, 1] - radii) / view_field_y + 0.5).astype(int)
+    y_end = np.ceil((candidates[:, 1] + radii) / view_field_y - 0.5).astype(int)
+
+    x_start, x_end = np.clip(x_start, 0, width), np.clip(x_end, -1, width - 1)
+    y_start, y_end = np.clip(y_start, 0, height), np.clip(y_end, -1, height - 1)
+    inside = (x_start <= x_end) & (y_start <= y_end)
+    x_start, x_end = x_start[inside], x_end[inside]
+    y_start, y_end = y_start[inside], y_end[inside]
+
+    difference = np.zeros((height + 1, width + 1), dtype=np.int32)
+    np.add.at(difference, (y_start, x_start), 1)
+    np.add.at(difference, (y_start, x_end + 1), -1)
+    np.add.at(difference, (y_end + 1, x_start), -1)
+    np.add.at(difference, (y_end + 1, x_end + 1), 1)
+    covered = difference.cumsum(axis=0).cumsum(axis=1)[:height, :width] > 0
+
+    return np.where(covered, scan_area_map, 0).astype(scan_area_map.dtype)
+
+
+def estimate_two_stage_time(
+    scan_area_map: np.ndarray,
+    magnification_index: int,
+    candidate_fraction: float,
+    seconds_per_tile: float = 0.5,
+    seconds_per_coarse_tile: float = 0.5,
+    coarse_magnification_index: int = COARSE_MAGNIFICATION_INDEX,
+    objective_change_time: float = OBJECTIVE_CHANGE_TIME,
+):
+    """Estimates the duration of the search with and without the coarse pass\n
+    The two stage search takes every coarse tile, two objective changes and the fine tiles around the candidates.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map of the search
+        magnification_index (int): The magnification index of the search
+        candidate_fraction (float): The expected fraction of the fine tiles around candidates, e.g. from a previous scan of the same material
+        seconds_per_tile (float, optional): The time to move, capture and detect a fine tile. Defaults to 0.5.
+        seconds_per_coarse_tile (float, optional): The time to move, capture and detect a coarse tile. Defaults to 0.5.
+        coarse_magnification_index (int, optional): The magnification index of the coarse pass. Defaults to COARSE_MAGNIFICATION_INDEX.
+        objective_change_time (float, optional): The time to change the objective in seconds. Defaults to OBJECTIVE_CHANGE_TIME.
+
+    Returns:
+        (float, float, float): The direct and the two stage duration in seconds and the candidate fraction at which both take equally long
+    """
+    coarse_factor = get_coarse_factor(magnification_index, coarse_magnification_index)
+    num_tiles = np.count_nonzero(scan_area_map)
+    num_coarse_tiles = np.count_nonzero(
+        create_coarse_scan_area_map(scan_area_map, coarse_factor)
+    )
+
+    direct_time = num_tiles * seconds_per_tile
+    overhead = num_coarse_tiles * seconds_per_coarse_tile + 2 * objective_change_time
+    two_stage_time = overhead + candidate_fraction * direct_time
+    break_even_fraction = 1 - overhead / max(direct_time, 1e-9)
+    return direct_time, two_stage_time, break_even_fraction
+
+
+def two_stage_pays_off(
+    scan_area_map: np.ndarray,
+    magnification_index: int,
+    candidate_fraction: float,
+    **kwargs,
+) -> bool:
+    """Prints the cost model of estimate_two_stage_time and decides if the coarse pass is worth it
+
+    Args:
+        scan_area_map (NxM Array): The scan area map of the search
+        magnification_index (int): The magnification index of the search
+        candidate_fraction (float): The expected fraction of the fine tiles around candidates
+        **kwargs: Passed to estimate_two_stage_time
+
+    Returns:
+        bool: True if the two stage search is expected to be faster
+    """
+    direct_time, two_stage_time, break_even_fraction = estimate_two_stage_time(
+        scan_area_map, magnification_index, candidate_fraction, **kwargs
+    )
+    print(
+        f"Direct search: ~{direct_time / 60:.1f} min | Two stage search: ~{two_stage_time / 60:.1f} min | Pays off below {max(break_even_fraction, 0):.0%} of the tiles around candidates"
+    )
+    return two_stage_time < direct_time
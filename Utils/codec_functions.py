@@ -0,0 +1,177 @@
+"""
+One place which decides how images are encoded, each kind of written image has its own policy
+"""
+import os
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+
+import cv2
+import numpy as np
+
+# The encoder settings for each kind of written image, the format itself is given by the file extension
+# png_compression: 0 (fastest) to 9 (smallest), all levels are lossless
+# jpeg_quality: 0 to 100
+# webp_quality: 1 to 100, above 100 the encoding is lossless
+ARTIFACT_POLICIES = {
+    # written for every tile during the scan, speed matters more than size
+    "raw_tile": {"png_compression": 1, "jpeg_quality": 95, "webp_quality": 101},
+    "eval_image": {"png_compression": 1, "jpeg_quality": 95, "webp_quality": 90},
+    "overview": {"png_compression": 3, "jpeg_quality": 95, "webp_quality": 101},
+    "overview_compressed": {
+        "png_compression": 3,
+        "jpeg_quality": 80,
+        "webp_quality": 80,
+    },
+    "compressed_tile": {"png_compression": 1, "jpeg_quality": 80, "webp_quality": 80},
+    # binary images compress very well, even at the highest level
+    "mask": {"png_compression": 9, "jpeg_quality": 100, "webp_quality": 101},
+    "flatfield": {"png_compression": 3, "jpeg_quality": 100, "webp_quality": 101},
+}
+
+
+def get_encode_params(
+    extension: str,
+    artifact: str = "raw_tile",
+    **overrides,
+) -> List[int]:
+    """Returns the OpenCV encoder parameters of an artifact for the given file format
+
+    Args:
+        extension (str): The file extension, e.g. ".png" or ".jpg"
+        artifact (str, optional): The kind of image, a key of ARTIFACT_POLICIES. Defaults to "raw_tile".
+        **overrides: Settings which replace the ones of the policy, e.g. jpeg_quality=70
+
+    Returns:
+        List[int]: The parameters for cv2.imwrite and cv2.imencode
+    """
+    policy = {**ARTIFACT_POLICIES[artifact], **overrides}
+    extension = extension.lower()
+
+    if extension == ".png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, policy["png_compression"]]
+        if "png_strategy" in policy:
+            params += [cv2.IMWRITE_PNG_STRATEGY, policy["png_strategy"]]
+        return params
+    if extension in (".jpg", ".jpeg"):
+        return [cv2.IMWRITE_JPEG_QUALITY, policy["jpeg_quality"]]
+    if extension == ".webp":
+        return [cv2.IMWRITE_WEBP_QUALITY, policy["webp_quality"]]
+    return []
+
+
+def write_image(
+    path: str,
+    image: np.ndarray,
+    artifact: str = "raw_tile",
+    **overrides,
+) -> None:
+    """Writes an image with the encoder settings of its artifact
+
+    Args:
+        path (str): The path of the image, the extension decides the format
+        image (NxMx3 Array): The image
+        artifact (str, optional): The kind of image, a key of ARTIFACT_POLICIES. Defaults to "raw_tile".
+        **overrides: Settings which replace the ones of the policy, e.g. jpeg_quality=70
+
+    Raises:
+        IOError: If the image could not be written
+    """
+    extension = os.path.splitext(path)[1]
+    params = get_encode_params(extension, artifact, **overrides)
+    if not cv2.imwrite(path, image, params):
+        raise IOError(f"Could not write the image to {path}")
+
+
+def encode_image(
+    image: np.ndarray,
+    extension: str,
+    artifact: str = "raw_tile",
+    **overrides,
+) -> bytes:
+    """Encodes an image in memory with the encoder settings of its artifact
+
+    Args:
+        image (NxMx3 Array): The image
+        extension (str): The file extension, e.g. ".png" or ".jpg"
+        artifact (str, optional): The kind of image, a key of ARTIFACT_POLICIES. Defaults to "raw_tile".
+        **overrides: Settings which replace the ones of the policy, e.g. jpeg_quality=70
+
+    Returns:
+        bytes: The encoded image
+    """
+    params = get_encode_params(extension, artifact, **overrides)
+    success, buffer = cv2.imencode(extension, image, params)
+    if not success:
+        raise IOError(f"Could not encode the image as {extension}")
+    return buffer.tobytes()
+
+
+class ImageWriter:
+    """Encodes and writes images in background threads\n
+    OpenCV releases the GIL while encoding, so the scan continues while the images are written.
+    Leaving the context waits for all writes and raises the first error which occured.
+    """
+
+    def __init__(self, max_workers: int = 2, max_pending: int = 8):
+        """
+        Args:
+            max_workers (int, optional): The number of encoder threads. Defaults to 2.
+            max_pending (int, optional): The number of queued images before `write` blocks, this bounds the memory. Defaults to 8.
+        """
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+        self.max_pending = max_pending
+        self._pending = []
+
+    def write(
+        self,
+        path: str,
+        image: np.ndarray,
+        artifact: str = "raw_tile",
+        copy: bool = True,
+        **overrides,
+    ) -> Future:
+        """Queues an image to be written
+
+        Args:
+            path (str): The path of the image, the extension decides the format
+            image (NxMx3 Array): The image
+            artifact (str, optional): The kind of image, a key of ARTIFACT_POLICIES. Defaults to "raw_tile".
+            copy (bool, optional): Copy the image first, needed if the caller reuses the buffer. Defaults to True.
+            **overrides: Settings which replace the ones of the policy
+
+        Returns:
+            Future: Resolves once the image is written
+        """
+        if copy:
+            image = image.copy()
+
+        # wait for the oldest writes if the encoders fall behind
+        while len(self._pending) >= self.max_pending:
+            self._pending.pop(0).result()
+
+        # drop the finished writes, errors are raised here instead of at the end of the scan
+        for finished in [future for future in self._pending if future.done()]:
+            self._pending.remove(finished)
+            finished.result()
+
+        future = self._executor.submit(write_image, path, image, artifact, **overrides)
+        self._pending.append(future)
+        return future
+
+    def wait(self):
+        """Waits for all queued writes and raises the first error"""
+        pending, self._pending = self._pending, []
+        for future in pending:
+            future.result()
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self._executor.shutdown(wait=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
@@ -6,6 +6,15 @@ MICROMETER_PER_PIXEL = {
     5: 0.0769,
 }
 
+# The focus height in µm the nosepiece moves to for each objective
+FOCUS_HEIGHTS = {
+    1: 5500,
+    2: 4300,
+    3: 3930,
+    4: 3900,
+    5: 3900,
+}
+
 MAGNIFICATION_TO_MAGNIFICATION_INDEX = {
     2.5: 1,
     5: 2,
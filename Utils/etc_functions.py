@@ -13,8 +13,14 @@ from Drivers import (
 )
 
 import Utils.conversion_functions as conversion
+from Utils.focus_functions import AUTOFOCUS_STEPS, autofocus
+from Utils.transform_functions import create_pixel_to_stage_transform
+from Utils.viewer_functions import LiveViewer
 from GMMDetector.structures import Flake
 
+# The time set_microscope_and_camera_settings takes to change the objective in seconds
+OBJECTIVE_CHANGE_TIME = 10
+
 
 def load_all_detection_parameters(
     material: str,
@@ -178,6 +184,7 @@ def calibrate_scope(
     view_field_y: float = None,
     scan_area_map: np.ndarray = None,
     use_auto_AF: bool = False,
+    use_software_AF: bool = False,
     **kwargs,
 ):
     """Starts the scope calibration process
@@ -187,6 +194,7 @@ def calibrate_scope(
         microscope (Type[MicroscopeDriverInterface]):
         camera (Type[CameraDriverInterface]):
         needed_magnification_idx (int): The Magnificaiton which is needed to be calibrated
+        use_software_AF (bool, optional): Focus on the image sharpness instead of waiting for the hardware AF, the hardware AF has to be switched off. Defaults to False.
 
     Returns:
         (IMAGE , 3-Tuple ): The new Flatfield Image and the background Values, can also return None, None if none is selected
@@ -249,30 +257,18 @@ def calibrate_scope(
     ----------------------------"""
         )
 
-        cv2.namedWindow("Calibration Window")
+        # the camera is read in the background, so the keys are handled without delay
+        viewer = LiveViewer(
+            camera_driver, window_name="Calibration Window", guide_style="circle"
+        )
+        viewer.start()
         current_magnification = conversion.magnification_index_to_magnification(
             microscope_driver.get_properties()["nosepiece"]
         )
-        cv2.setWindowTitle(
-            "Calibration Window", f"Calibration Window: {current_magnification}"
-        )
+        viewer.set_title(f"Calibration Window: {current_magnification}")
 
         while True:
-            img = camera_driver.get_image()
-            # resize the image so it fits onto the screen
-            img_small = cv2.resize(img, (960, 600))
-
-            # Add a small calibration circle for the middle
-            cv2.circle(
-                img_small,
-                (480, 300),
-                10,
-                color=[255, 0, 0],
-                thickness=3,
-            )
-            cv2.imshow("Calibration Window", img_small)
-
-            key = cv2.waitKey(1)
+            key = viewer.show()
 
             # Press Q to end the calibration
             if key == ord("q"):
@@ -294,7 +290,11 @@ def calibrate_scope(
 
             # Press F to set the new flatfield
             elif key == ord("f"):
-                new_flatfield = img.copy()
+                latest_frame = viewer.get_latest_frame()
+                if latest_frame is None:
+                    print("No frame received yet, the flatfield was not set")
+                else:
+                    new_flatfield = latest_frame
 
             # Press E to reotate the Nosepiece and readjust the microscope and Camera params
             elif key == ord("e"):
@@ -305,20 +305,17 @@ def calibrate_scope(
                 current_magnification = conversion.magnification_index_to_magnification(
                     current_nosepiece_index
                 )
-                cv2.setWindowTitle(
-                    "Calibration Window", f"Calibration Window: {current_magnification}"
-                )
+                viewer.set_title(f"Calibration Window: {current_magnification}")
                 # Set the Camera and microscope Settings
                 if camera_settings is not None and microscope_settings is not None:
-                    set_microscope_and_camera_settings(
-                        microscope_settings_dict=microscope_settings,
-                        camera_settings_dict=camera_settings,
-                        magnification_index=microscope_driver.get_properties()[
-                            "nosepiece"
-                        ],
-                        camera_driver=camera_driver,
-                        microscope_driver=microscope_driver,
-                    )
+                    with viewer.camera_lock:
+                        set_microscope_and_camera_settings(
+                            microscope_settings_dict=microscope_settings,
+                            camera_settings_dict=camera_settings,
+                            magnification_index=current_nosepiece_index,
+                            camera_driver=camera_driver,
+                            microscope_driver=microscope_driver,
+                        )
 
             # Press R to rotate the Nosepiece and readjust the microscope and Camera params
             elif key == ord("r"):
@@ -329,21 +326,19 @@ def calibrate_scope(
                 current_magnification = conversion.magnification_index_to_magnification(
                     current_nosepiece_index
                 )
-                cv2.setWindowTitle(
-                    "Calibration Window", f"Calibration Window: {current_magnification}"
-                )
+                viewer.set_title(f"Calibration Window: {current_magnification}")
                 # Set the Camera and microscope Settings
                 if camera_settings is not None and microscope_settings is not None:
-                    set_microscope_and_camera_settings(
-                        microscope_settings_dict=microscope_settings,
-                        camera_settings_dict=camera_settings,
-                        magnification_index=microscope_driver.get_properties()[
-                            "nosepiece"
-                        ],
-                        camera_driver=camera_driver,
-                        microscope_driver=microscope_driver,
-                    )
+                    with viewer.camera_lock:
+                        set_microscope_and_camera_settings(
+                            microscope_settings_dict=microscope_settings,
+                            camera_settings_dict=camera_settings,
+                            magnification_index=current_nosepiece_index,
+                            camera_driver=camera_driver,
+                            microscope_driver=microscope_driver,
+                        )
 
+        viewer.stop()
         cv2.destroyAllWindows()
         return new_flatfield
 
@@ -356,6 +351,18 @@ def calibrate_scope(
             camera_driver=camera_driver,
             microscope_driver=microscope_driver,
         )
+        if use_software_AF:
+            # focus on the sharpness of the image instead of waiting for the hardware AF to settle
+            coarse_step, tolerance = AUTOFOCUS_STEPS[magnification_index]
+            autofocus(
+                microscope_driver,
+                camera_driver,
+                step=coarse_step,
+                tolerance=tolerance,
+                verbose=True,
+            )
+            return None
+
         time.sleep(10)
 
         # rotate back once, when using 20x This means to 5x, and wait until it is sharp
@@ -476,19 +483,12 @@ def reformat_flake_dict(
     """
 
     MICROMETER_PER_PIXEL = conversion.MICROMETER_PER_PIXEL[magnification_index]
-    IMAGE_Y_DIMENSION, IMAGE_X_DIMENSION = flake.mask.shape
 
     # Correcting the XY positions so the Flake is in the Middle based on the image
-    flake_position_x = round(
-        image_dict["motor_pos"][0]
-        + (flake.center[0] - IMAGE_X_DIMENSION / 2) * MICROMETER_PER_PIXEL / 1000,
-        5,
-    )
-    flake_position_y = round(
-        image_dict["motor_pos"][1]
-        + (flake.center[1] - IMAGE_Y_DIMENSION / 2) * MICROMETER_PER_PIXEL / 1000,
-        5,
+    pixel_to_stage = create_pixel_to_stage_transform(
+        magnification_index, image_dict["motor_pos"], flake.mask.shape
     )
+    flake_position_x, flake_position_y = np.round(pixel_to_stage(flake.center), 5)
 
     # Extract the Flake Path TODO: Make this more robust, doesnt support changing the path later
     # may need a database overhaul
@@ -497,8 +497,8 @@ def reformat_flake_dict(
 
     new_flake_dict = {
         "chip_id": image_dict["chip_id"],
-        "position_x": flake_position_x,
-        "position_y": flake_position_y,
+        "position_x": float(flake_position_x),
+        "position_y": float(flake_position_y),
         "size": conversion.pixels_to_micrometers_IDX(flake.size, magnification_index),
         "thickness": flake.thickness,
         "entropy": flake.entropy,
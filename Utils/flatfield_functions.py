@@ -0,0 +1,160 @@
+"""
+A collection of helper functions to estimate the flatfield from the images taken during a scan
+"""
+import cv2
+import numpy as np
+from numba import jit, prange
+
+
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
+def _update_background_estimate(
+    estimate,
+    update_counts,
+    image,
+    exclusion_mask,
+    warmup_updates,
+    median_step,
+    rejection_threshold,
+):
+    for i in prange(image.shape[0]):
+        for j in range(image.shape[1]):
+            if exclusion_mask[i, j] != 0:
+                continue
+
+            count = update_counts[i, j]
+
+            # reject pixels far away from the current background, i.e. flakes and dust
+            if count >= warmup_updates:
+                is_outlier = False
+                for k in range(image.shape[2]):
+                    difference = abs(image[i, j, k] - estimate[i, j, k])
+                    if difference > rejection_threshold * estimate[i, j, k]:
+                        is_outlier = True
+                if is_outlier:
+                    continue
+
+            for k in range(image.shape[2]):
+                value = np.float32(image[i, j, k])
+                if count < warmup_updates:
+                    # running mean to converge quickly
+                    estimate[i, j, k] += (value - estimate[i, j, k]) / (count + 1)
+                elif value > estimate[i, j, k]:
+                    # running median which follows the drift of the lamp
+                    estimate[i, j, k] += median_step
+                elif value < estimate[i, j, k]:
+                    estimate[i, j, k] -= median_step
+
+            if count < 65535:
+                update_counts[i, j] = count + 1
+
+
+class FlatfieldEstimator:
+    """Estimates the flatfield from the images streamed during a scan\n
+    Keeps a per pixel running median of the background at constant memory.
+    Pixels covered by flakes are excluded by the supplied masks, everything deviating too much from the current estimate is rejected as well.
+    """
+
+    def __init__(
+        self,
+        image_shape: tuple = (1200, 1920, 3),
+        downsample_factor: int = 1,
+        min_updates: int = 20,
+        warmup_updates: int = 5,
+        median_step: float = 0.25,
+        rejection_threshold: float = 0.08,
+    ):
+        """
+        Args:
+            image_shape (tuple, optional): The shape of the images. Defaults to (1200, 1920, 3).
+            downsample_factor (int, optional): Estimate the flatfield on a downsampled grid to save memory and time. Defaults to 1.
+            min_updates (int, optional): The number of updates until the estimate is considered usable. Defaults to 20.
+            warmup_updates (int, optional): The number of updates per pixel which are averaged before switching to the median. Defaults to 5.
+            median_step (float, optional): The step of the running median in intensity values per update. Defaults to 0.25.
+            rejection_threshold (float, optional): The relative deviation from the estimate above which a pixel is rejected. Defaults to 0.08.
+        """
+        self.image_shape = tuple(image_shape)
+        self.downsample_factor = downsample_factor
+        self.min_updates = min_updates
+        self.warmup_updates = warmup_updates
+        self.median_step = median_step
+        self.rejection_threshold = rejection_threshold
+
+        estimate_shape = (
+            self.image_shape[0] // downsample_factor,
+            self.image_shape[1] // downsample_factor,
+            self.image_shape[2],
+        )
+        self.estimate = np.zeros(estimate_shape, dtype=np.float32)
+        self.update_counts = np.zeros(estimate_shape[:2], dtype=np.uint16)
+        self.num_updates = 0
+
+    @property
+    def is_ready(self) -> bool:
+        return self.num_updates >= self.min_updates
+
+    def _downsample(self, image):
+        if self.downsample_factor == 1:
+            return image
+        return cv2.resize(
+            image,
+            (self.estimate.shape[1], self.estimate.shape[0]),
+            interpolation=cv2.INTER_AREA,
+        )
+
+    def _downsample_mask(self, mask):
+        mask = (mask != 0).astype(np.uint8)
+        if self.downsample_factor == 1:
+            return mask
+        # any pixel touched by the mask is excluded
+        factor = self.downsample_factor
+        mask = cv2.dilate(mask, np.ones((factor, factor), dtype=np.uint8))
+        return np.ascontiguousarray(
+            mask[::factor, ::factor][: self.estimate.shape[0], : self.estimate.shape[1]]
+        )
+
+    def update(self, image, exclusion_mask=None):
+        """Adds an image to the background estimate
+
+        Args:
+            image (NxMx3 Array): An uncorrected image, i.e. as returned by `get_image`
+            exclusion_mask (NxMx1 Array, optional): A mask of pixels which are not background, e.g. all detected flakes. Defaults to None.
+        """
+        image = self._downsample(image)
+
+        if exclusion_mask is None:
+            exclusion_mask = np.zeros(image.shape[:2], dtype=np.uint8)
+        else:
+            exclusion_mask = self._downsample_mask(exclusion_mask)
+
+        _update_background_estimate(
+            self.estimate,
+            self.update_counts,
+            image,
+            exclusion_mask,
+            self.warmup_updates,
+            np.float32(self.median_step),
+            np.float32(self.rejection_threshold),
+        )
+        self.num_updates += 1
+
+    def get_flatfield(self):
+        """Returns the current estimate of the flatfield
+
+        Returns:
+            (NxMx3 Array): The flatfield, same shape as the images
+        """
+        estimate = self.estimate.copy()
+
+        # pixels which were never seen as background get the median background
+        unseen_pixels = self.update_counts == 0
+        if unseen_pixels.any() and not unseen_pixels.all():
+            estimate[unseen_pixels] = np.median(estimate[~unseen_pixels], axis=0)
+
+        flatfield = np.clip(np.rint(estimate), 0, 255).astype(np.uint8)
+        if self.downsample_factor != 1:
+            flatfield = cv2.resize(
+                flatfield,
+                (self.image_shape[1], self.image_shape[0]),
+                interpolation=cv2.INTER_LINEAR,
+            )
+        return flatfield
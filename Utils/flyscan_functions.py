@@ -0,0 +1,444 @@
+"""
+Fly scanning, the stage sweeps each row of the scan area map at constant velocity while the camera streams frames\n
+Every frame is tagged with the stage position interpolated at its timestamp, per tile the frame closest to the tile center is kept.
+The velocity is limited by the motion blur during the short exposure and by the frame rate.
+The motion blur of each frame follows from the stage positions polled around it, frames which are too blurred are rejected.
+Tiles without a usable frame are left in a map of missed tiles, which search_scan_area_map takes stop and go afterwards.
+"""
+import queue
+import threading
+import time
+from typing import Generator, Optional, Tuple, Type
+
+import numpy as np
+from Drivers import (
+    CameraDriverInterface,
+    MicroscopeDriverInterface,
+    MotorDriverInterface,
+)
+
+from .etc_functions import set_microscope_and_camera_settings
+from .focus_functions import FocusMap
+from .transform_functions import create_grid_to_stage_transform
+import Utils.conversion_functions as conversion
+
+GAIN_PER_DECADE = 200  # The gain amplifying the image tenfold, the gain is given in 0.1 dB
+VELOCITY_MARGIN = 0.8  # The fraction of the blur limit the stage is driven at, the velocity of the stage ripples
+
+
+def get_fly_scan_velocity(
+    exposure: float,
+    frame_period: float,
+    view_field_x: float = 0.7380,
+    magnification_index: int = 3,
+    max_blur: float = 2,
+    tolerance: float = 0.05,
+) -> float:
+    """The fastest velocity which keeps the motion blur and the offset of the frames to the tile centers\n
+    The blur limit keeps the VELOCITY_MARGIN, so the ripple of the velocity does not get frames rejected.
+
+    Args:
+        exposure (float): The exposure of the fly scan in seconds
+        frame_period (float): The time between two frames in seconds, see measure_frame_period
+        view_field_x (float, optional): the x View Field of the magnification in mm. Defaults to 0.7380.
+        magnification_index (int, optional): The magnification index of the scan. Defaults to 3.
+        max_blur (float, optional): The maximum motion blur in pixels. Defaults to 2.
+        tolerance (float, optional): The maximum offset of a frame to its tile center relative to the view field. Defaults to 0.05.
+
+    Returns:
+        float: The velocity in mm/s
+    """
+    millimeter_per_pixel = conversion.MICROMETER_PER_PIXEL[magnification_index] / 1000
+    blur_velocity = VELOCITY_MARGIN * max_blur * millimeter_per_pixel / exposure
+
+    # one frame at least every 2 * tolerance of the view field, so each tile center has a frame within the tolerance
+    frame_velocity = 2 * tolerance * view_field_x / frame_period
+    return min(blur_velocity, frame_velocity)
+
+
+def measure_frame_period(
+    camera_driver: Type[CameraDriverInterface],
+    num_frames: int = 5,
+) -> float:
+    """Measures the time between two frames of the camera stream
+
+    Args:
+        camera_driver (Type[CameraDriverInterface]): The Camera Driver
+        num_frames (int, optional): The number of timed frames. Defaults to 5.
+
+    Returns:
+        float: The median time per frame in seconds
+    """
+    # the first frame may still be exposed with the old settings
+    camera_driver.get_raw_image()
+
+    frame_periods = []
+    for _ in range(num_frames):
+        start_time = time.time()
+        camera_driver.get_raw_image()
+        frame_periods.append(time.time() - start_time)
+    return float(np.median(frame_periods))
+
+
+def get_motion_blur(
+    sample_times,
+    sample_positions,
+    exposure: float,
+    magnification_index: int = 3,
+) -> float:
+    """The motion blur of a frame in pixels, from the stage positions polled before and after it
+
+    Args:
+        sample_times (2 Array): The unix times before and after the frame
+        sample_positions (2x2 Array): The x and y positions at these times in mm
+        exposure (float): The exposure in seconds
+        magnification_index (int, optional): The magnification index of the frame. Defaults to 3.
+
+    Returns:
+        float: The distance the stage moved during the exposure in pixels
+    """
+    (start_time, end_time), (start_position, end_position) = (
+        sample_times,
+        np.asarray(sample_positions, dtype=np.float64),
+    )
+    velocity = np.hypot(*(end_position - start_position)) / max(
+        end_time - start_time, 1e-9
+    )
+    millimeter_per_pixel = conversion.MICROMETER_PER_PIXEL[magnification_index] / 1000
+    return float(velocity * exposure / millimeter_per_pixel)
+
+
+def interpolate_stage_positions(
+    sample_times,
+    sample_positions,
+    frame_times,
+) -> np.ndarray:
+    """Interpolates the stage position at the frame timestamps from the polled stage positions
+
+    Args:
+        sample_times (N Array): The unix times the stage position was polled at, increasing
+        sample_positions (Nx2 Array): The polled x and y positions in mm
+        frame_times (M Array): The unix times of the frames
+
+    Returns:
+        (Mx2 Array): The x and y positions of the frames in mm
+    """
+    sample_times = np.asarray(sample_times, dtype=np.float64)
+    sample_positions = np.asarray(sample_positions, dtype=np.float64).reshape(-1, 2)
+    frame_times = np.atleast_1d(np.asarray(frame_times, dtype=np.float64))
+    return np.stack(
+        [
+            np.interp(frame_times, sample_times, sample_positions[:, 0]),
+            np.interp(frame_times, sample_times, sample_positions[:, 1]),
+        ],
+        axis=1,
+    )
+
+
+def _wait_for_stage(
+    motor_driver: Type[MotorDriverInterface],
+    target_x: float,
+    target_y: float,
+    timeout: float,
+    precision: float = 0.001,
+):
+    end_time = time.time() + timeout
+    while time.time() < end_time:
+        x, y = motor_driver.get_pos()
+        if abs(x - target_x) < precision and abs(y - target_y) < precision:
+            return
+        time.sleep(0.01)
+    print(f"\nFly scan: The stage did not reach {target_x:.3f}, {target_y:.3f} in time")
+
+
+def fly_scan_generator(
+    scan_area_map,
+    motor_driver: Type[MotorDriverInterface],
+    microscope_driver: Type[MicroscopeDriverInterface],
+    camera_driver: Type[CameraDriverInterface],
+    camera_settings: dict,
+    microscope_settings: dict,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    magnification_index: int = 3,
+    wait_time: float = 0.2,
+    raw_images: bool = False,
+    focus_map: FocusMap = None,
+    exposure: float = 0.0005,
+    max_blur: float = 2,
+    tolerance: float = 0.05,
+    velocity: float = None,
+    run_up: float = 0.2,
+    frame_time: float = 0.5,
+    missed_scan_area_map: np.ndarray = None,
+) -> Generator[Tuple[Optional[np.ndarray], Optional[dict]], None, None]:
+    """Yields the tiles of the scan area map like image_generator, but captures them while the stage sweeps each row\n
+    The rows are swept in a snake pattern, from the first to the last tile of the row at constant velocity.
+    The exposure is shortened and the gain raised by the same factor, the camera streams frames during the sweep.
+    The stage is polled around every frame, its position at the frame is interpolated from the timestamps.
+    A frame is assigned to the nearest tile of the row if it lies within the tolerance of the tile center and its motion blur is below the maximum.
+    Tiles without such a frame are marked in the missed scan area map, the camera settings of the magnification are restored at the end.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map
+        motor_driver (Type[MotorDriverInterface]): The Motordriver
+        microscope_driver (Type[MicroscopeDriverInterface]): The Microscope Driver
+        camera_driver (Type[CameraDriverInterface]): The Camera Driver
+        camera_settings (dict): The settings for the camera.
+        microscope_settings (dict): The settings for the microscope.
+        view_field_x (float, optional): the x View Field of the magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the magnification in mm. Defaults to 0.4613.
+        magnification_index (int, optional): The magnification index of the scan. Defaults to 3.
+        wait_time (float, optional): The time to wait at the start of each row in seconds. Defaults to 0.2.
+        raw_images (bool, optional): Yield copies of the raw camera buffers instead of the processed images. Defaults to False.
+        focus_map (FocusMap, optional): Moves the focus drive to the predicted height of each tile during the sweep, the hardware AF has to be off. Defaults to None.
+        exposure (float, optional): The exposure of the fly scan in seconds. Defaults to 0.0005.
+        max_blur (float, optional): The maximum motion blur in pixels, decides the velocity and rejects frames. Defaults to 2.
+        tolerance (float, optional): The maximum offset of a frame to its tile center relative to the x view field. Defaults to 0.05.
+        velocity (float, optional): The sweep velocity in mm/s. Defaults to None, from get_fly_scan_velocity and the frame rate of the previous row.
+        run_up (float, optional): The distance in mm the stage accelerates before the first tile and brakes after the last tile of a row. Defaults to 0.2.
+        frame_time (float, optional): When the frame is exposed between the call and the return of the capture, 0 at the call and 1 at the return. Defaults to 0.5.
+        missed_scan_area_map (NxM Array, optional): Filled with the chip labels of the tiles without a usable frame. Defaults to None.
+
+    Yields:
+        Tuple (NxMx3 Array, Dict): The Image and the Metadata as a Dict, with the same keys as image_generator and\n
+            'motor_pos' : The interpolated motorposition of the frame in mm (x,y)\n
+            'fly_scan' : True for the frames captured during a sweep\n
+            'motion_blur' : The motion blur of the frame in pixels\n
+    """
+    set_microscope_and_camera_settings(
+        microscope_settings_dict=microscope_settings,
+        camera_settings_dict=camera_settings,
+        magnification_index=magnification_index,
+        camera_driver=camera_driver,
+        microscope_driver=microscope_driver,
+    )
+
+    # the shorter exposure is compensated by the gain
+    normal_props = camera_driver.get_properties()
+    camera_driver.set_properties(
+        exposure=exposure,
+        gain=int(
+            round(
+                normal_props["gain"]
+                + GAIN_PER_DECADE * np.log10(normal_props["exposure"] / exposure)
+            )
+        ),
+    )
+
+    cam_props = camera_driver.get_properties()
+    mic_props = microscope_driver.get_properties()
+
+    def plan_velocity(frame_period: float) -> float:
+        return get_fly_scan_velocity(
+            exposure,
+            frame_period,
+            view_field_x=view_field_x,
+            magnification_index=magnification_index,
+            max_blur=max_blur,
+            tolerance=tolerance,
+        )
+
+    adapt_velocity = velocity is None
+    frame_period = measure_frame_period(camera_driver)
+    if adapt_velocity:
+        velocity = plan_velocity(frame_period)
+    print(
+        f"Fly scan at {velocity:.3f} mm/s with {1 / frame_period:.1f} frames/s, ~{velocity / view_field_x:.2f} tiles/s"
+    )
+
+    grid_to_stage = create_grid_to_stage_transform(view_field_x, view_field_y)
+    if missed_scan_area_map is None:
+        missed_scan_area_map = np.zeros_like(scan_area_map)
+    rows = np.unique(np.nonzero(scan_area_map)[0])
+    num_images = np.count_nonzero(scan_area_map)
+
+    stop_event = threading.Event()
+    sweep_errors = []
+    num_blurred = 0
+    # the times of the frames of the last row, the frame rate drops while the detection runs
+    frame_times = []
+
+    def sweep_row(row_number: int, y_idx: int, tile_queue: queue.Queue):
+        """Sweeps a row and puts the best frame of each tile into the queue, None once the row is done\n
+        The capture runs in its own thread, so the detection of the previous tiles does not slow down the frame rate.
+        """
+        nonlocal num_blurred
+        try:
+            # the tiles of the row in the order of the sweep, a snake pattern over the rows
+            x_indices = np.nonzero(scan_area_map[y_idx])[0]
+            direction = 1 if row_number % 2 == 0 else -1
+            x_indices = x_indices[::direction]
+            positions = grid_to_stage(
+                np.stack([x_indices, np.full_like(x_indices, y_idx)], axis=1)
+            )
+            tile_x, y_pos = positions[:, 0], float(positions[0, 1])
+            start_x = float(tile_x[0] - direction * run_up)
+            end_x = float(tile_x[-1] + direction * run_up)
+
+            # move to the start of the row with the default velocity
+            motor_driver.set_velocity(None)
+            motor_driver.abs_move(start_x, y_pos)
+            z_height = None
+            if focus_map is not None:
+                z_height = focus_map.move_to_focus(
+                    microscope_driver, tile_x[0], y_pos, magnification_index
+                )
+            if wait_time > 0:
+                time.sleep(wait_time)
+
+            motor_driver.set_velocity(velocity)
+            motor_driver.abs_move(end_x, y_pos, wait_for_finish=False)
+
+            sample_times, sample_positions = [], []
+            taken = np.zeros(len(tile_x), dtype=bool)
+            focused_tile = 0
+            # the best frame of the current tile as (tile, offset, image, props)
+            pending = None
+            sweep_end_time = time.time() + 2 * abs(end_x - start_x) / velocity + 5
+
+            frame_times.clear()
+            while time.time() < sweep_end_time and not stop_event.is_set():
+                call_time = time.time()
+                frame_times.append(call_time)
+                sample_times.append(call_time)
+                sample_positions.append(motor_driver.get_pos())
+
+                if raw_images:
+                    image = camera_driver.get_raw_image()
+                else:
+                    image = camera_driver.get_image()
+
+                return_time = time.time()
+                sample_times.append(return_time)
+                sample_positions.append(motor_driver.get_pos())
+
+                x_pos, frame_y = interpolate_stage_positions(
+                    sample_times,
+                    sample_positions,
+                    call_time + frame_time * (return_time - call_time),
+                )[0]
+
+                # the stage has passed the last tile of the row
+                if direction * (x_pos - tile_x[-1]) > tolerance * view_field_x:
+                    break
+
+                tile = int(np.argmin(np.abs(tile_x - x_pos)))
+                if pending is not None and pending[0] != tile:
+                    tile_queue.put(pending[2:])
+                    pending = None
+
+                # the focus of a tile is set once the stage is closer to it than to the previous tile
+                if focus_map is not None and tile != focused_tile:
+                    focused_tile = tile
+                    z_height = focus_map.move_to_focus(
+                        microscope_driver, tile_x[tile], y_pos, magnification_index
+                    )
+
+                offset = abs(tile_x[tile] - x_pos)
+                if offset > tolerance * view_field_x or (
+                    pending is not None and pending[1] <= offset
+                ):
+                    continue
+
+                motion_blur = get_motion_blur(
+                    sample_times[-2:],
+                    sample_positions[-2:],
+                    cam_props["exposure"],
+                    magnification_index,
+                )
+                if motion_blur > max_blur:
+                    num_blurred += 1
+                    continue
+
+                all_props = {
+                    **cam_props,
+                    **mic_props,
+                    "motor_pos": (float(x_pos), float(frame_y)),
+                    "chip_id": int(scan_area_map[y_idx, x_indices[tile]]),
+                    "fly_scan": True,
+                    "motion_blur": motion_blur,
+                }
+                if z_height is not None:
+                    all_props["z_height"] = z_height
+
+                # the raw buffer is overwritten by the next frame
+                if raw_images:
+                    image = image.copy()
+                pending = (tile, offset, image, all_props)
+                taken[tile] = True
+
+            if pending is not None:
+                tile_queue.put(pending[2:])
+
+            missed_scan_area_map[y_idx, x_indices[~taken]] = scan_area_map[
+                y_idx, x_indices[~taken]
+            ]
+            # the next move is only sent once the stage stands, also after an early stop
+            _wait_for_stage(
+                motor_driver,
+                end_x,
+                y_pos,
+                timeout=2 * abs(end_x - start_x) / velocity + 5,
+            )
+        except Exception as error:
+            sweep_errors.append(error)
+        finally:
+            tile_queue.put(None)
+
+    curr_idx = 0
+    start_time = time.time()
+    sweep_thread = None
+    try:
+        for row_number, y_idx in enumerate(rows):
+            tile_queue = queue.Queue()
+            sweep_thread = threading.Thread(
+                target=sweep_row, args=(row_number, y_idx, tile_queue), daemon=True
+            )
+            sweep_thread.start()
+
+            while True:
+                item = tile_queue.get()
+                if item is None:
+                    break
+
+                curr_idx += 1
+                time_to_go = (
+                    (time.time() - start_time) / curr_idx * (num_images - curr_idx)
+                )
+                time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
+                print(
+                    f"\r{curr_idx:>5}/{num_images:<5} scanned | Time to go : ~ {time_string:15}",
+                    end="\r",
+                )
+
+                yield item
+
+            sweep_thread.join()
+            if len(sweep_errors) != 0:
+                raise sweep_errors[0]
+
+            # the next row follows the frame rate measured during this one
+            if adapt_velocity and len(frame_times) > 2:
+                frame_period = float(np.median(np.diff(frame_times)))
+                row_velocity = plan_velocity(frame_period)
+                if abs(row_velocity - velocity) > 0.1 * velocity:
+                    print(
+                        f"\nFly scan at {row_velocity:.3f} mm/s with {1 / frame_period:.1f} frames/s during the search"
+                    )
+                velocity = row_velocity
+
+    finally:
+        # also reached when the search stops early, the sweep is stopped first
+        stop_event.set()
+        if sweep_thread is not None:
+            sweep_thread.join()
+        motor_driver.set_velocity(None)
+        camera_driver.set_properties(
+            exposure=normal_props["exposure"], gain=normal_props["gain"]
+        )
+
+    num_missed = np.count_nonzero(missed_scan_area_map)
+    print(
+        f"\nFly scan: {curr_idx} tiles captured on the fly, {num_blurred} blurred frames rejected, {num_missed} tiles left for stop and go"
+    )
@@ -0,0 +1,564 @@
+"""
+Software autofocus, the focus drive is moved until the sharpness of the camera image peaks\n
+The focus map predicts the focus height anywhere on the plate from a few of these measurements.
+"""
+import time
+from typing import Tuple, Type
+
+import cv2
+import numpy as np
+from Drivers import (
+    CameraDriverInterface,
+    MicroscopeDriverInterface,
+    MotorDriverInterface,
+)
+
+import Utils.conversion_functions as conversion
+from Utils.transform_functions import create_grid_to_stage_transform
+
+# The step of the coarse search and the precision of the fine search in µm for each magnification index
+AUTOFOCUS_STEPS = {
+    1: (60, 5),
+    2: (20, 2),
+    3: (4, 0.3),
+    4: (1.5, 0.1),
+    5: (0.8, 0.05),
+}
+
+# The range of the focus drive in µm, the same protection as in the microscope driver
+Z_LIMITS = (3501, 6499)
+
+GOLDEN_RATIO = (np.sqrt(5) - 1) / 2
+
+
+def _get_laplacian(
+    image: np.ndarray,
+    roi_fraction: float,
+    downsample: int,
+) -> np.ndarray:
+    """The Laplacian of the centered region of the image, downsampled in floating point to keep the noise suppression of the averaging"""
+    height, width = image.shape[:2]
+    roi_height, roi_width = int(height * roi_fraction), int(width * roi_fraction)
+    top, left = (height - roi_height) // 2, (width - roi_width) // 2
+    roi = image[top : top + roi_height, left : left + roi_width]
+
+    if roi.ndim == 3:
+        roi = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    roi = roi.astype(np.float32)
+    if downsample > 1:
+        roi = cv2.resize(
+            roi,
+            (roi_width // downsample, roi_height // downsample),
+            interpolation=cv2.INTER_AREA,
+        )
+
+    return cv2.Laplacian(roi, cv2.CV_32F)
+
+
+def focus_metric(
+    image: np.ndarray,
+    roi_fraction: float = 0.5,
+    downsample: int = 2,
+) -> float:
+    """Measures the sharpness of an image as the variance of its Laplacian
+
+    Args:
+        image (NxMx3 Array): The image
+        roi_fraction (float, optional): The size of the centered region which is evaluated relative to the image. Defaults to 0.5.
+        downsample (int, optional): The factor by which the region is downsampled first, this also suppresses the pixel noise. Defaults to 2.
+
+    Returns:
+        float: The sharpness, higher is sharper
+    """
+    return float(_get_laplacian(image, roi_fraction, downsample).var())
+
+
+def focus_metric_and_noise_floor(
+    image: np.ndarray,
+    roi_fraction: float = 0.5,
+    downsample: int = 2,
+) -> Tuple[float, float]:
+    """Measures the sharpness of an image and the sharpness its pixel noise alone would have\n
+    The noise floor is estimated robustly from the median absolute deviation of the Laplacian, the edges of the few flakes barely change it.
+    Far from the focus the sharpness drops to the noise floor.
+
+    Args:
+        image (NxMx3 Array): The image
+        roi_fraction (float, optional): The size of the centered region which is evaluated relative to the image. Defaults to 0.5.
+        downsample (int, optional): The factor by which the region is downsampled first. Defaults to 2.
+
+    Returns:
+        Tuple[float, float]: The sharpness like `focus_metric` and the noise floor
+    """
+    laplacian = _get_laplacian(image, roi_fraction, downsample)
+    median_absolute_deviation = np.median(np.abs(laplacian - np.median(laplacian)))
+    return float(laplacian.var()), float((1.4826 * median_absolute_deviation) ** 2)
+
+
+def read_z_height(
+    microscope_driver: Type[MicroscopeDriverInterface],
+    retries: int = 3,
+    retry_delay: float = 0.1,
+) -> float:
+    """Reads the height of the focus drive, the read intermittently fails on the real microscope and is retried
+
+    Args:
+        microscope_driver (Type[MicroscopeDriverInterface]): The microscope driver
+        retries (int, optional): The number of attempts. Defaults to 3.
+        retry_delay (float, optional): The time between the attempts in seconds. Defaults to 0.1.
+
+    Returns:
+        float: The height in µm, None if every attempt failed
+    """
+    for _ in range(retries):
+        try:
+            return microscope_driver.get_z_height()
+        except Exception as error:
+            print(f"Reading the focus height failed, retrying: {error}")
+            time.sleep(retry_delay)
+    return None
+
+
+def autofocus(
+    microscope_driver: Type[MicroscopeDriverInterface],
+    camera_driver: Type[CameraDriverInterface],
+    step: float = 4,
+    tolerance: float = 0.3,
+    max_coarse_steps: int = 20,
+    coarse_downsample: int = 8,
+    min_signal_to_noise: float = 1.5,
+    settle_time: float = 0.05,
+    z_start: float = None,
+    verbose: bool = False,
+) -> Tuple[float, float]:
+    """Focuses the microscope by maximizing the sharpness of the camera image\n
+    Starting at the current height, the coarse search widens to both sides until the sharpness rises above the noise floor and then walks uphill until it drops again.
+    The coarse sharpness is measured on a heavily downsampled image, its peak is wider than the coarse step so the steps can not jump over it.
+    A golden section search narrows the bracket around the peak down to the tolerance, every step needs a single image.
+    The hardware AF has to be off, otherwise the focus drive does not move, the search stops with an error if the drive does not follow.
+
+    Args:
+        microscope_driver (Type[MicroscopeDriverInterface]): The microscope driver
+        camera_driver (Type[CameraDriverInterface]): The camera driver
+        step (float, optional): The step of the coarse search in µm. Defaults to 4.
+        tolerance (float, optional): The precision of the found height in µm. Defaults to 0.3.
+        max_coarse_steps (int, optional): The coarse search gives up after this many steps. Defaults to 20.
+        coarse_downsample (int, optional): The downsampling of the coarse sharpness, larger values widen its peak. Defaults to 8.
+        min_signal_to_noise (float, optional): The coarse sharpness has to exceed the noise floor by this factor to count as structure. Defaults to 1.5.
+        settle_time (float, optional): The time to wait after each move of the focus drive in seconds. Defaults to 0.05.
+        z_start (float, optional): The height the drive was last moved to in µm, read from the drive if None. Defaults to None.
+        verbose (bool, optional): Print the result. Defaults to False.
+
+    Returns:
+        Tuple[float, float]: The height in focus in µm and its sharpness, the sharpness is None if no peak was found and the drive is back at the start
+    """
+    if z_start is None:
+        z_start = read_z_height(microscope_driver)
+        if z_start is None:
+            raise RuntimeError(
+                "Autofocus: The height of the focus drive can not be read from the microscope"
+            )
+    z_start = round(float(np.clip(z_start, *Z_LIMITS)), 3)
+
+    # each measurement is (coarse sharpness, coarse noise floor, sharpness)
+    measurements = {}
+    is_drive_checked = False
+
+    def check_drive(z_height: float):
+        # with the hardware AF on the drive ignores the moves without an error
+        nonlocal is_drive_checked
+        actual_z_height = read_z_height(microscope_driver)
+        if actual_z_height is None:
+            return
+        is_drive_checked = True
+        if abs(actual_z_height - z_height) > abs(z_height - z_start) / 2:
+            raise RuntimeError(
+                f"Autofocus: The focus drive was moved to {z_height:.2f} µm but stays at {actual_z_height:.2f} µm, is the hardware AF still on?"
+            )
+
+    def measure(z_height: float) -> Tuple[float, float, float]:
+        z_height = round(float(np.clip(z_height, *Z_LIMITS)), 3)
+        if z_height not in measurements:
+            microscope_driver.set_z_height(z_height)
+            time.sleep(settle_time)
+            if not is_drive_checked and z_height != z_start:
+                check_drive(z_height)
+            image = camera_driver.get_image()
+            measurements[z_height] = (
+                *focus_metric_and_noise_floor(image, downsample=coarse_downsample),
+                focus_metric(image),
+            )
+        return measurements[z_height]
+
+    def coarse_sharpness(z_height: float) -> float:
+        return measure(z_height)[0]
+
+    def has_structure(z_height: float) -> bool:
+        sharpness, noise_floor = measure(z_height)[:2]
+        return sharpness > min_signal_to_noise * noise_floor
+
+    # 1. coarse search, far from the focus the sharpness drops to the noise floor
+    # the search widens to both sides until structure appears
+    center = None
+    for offset in range(max_coarse_steps + 1):
+        candidates = (
+            [z_start]
+            if offset == 0
+            else [z_start - offset * step, z_start + offset * step]
+        )
+        candidates = [z_height for z_height in candidates if has_structure(z_height)]
+        if len(candidates) != 0:
+            center = max(candidates, key=coarse_sharpness)
+            break
+    if center is None:
+        print("Autofocus: The sharpness is flat, no structure in the field of view?")
+        microscope_driver.set_z_height(z_start)
+        time.sleep(settle_time)
+        return z_start, None
+
+    # then walks uphill until the sharpness drops on both sides
+    for _ in range(max_coarse_steps):
+        best = max(
+            [
+                float(np.clip(z_height, *Z_LIMITS))
+                for z_height in [center - step, center, center + step]
+            ],
+            key=coarse_sharpness,
+        )
+        if best == center:
+            break
+        center = best
+    lower, upper = center - step, center + step
+
+    # 2. golden section search in the bracket around the peak
+    # the coarse sharpness is smooth enough to narrow the bracket to a step, then the sharper metric takes over
+    while upper - lower > tolerance:
+        inner_lower = upper - GOLDEN_RATIO * (upper - lower)
+        inner_upper = lower + GOLDEN_RATIO * (upper - lower)
+        index = 0 if upper - lower > step else 2
+        if measure(inner_lower)[index] > measure(inner_upper)[index]:
+            upper = inner_upper
+        else:
+            lower = inner_lower
+
+    best_z_height = max(measurements, key=lambda z_height: measurements[z_height][2])
+    microscope_driver.set_z_height(best_z_height)
+    time.sleep(settle_time)
+
+    if verbose:
+        print(
+            f"Autofocus: {best_z_height:.2f} µm, moved {best_z_height - z_start:+.2f} µm using {len(measurements)} images"
+        )
+
+    return best_z_height, measurements[best_z_height][2]
+
+
+class FocusMap:
+    """A model of the focus height over the plate, fitted to sparse autofocus measurements\n
+    The height is a low order surface in the stage position plus a constant offset for each objective.
+    The scan pre-positions the focus drive for every tile and refines the model with every new measurement.
+    """
+
+    def __init__(
+        self,
+        order: int = 1,
+        min_samples_per_objective: int = 1,
+    ):
+        """
+        Args:
+            order (int, optional): The order of the surface, 1 is a plane and 2 a paraboloid. Defaults to 1.
+            min_samples_per_objective (int, optional): Objectives with fewer measurements should be focused instead of predicted. Defaults to 1.
+        """
+        self.order = order
+        self.min_samples_per_objective = min_samples_per_objective
+
+        # each sample is (x, y, magnification_index, z_height)
+        self.samples = []
+        self.coefficients = np.zeros(0)
+        self.offsets = {}
+        self.fitted_order = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def _get_features(self, x: np.ndarray, y: np.ndarray, order: int) -> np.ndarray:
+        """The polynomial terms of the surface without the constant, which is part of the offsets"""
+        features = []
+        if order >= 1:
+            features += [x, y]
+        if order >= 2:
+            features += [x * x, x * y, y * y]
+        return np.stack(features, axis=-1) if features else np.zeros((len(x), 0))
+
+    def fit(self):
+        """Fits the surface and the offsets to all samples with least squares\n
+        The order is reduced while there are too few samples to determine the surface.
+        """
+        if len(self.samples) == 0:
+            return
+
+        samples = np.array(self.samples, dtype=np.float64)
+        magnification_indices = sorted(set(samples[:, 2].astype(int).tolist()))
+
+        # a plane needs 3 points in addition to the offsets, a paraboloid 6
+        num_free = len(samples) - len(magnification_indices)
+        order = self.order
+        while order > 0 and num_free < (2 if order == 1 else 5):
+            order -= 1
+
+        features = self._get_features(samples[:, 0], samples[:, 1], order)
+        one_hot = samples[:, 2:3] == np.array(magnification_indices)[None, :]
+        design = np.concatenate([features, one_hot], axis=1)
+
+        solution = np.linalg.lstsq(design, samples[:, 3], rcond=None)[0]
+        self.fitted_order = order
+        self.coefficients = solution[: features.shape[1]]
+        self.offsets = dict(
+            zip(magnification_indices, solution[features.shape[1] :].tolist())
+        )
+
+    def add(
+        self,
+        x: float,
+        y: float,
+        z_height: float,
+        magnification_index: int,
+    ):
+        """Adds a measured focus height and refits the model
+
+        Args:
+            x (float): The x position in mm
+            y (float): The y position in mm
+            z_height (float): The height in focus in µm
+            magnification_index (int): The objective used for the measurement
+        """
+        self.samples.append((float(x), float(y), magnification_index, float(z_height)))
+        self.fit()
+
+    def needs_samples(self, magnification_index: int) -> bool:
+        """Whether the objective has too few measurements to trust the prediction"""
+        num_samples = sum(sample[2] == magnification_index for sample in self.samples)
+        return num_samples < self.min_samples_per_objective
+
+    def predict(
+        self,
+        x,
+        y,
+        magnification_index: int,
+    ):
+        """Predicts the focus height at one or many stage positions\n
+        The offset of an objective without measurements is derived from the nominal focus heights.
+
+        Args:
+            x (float or N Array): The x positions in mm
+            y (float or N Array): The y positions in mm
+            magnification_index (int): The used objective
+
+        Returns:
+            float or N Array: The heights in µm, None if there are no samples at all
+        """
+        if len(self.offsets) == 0:
+            return None
+
+        if magnification_index in self.offsets:
+            offset = self.offsets[magnification_index]
+        else:
+            reference_index, reference_offset = next(iter(self.offsets.items()))
+            offset = (
+                reference_offset
+                + conversion.FOCUS_HEIGHTS[magnification_index]
+                - conversion.FOCUS_HEIGHTS[reference_index]
+            )
+
+        x, y = np.asarray(x, dtype=np.float64), np.asarray(y, dtype=np.float64)
+        features = self._get_features(
+            np.atleast_1d(x), np.atleast_1d(y), self.fitted_order
+        )
+        z_heights = features @ self.coefficients + offset
+
+        if x.ndim == 0:
+            return float(z_heights[0])
+        return z_heights
+
+    def get_residuals(self) -> np.ndarray:
+        """The difference between the measured and the predicted heights of all samples in µm"""
+        return np.array(
+            [
+                z_height - self.predict(x, y, magnification_index)
+                for x, y, magnification_index, z_height in self.samples
+            ]
+        )
+
+    def move_to_focus(
+        self,
+        microscope_driver: Type[MicroscopeDriverInterface],
+        x: float,
+        y: float,
+        magnification_index: int,
+    ):
+        """Moves the focus drive to the predicted height, does nothing without samples
+
+        Returns:
+            float: The predicted height in µm or None
+        """
+        z_height = self.predict(x, y, magnification_index)
+        if z_height is not None:
+            microscope_driver.set_z_height(z_height)
+        return z_height
+
+    def measure(
+        self,
+        microscope_driver: Type[MicroscopeDriverInterface],
+        camera_driver: Type[CameraDriverInterface],
+        x: float,
+        y: float,
+        magnification_index: int,
+        settle_time: float = 0.05,
+    ) -> float:
+        """Focuses at the current position starting from the prediction and adds the result to the map\n
+        The stage has to be at (x, y) already.
+        With a prediction the peak is close, so the coarse search gives up early on positions without structure.
+
+        Returns:
+            float: The measured height in µm, None if the field of view has no structure to focus on
+        """
+        predicted_z_height = self.move_to_focus(
+            microscope_driver, x, y, magnification_index
+        )
+        step, tolerance = AUTOFOCUS_STEPS[magnification_index]
+        z_height, sharpness = autofocus(
+            microscope_driver,
+            camera_driver,
+            step=step,
+            tolerance=tolerance,
+            max_coarse_steps=20 if predicted_z_height is None else 4,
+            settle_time=settle_time,
+            z_start=predicted_z_height,
+        )
+        if sharpness is None:
+            return None
+
+        self.add(x, y, z_height, magnification_index)
+        return z_height
+
+    def to_dict(self) -> dict:
+        return {
+            "order": self.order,
+            "min_samples_per_objective": self.min_samples_per_objective,
+            "samples": self.samples,
+        }
+
+    @classmethod
+    def from_dict(cls, focus_map_dict: dict) -> "FocusMap":
+        focus_map = cls(
+            order=focus_map_dict["order"],
+            min_samples_per_objective=focus_map_dict["min_samples_per_objective"],
+        )
+        focus_map.samples = [tuple(sample) for sample in focus_map_dict["samples"]]
+        focus_map.fit()
+        return focus_map
+
+
+def select_focus_sample_positions(
+    scan_area_map: np.ndarray,
+    view_field_x: float,
+    view_field_y: float,
+    num_samples: int = 9,
+    erosion_iterations: int = 1,
+) -> np.ndarray:
+    """Selects spread out tiles on the chips to measure the focus at\n
+    Starting at the center of mass, the farthest tile from all selected ones is added until there are enough.
+    The map is eroded first to stay away from the chip edges.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map, non zero tiles are on a chip
+        view_field_x (float): The x dimension of a tile in mm
+        view_field_y (float): The y dimension of a tile in mm
+        num_samples (int, optional): The number of positions. Defaults to 9.
+        erosion_iterations (int, optional): How many tiles are removed from the chip edges. Defaults to 1.
+
+    Returns:
+        (Kx2 Array): The stage positions in mm
+    """
+    chip_map = (scan_area_map != 0).astype(np.uint8)
+    eroded_map = cv2.erode(
+        chip_map, np.ones((3, 3), np.uint8), iterations=erosion_iterations
+    )
+    if not eroded_map.any():
+        eroded_map = chip_map
+
+    y_indices, x_indices = np.nonzero(eroded_map)
+    positions = create_grid_to_stage_transform(view_field_x, view_field_y)(
+        np.stack([x_indices, y_indices], axis=1)
+    )
+    if len(positions) == 0:
+        return positions
+
+    # start at the tile closest to the center of mass
+    distances = np.linalg.norm(positions - positions.mean(axis=0), axis=1)
+    selected = [int(np.argmin(distances))]
+    distances = np.linalg.norm(positions - positions[selected[0]], axis=1)
+    for _ in range(min(num_samples, len(positions)) - 1):
+        selected.append(int(np.argmax(distances)))
+        distances = np.minimum(
+            distances, np.linalg.norm(positions - positions[selected[-1]], axis=1)
+        )
+
+    return positions[selected]
+
+
+def create_focus_map(
+    scan_area_map: np.ndarray,
+    motor_driver: Type[MotorDriverInterface],
+    microscope_driver: Type[MicroscopeDriverInterface],
+    camera_driver: Type[CameraDriverInterface],
+    magnification_index: int,
+    view_field_x: float,
+    view_field_y: float,
+    num_samples: int = 9,
+    order: int = 1,
+    settle_time: float = 0.2,
+    verbose: bool = True,
+    **kwargs,
+) -> FocusMap:
+    """Measures the focus at spread out positions on the chips and fits a focus map\n
+    Every measurement starts at the prediction of the previous ones, so only the first needs a wide search.
+    The positions are spread out, the first ones cover the extent of the chips and later ones fill the gaps.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map, non zero tiles are on a chip
+        motor_driver (Type[MotorDriverInterface]): The motor driver
+        microscope_driver (Type[MicroscopeDriverInterface]): The microscope driver, already at the used objective
+        camera_driver (Type[CameraDriverInterface]): The camera driver
+        magnification_index (int): The used objective
+        view_field_x (float): The x dimension of a tile in mm
+        view_field_y (float): The y dimension of a tile in mm
+        num_samples (int, optional): The number of measured positions. Defaults to 9.
+        order (int, optional): The order of the surface. Defaults to 1.
+        settle_time (float, optional): The time to wait after each stage move in seconds. Defaults to 0.2.
+        verbose (bool, optional): Print the fit. Defaults to True.
+
+    Returns:
+        FocusMap: The fitted focus map
+    """
+    focus_map = FocusMap(order=order)
+
+    # positions without structure are skipped, so there are more candidates than samples
+    positions = select_focus_sample_positions(
+        scan_area_map, view_field_x, view_field_y, num_samples * 3
+    )
+
+    for x, y in positions.tolist():
+        motor_driver.abs_move(x, y)
+        time.sleep(settle_time)
+        focus_map.measure(microscope_driver, camera_driver, x, y, magnification_index)
+        if len(focus_map) >= num_samples:
+            break
+
+    if verbose and len(focus_map) > 0:
+        residuals = focus_map.get_residuals()
+        print(
+            f"Focus map from {len(focus_map)} positions, RMS residual {np.sqrt(np.mean(residuals**2)):.2f} µm"
+        )
+
+    return focus_map
@@ -0,0 +1,391 @@
+"""
+Finds the lamp voltage, aperture stop and exposure time which give a target background intensity\n
+The intensity is modelled as a power law of the three settings, fitted to the captures taken so far.
+Lamp and aperture changes are slow, the search and the sweeps change them as rarely as possible.
+"""
+import time
+from typing import Tuple, Type
+
+import cv2
+import numpy as np
+from Drivers import CameraDriverInterface, MicroscopeDriverInterface
+
+# The settings the lamp and the aperture stop can be set to
+VOLTAGE_STEPS = [4, 5, 6, 6.4, 7, 8, 9, 10]
+APERTURE_STEPS = [1.2, 2, 2.3, 2.5, 3, 4, 5, 6, 7, 8, 8.5]
+EXPOSURE_RANGE = (0.001, 0.5)
+
+# The time in seconds until the image is stable after a change of the lamp or the aperture stop
+VOLTAGE_SETTLE_TIME = 1
+APERTURE_SETTLE_TIME = 1
+
+# A new exposure is only in the image after the frame in flight is read out
+EXPOSURE_SETTLE_FRAMES = 2
+EXPOSURE_SETTLE_OFFSET = 0.05
+
+# The exponents of voltage, aperture and exposure the fit starts with
+PRIOR_EXPONENTS = (2, 1, 1)
+
+# Pixels at or above this value count as saturated, before the null values are subtracted
+SATURATION_LEVEL = 253
+
+
+def get_exposure_settle_time(exposure: float) -> float:
+    """The time in seconds until an image with the new exposure is available"""
+    return EXPOSURE_SETTLE_FRAMES * exposure + EXPOSURE_SETTLE_OFFSET
+
+
+def measure_intensity(
+    image: np.ndarray,
+    saturation_level: float = SATURATION_LEVEL,
+) -> Tuple[float, float]:
+    """Measures the brightness of an image
+
+    Args:
+        image (NxMx3 Array): The image
+        saturation_level (float, optional): Pixels at or above this value count as saturated. Defaults to SATURATION_LEVEL.
+
+    Returns:
+        Tuple[float, float]: The mean of the brightest channel and the fraction of saturated pixels
+    """
+    channel_means = np.array(cv2.mean(image)[:3])
+    saturated_fraction = np.count_nonzero(image.max(axis=2) >= saturation_level) / (
+        image.shape[0] * image.shape[1]
+    )
+    return float(channel_means.max()), float(saturated_fraction)
+
+
+class IlluminationModel:
+    """Models the mean intensity as k * voltage^a * aperture^b * exposure^c\n
+    The exponents are fitted in log space, pulled towards PRIOR_EXPONENTS while there are few captures.
+    The saturation is predicted by scaling the pixel distribution of the last unsaturated capture.
+    """
+
+    def __init__(
+        self,
+        prior_weight: float = 1.0,
+        min_intensity: float = 5,
+        max_saturated_fraction: float = 0.001,
+        saturation_level: float = SATURATION_LEVEL,
+    ):
+        """
+        Args:
+            prior_weight (float, optional): The weight of the prior exponents relative to a single capture. Defaults to 1.0.
+            min_intensity (float, optional): Darker captures are dominated by the noise and are not used for the fit. Defaults to 5.
+            max_saturated_fraction (float, optional): Captures with more saturated pixels are not used for the fit. Defaults to 0.001.
+            saturation_level (float, optional): Pixels at or above this value count as saturated, lower it by the subtracted null values. Defaults to SATURATION_LEVEL.
+        """
+        self.prior_weight = prior_weight
+        self.min_intensity = min_intensity
+        self.max_saturated_fraction = max_saturated_fraction
+        self.saturation_level = saturation_level
+
+        # each sample is (voltage, aperture, exposure, intensity)
+        self.samples = []
+        self.coefficients = np.array([0, *PRIOR_EXPONENTS], dtype=np.float64)
+
+        # the sorted brightest channel of the brightest unsaturated capture divided by its mean
+        # the noise does not scale with the intensity, so dark captures make bad references
+        self.relative_pixel_values = None
+        self.reference_intensity = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(
+        self,
+        voltage: float,
+        aperture: float,
+        exposure: float,
+        image: np.ndarray,
+    ) -> Tuple[float, float]:
+        """Adds a capture and refits the model
+
+        Args:
+            voltage (float): The lamp voltage in V
+            aperture (float): The aperture stop
+            exposure (float): The exposure time in s
+            image (NxMx3 Array): The captured image
+
+        Returns:
+            Tuple[float, float]: The measured intensity and the fraction of saturated pixels
+        """
+        intensity, saturated_fraction = measure_intensity(image, self.saturation_level)
+        if (
+            intensity >= self.min_intensity
+            and saturated_fraction <= self.max_saturated_fraction
+        ):
+            self.samples.append((voltage, aperture, exposure, intensity))
+            if intensity > self.reference_intensity:
+                self.reference_intensity = intensity
+                self.relative_pixel_values = (
+                    np.sort(image.max(axis=2), axis=None) / intensity
+                )
+            self.fit()
+        return intensity, saturated_fraction
+
+    def fit(self):
+        """Fits the log intensity with least squares, the prior rows keep the fit determined with few captures"""
+        if len(self.samples) == 0:
+            return
+
+        samples = np.log(np.array(self.samples, dtype=np.float64))
+        design = np.concatenate([np.ones((len(samples), 1)), samples[:, :3]], axis=1)
+        target = samples[:, 3]
+
+        prior_design = np.sqrt(self.prior_weight) * np.eye(4)[1:]
+        prior_target = np.sqrt(self.prior_weight) * np.array(PRIOR_EXPONENTS)
+
+        self.coefficients = np.linalg.lstsq(
+            np.concatenate([design, prior_design]),
+            np.concatenate([target, prior_target]),
+            rcond=None,
+        )[0]
+
+    def predict(self, voltage, aperture, exposure):
+        """Predicts the mean intensity, works on arrays of settings"""
+        log_k, a, b, c = self.coefficients
+        return np.exp(
+            log_k + a * np.log(voltage) + b * np.log(aperture) + c * np.log(exposure)
+        )
+
+    def get_exposure(self, voltage, aperture, intensity):
+        """The exposure time which gives the intensity, works on arrays of settings"""
+        log_k, a, b, c = self.coefficients
+        return np.exp(
+            (np.log(intensity) - log_k - a * np.log(voltage) - b * np.log(aperture)) / c
+        )
+
+    def predict_saturation(self, intensity):
+        """Predicts the fraction of saturated pixels at a mean intensity, works on arrays"""
+        if self.relative_pixel_values is None:
+            return np.zeros_like(np.asarray(intensity, dtype=np.float64))
+        thresholds = self.saturation_level / np.asarray(intensity, dtype=np.float64)
+        num_pixels = len(self.relative_pixel_values)
+        return (
+            num_pixels - np.searchsorted(self.relative_pixel_values, thresholds)
+        ) / num_pixels
+
+
+def find_illumination_settings(
+    microscope_driver: Type[MicroscopeDriverInterface],
+    camera_driver: Type[CameraDriverInterface],
+    target_intensity: float,
+    tolerance: float = 2,
+    voltage_steps: list = VOLTAGE_STEPS,
+    aperture_steps: list = APERTURE_STEPS,
+    exposure_range: Tuple[float, float] = EXPOSURE_RANGE,
+    max_captures: int = 30,
+    model: IlluminationModel = None,
+    verbose: bool = True,
+) -> Tuple[dict, IlluminationModel]:
+    """Searches the settings which give the target background intensity\n
+    The exposure is fast to change, so the search keeps the lamp and the aperture as long as the predicted exposure is in range.
+    Otherwise it moves to the closest lamp and aperture setting where the target is reachable.
+    As the intensity is linear in the exposure, this usually needs less than 10 captures.
+
+    Args:
+        microscope_driver (Type[MicroscopeDriverInterface]): The microscope driver
+        camera_driver (Type[CameraDriverInterface]): The camera driver
+        target_intensity (float): The mean intensity of the brightest channel to reach
+        tolerance (float, optional): The allowed deviation from the target. Defaults to 2.
+        voltage_steps (list, optional): The possible lamp voltages. Defaults to VOLTAGE_STEPS.
+        aperture_steps (list, optional): The possible aperture stops. Defaults to APERTURE_STEPS.
+        exposure_range (Tuple[float, float], optional): The minimum and maximum exposure time in s. Defaults to EXPOSURE_RANGE.
+        max_captures (int, optional): The search gives up after this many captures. Defaults to 30.
+        model (IlluminationModel, optional): A model from an earlier search to start with. Defaults to a new model.
+        verbose (bool, optional): Print every capture. Defaults to True.
+
+    Returns:
+        Tuple[dict, IlluminationModel]: The best settings with the keys 'light_voltage', 'aperture', 'exposure', 'intensity', 'saturated_fraction' and 'captures', and the fitted model
+    """
+    if model is None:
+        # the images have the null values subtracted, so they saturate earlier
+        model = IlluminationModel(
+            saturation_level=SATURATION_LEVEL
+            - float(np.max(camera_driver.get_null_values()))
+        )
+
+    microscope_props = microscope_driver.get_properties()
+    camera_props = camera_driver.get_properties()
+    voltage = microscope_props["light"]
+    aperture = microscope_props["aperture"]
+    exposure = float(np.clip(camera_props["exposure"], *exposure_range))
+
+    # all lamp and aperture combinations, the transition cost is the time to change to them
+    voltage_grid, aperture_grid = np.meshgrid(
+        np.array(voltage_steps, dtype=np.float64),
+        np.array(aperture_steps, dtype=np.float64),
+        indexing="ij",
+    )
+    voltage_grid, aperture_grid = voltage_grid.ravel(), aperture_grid.ravel()
+
+    best_settings = None
+    current_voltage, current_aperture, current_exposure = None, None, None
+    for capture_index in range(1, max_captures + 1):
+        # only change what is needed, the lamp and the aperture are slow
+        settle_time = get_exposure_settle_time(exposure)
+        if voltage != current_voltage:
+            microscope_driver.set_lamp_voltage(voltage)
+            settle_time = max(settle_time, VOLTAGE_SETTLE_TIME)
+        if aperture != current_aperture:
+            microscope_driver.set_lamp_aperture_stop(aperture)
+            settle_time = max(settle_time, APERTURE_SETTLE_TIME)
+        if exposure != current_exposure:
+            camera_driver.set_properties(exposure=exposure)
+        current_voltage, current_aperture, current_exposure = (
+            voltage,
+            aperture,
+            exposure,
+        )
+        time.sleep(settle_time)
+
+        intensity, saturated_fraction = model.add(
+            voltage, aperture, exposure, camera_driver.get_image()
+        )
+        if verbose:
+            print(
+                f"{capture_index:>3}: {voltage:.1f} V, aperture {aperture:.1f}, {exposure * 1000:.1f} ms -> intensity {intensity:.1f}, {saturated_fraction * 100:.2f}% saturated"
+            )
+
+        # saturated captures only count if there is nothing else
+        saturated = saturated_fraction > model.max_saturated_fraction
+        error = abs(intensity - target_intensity)
+        if best_settings is None or (saturated, error) < (
+            best_settings["saturated_fraction"] > model.max_saturated_fraction,
+            abs(best_settings["intensity"] - target_intensity),
+        ):
+            best_settings = {
+                "light_voltage": voltage,
+                "aperture": aperture,
+                "exposure": exposure,
+                "intensity": intensity,
+                "saturated_fraction": saturated_fraction,
+            }
+        if error <= tolerance and not saturated:
+            break
+
+        # only trust the predicted saturation close to the reference capture
+        if model.reference_intensity > target_intensity / 2 and (
+            model.predict_saturation(target_intensity) > model.max_saturated_fraction
+        ):
+            print(
+                f"The target intensity {target_intensity} saturates the image, keeping the closest unsaturated settings"
+            )
+            break
+
+        # A saturated capture does not enter the fit, its intensity is only a lower bound
+        # so the exposure is reduced by at least the missing factor
+        if saturated:
+            factor = min(0.9 * target_intensity / max(intensity, 1), 0.9)
+            exposure = float(np.clip(exposure * factor, *exposure_range))
+            continue
+
+        # Without any capture in the fit the model is only the prior, step the exposure by a fixed factor
+        if len(model) == 0:
+            exposure = float(np.clip(exposure * 4, *exposure_range))
+            continue
+
+        exposures = model.get_exposure(voltage_grid, aperture_grid, target_intensity)
+        reachable = (exposures >= exposure_range[0]) & (exposures <= exposure_range[1])
+
+        if reachable.any():
+            costs = (voltage_grid != voltage) * VOLTAGE_SETTLE_TIME + (
+                aperture_grid != aperture
+            ) * APERTURE_SETTLE_TIME
+            # among equally cheap settings prefer the shortest exposure
+            costs = np.where(reachable, costs + exposures, np.inf)
+            index = int(np.argmin(costs))
+            exposure = float(exposures[index])
+        else:
+            # the target is out of reach, take the setting which comes closest
+            clipped_exposures = np.clip(exposures, *exposure_range)
+            errors = np.abs(
+                np.log(
+                    model.predict(voltage_grid, aperture_grid, clipped_exposures)
+                    / target_intensity
+                )
+            )
+            index = int(np.argmin(errors))
+            exposure = float(clipped_exposures[index])
+        voltage, aperture = float(voltage_grid[index]), float(aperture_grid[index])
+
+        # the same settings again would not change anything
+        if (voltage, aperture, exposure) == (
+            current_voltage,
+            current_aperture,
+            current_exposure,
+        ):
+            break
+
+    best_settings["captures"] = capture_index
+    if verbose:
+        print(
+            f"Best settings after {capture_index} captures: {best_settings['light_voltage']:.1f} V, aperture {best_settings['aperture']:.1f}, {best_settings['exposure'] * 1000:.1f} ms -> intensity {best_settings['intensity']:.1f}"
+        )
+
+    return best_settings, model
+
+
+def order_sweep(
+    settings: np.ndarray,
+    costs: Tuple[float, float, float] = (
+        VOLTAGE_SETTLE_TIME,
+        APERTURE_SETTLE_TIME,
+        0,
+    ),
+) -> np.ndarray:
+    """Orders a sweep over voltage, aperture and exposure to minimize the slow transitions\n
+    The most expensive setting changes in the outermost loop, every inner loop runs back and forth like a snake.
+    So each setting only changes to its neighbouring value and the expensive ones change the fewest times.
+
+    Args:
+        settings (Nx3 Array): The settings as (voltage, aperture, exposure) in any order
+        costs (Tuple[float, float, float], optional): The time to change each of the settings. Defaults to the settle times.
+
+    Returns:
+        (Nx3 Array): The ordered settings
+    """
+    settings = np.asarray(settings, dtype=np.float64)
+    if len(settings) == 0:
+        return settings
+
+    keys = []
+    group = np.zeros(len(settings), dtype=np.int64)
+    for dimension in np.argsort(-np.asarray(costs), kind="stable"):
+        rank = np.unique(settings[:, dimension], return_inverse=True)[1].ravel()
+        keys.append(np.where(group % 2 == 0, rank, -rank))
+
+        # the index of the loop iteration each setting is in, counted in sweep order
+        group = np.unique(np.stack(keys, axis=1), axis=0, return_inverse=True)[1]
+        group = group.ravel()
+
+    return settings[np.lexsort(keys[::-1])]
+
+
+def estimate_sweep_time(
+    settings: np.ndarray,
+    voltage_settle_time: float = VOLTAGE_SETTLE_TIME,
+    aperture_settle_time: float = APERTURE_SETTLE_TIME,
+) -> float:
+    """Estimates the time in seconds a sweep in the given order spends waiting for the settings to settle
+
+    Args:
+        settings (Nx3 Array): The settings as (voltage, aperture, exposure) in sweep order
+        voltage_settle_time (float, optional): The time after a voltage change. Defaults to VOLTAGE_SETTLE_TIME.
+        aperture_settle_time (float, optional): The time after an aperture change. Defaults to APERTURE_SETTLE_TIME.
+
+    Returns:
+        float: The time in seconds
+    """
+    settings = np.asarray(settings, dtype=np.float64)
+    if len(settings) == 0:
+        return 0.0
+
+    changed = np.ones((len(settings), 3), dtype=bool)
+    changed[1:] = settings[1:] != settings[:-1]
+
+    settle_times = get_exposure_settle_time(settings[:, 2])
+    settle_times = np.maximum(settle_times, changed[:, 0] * voltage_settle_time)
+    settle_times = np.maximum(settle_times, changed[:, 1] * aperture_settle_time)
+    return float(settle_times.sum())
@@ -1,37 +1,77 @@
 import cv2
 import numpy as np
 
+from .transform_functions import create_stage_to_overview_transform
+
 
 def mark_on_overview(
     overview_image,
     motor_pos,
+    x_offset: float,
+    y_offset: float,
     flake_number: int = None,
     x_motor_range: float = 105,
     y_motor_range: float = 103.333,
-    x_offset: float = 2.6121,
-    y_offset: float = 1.1672,
 ):
+    return mark_all_on_overview(
+        overview_image,
+        [motor_pos],
+        x_offset,
+        y_offset,
+        flake_numbers=None if flake_number is None else [flake_number],
+        x_motor_range=x_motor_range,
+        y_motor_range=y_motor_range,
+    )
+
+
+def mark_all_on_overview(
+    overview_image,
+    motor_positions,
+    x_offset: float,
+    y_offset: float,
+    flake_numbers: list = None,
+    x_motor_range: float = 105,
+    y_motor_range: float = 103.333,
+):
+    """Marks all the motor positions on a single copy of the overview image
+
+    Args:
+        overview_image (NxMx3 Array): The overview image
+        motor_positions (List[Tuple[float, float]]): The motor positions in mm
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        flake_numbers (list, optional): A label for each position. Defaults to None.
+
+    Returns:
+        (NxMx3 Array): The marked copy of the overview image
+    """
     overview_copy = overview_image.copy()
 
-    picture_coords = np.array(
-        [
-            int((motor_pos[0] + x_offset) * overview_copy.shape[0] / x_motor_range),
-            int((motor_pos[1] + y_offset) * overview_copy.shape[1] / y_motor_range),
-        ]
+    # the x axis of the stage runs along the width of the overview
+    stage_to_overview = create_stage_to_overview_transform(
+        overview_copy.shape,
+        x_offset=x_offset,
+        y_offset=y_offset,
+        x_motor_range=x_motor_range,
+        y_motor_range=y_motor_range,
     )
+    all_picture_coords = stage_to_overview(
+        np.reshape(np.asarray(motor_positions, dtype=np.float64), (-1, 2))
+    ).astype(int)
 
-    cv2.circle(overview_copy, picture_coords, 20, [0, 255, 0], thickness=3)
+    for idx, picture_coords in enumerate(all_picture_coords.tolist()):
+        cv2.circle(overview_copy, picture_coords, 20, [0, 255, 0], thickness=3)
 
-    if flake_number is not None:
-        cv2.putText(
-            overview_copy,
-            str(flake_number),
-            picture_coords,
-            cv2.FONT_HERSHEY_DUPLEX,
-            0.7,
-            [0, 0, 255],
-            thickness=2,
-        )
+        if flake_numbers is not None:
+            cv2.putText(
+                overview_copy,
+                str(flake_numbers[idx]),
+                picture_coords,
+                cv2.FONT_HERSHEY_DUPLEX,
+                0.7,
+                [0, 0, 255],
+                thickness=2,
+            )
 
     return overview_copy
 
@@ -59,6 +99,8 @@ def mark_flake(image, flake_mask):
 
     rotated_rect = cv2.minAreaRect(flake_countour)
     points = cv2.boxPoints(rotated_rect)
-    marked_image = cv2.polylines(marked_image, [np.int0(points)], True, (0, 255, 0), 2)
+    marked_image = cv2.polylines(
+        marked_image, [points.astype(np.int32)], True, (0, 255, 0), 2
+    )
 
     return marked_image
@@ -0,0 +1,143 @@
+"""
+Compact flake masks, the mask is cropped to its bounding box and run length encoded
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+from numba import jit, prange
+
+from .codec_functions import write_image
+from .catalog_functions import FlakeCatalog
+
+
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
+def _count_transitions(crop):
+    # the pixel before the first pixel is treated as background
+    row_counts = np.zeros(crop.shape[0], dtype=np.int64)
+    for i in prange(crop.shape[0]):
+        previous = crop[i - 1, crop.shape[1] - 1] if i > 0 else 0
+        count = 0
+        for j in range(crop.shape[1]):
+            if crop[i, j] != previous:
+                count += 1
+            previous = crop[i, j]
+        row_counts[i] = count
+    return row_counts
+
+
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
+def _write_transitions(crop, row_offsets, transitions):
+    width = crop.shape[1]
+    for i in prange(crop.shape[0]):
+        previous = crop[i - 1, width - 1] if i > 0 else 0
+        index = row_offsets[i]
+        for j in range(width):
+            if crop[i, j] != previous:
+                transitions[index] = i * width + j
+                index += 1
+            previous = crop[i, j]
+
+
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
+def _fill_runs(run_starts, run_lengths, flat_crop):
+    # every second run is foreground, starting with the second one
+    for run_index in prange(run_lengths.shape[0] // 2):
+        start = run_starts[2 * run_index + 1]
+        for k in range(run_lengths[2 * run_index + 1]):
+            flat_crop[start + k] = 255
+
+
+def encode_mask(mask: np.ndarray) -> dict:
+    """Encodes a flake mask as its bounding box and the run lengths of the cropped mask\n
+    The runs are in row major order and alternate between background and foreground, starting with background.
+
+    Args:
+        mask (NxM Array): The mask of the flake, every non zero pixel belongs to the flake
+
+    Returns:
+        dict: The encoded mask with the keys\\n
+        'shape' : the height and width of the full mask\\n
+        'bbox' : x, y, width and height of the bounding box\\n
+        'counts' : the run lengths
+    """
+    mask = (mask != 0).astype(np.uint8)
+    x, y, width, height = cv2.boundingRect(mask)
+    crop = np.ascontiguousarray(mask[y : y + height, x : x + width])
+
+    row_counts = _count_transitions(crop)
+    row_offsets = np.zeros(len(row_counts), dtype=np.int64)
+    row_offsets[1:] = np.cumsum(row_counts)[:-1]
+    transitions = np.empty(row_counts.sum(), dtype=np.int64)
+    _write_transitions(crop, row_offsets, transitions)
+
+    counts = np.diff(np.concatenate(([0], transitions, [crop.size])))
+
+    return {
+        "shape": [int(mask.shape[0]), int(mask.shape[1])],
+        "bbox": [int(x), int(y), int(width), int(height)],
+        "counts": counts.tolist(),
+    }
+
+
+def decode_mask_crop(encoded_mask: dict) -> np.ndarray:
+    """Decodes an encoded mask to the size of its bounding box
+
+    Args:
+        encoded_mask (dict): The mask encoded by `encode_mask`
+
+    Returns:
+        (NxM Array): The cropped mask, flake pixels are 255
+    """
+    _, _, width, height = encoded_mask["bbox"]
+    run_lengths = np.array(encoded_mask["counts"], dtype=np.int64)
+    run_starts = np.zeros(len(run_lengths), dtype=np.int64)
+    run_starts[1:] = np.cumsum(run_lengths)[:-1]
+
+    flat_crop = np.zeros(width * height, dtype=np.uint8)
+    _fill_runs(run_starts, run_lengths, flat_crop)
+    return flat_crop.reshape(height, width)
+
+
+def decode_mask(encoded_mask: dict) -> np.ndarray:
+    """Expands an encoded mask to the full frame
+
+    Args:
+        encoded_mask (dict): The mask encoded by `encode_mask`
+
+    Returns:
+        (NxM Array): The full mask, flake pixels are 255
+    """
+    x, y, width, height = encoded_mask["bbox"]
+    mask = np.zeros(encoded_mask["shape"], dtype=np.uint8)
+    mask[y : y + height, x : x + width] = decode_mask_crop(encoded_mask)
+    return mask
+
+
+def export_flake_masks(scan_directory: str, overwrite: bool = False) -> int:
+    """Writes the full frame flake_mask.png into each flake directory of a scan from the encoded mask in its metadata
+
+    Args:
+        scan_directory (str): The directory of the scan
+        overwrite (bool, optional): Whether existing mask images are written again. Defaults to False.
+
+    Returns:
+        int: The number of written masks
+    """
+    num_written = 0
+    for flake_directory in FlakeCatalog(scan_directory).walk_flake_directories():
+        mask_path = os.path.join(flake_directory, "flake_mask.png")
+        if os.path.exists(mask_path) and not overwrite:
+            continue
+
+        with open(os.path.join(flake_directory, "meta.json"), "r") as f:
+            meta_data = json.load(f)
+
+        if "mask" not in meta_data:
+            continue
+
+        write_image(mask_path, decode_mask(meta_data["mask"]), "mask")
+        num_written += 1
+
+    return num_written
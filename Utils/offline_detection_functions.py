@@ -0,0 +1,455 @@
+"""
+A collection of helper functions to run the detection on an already recorded dataset using multiple processes
+"""
+import itertools
+import multiprocessing
+import os
+from typing import Dict, Generator, List, Optional, Tuple
+
+import cv2
+import numba
+import numpy as np
+from GMMDetector import MaterialDetector
+from skimage.morphology import disk
+
+from .cache_functions import (
+    DetectionCache,
+    create_entry_key,
+    hash_array,
+    hash_bytes,
+    hash_parameters,
+    load_cache_entry,
+    save_cache_entry,
+)
+from .codec_functions import write_image
+from .mask_functions import decode_mask, encode_mask
+from .prefilter_functions import EmptyTilePrefilter
+from .preprocessor_functions import remove_vignette_fast
+
+# Each worker process owns its own detector, created once by the initializer
+_worker_state = {}
+
+# Each sweep worker owns one detector per configuration of the grid
+_sweep_worker_state = {}
+
+
+def _get_prefilter_kwargs(detector_kwargs: dict) -> dict:
+    """The keyword arguments of the EmptyTilePrefilter besides the contrast_dict, it uses the same threshold and channels as the detector"""
+    return {
+        "standard_deviation_threshold": detector_kwargs["standard_deviation_threshold"],
+        "used_channels": detector_kwargs.get("used_channels", "BGR"),
+    }
+
+
+def _initialize_worker(
+    contrast_params: dict,
+    flatfield: np.ndarray,
+    detector_kwargs: dict,
+    confidence_threshold: float,
+    use_prefilter: bool,
+    marked_image_directory: str,
+    cache_directory: str,
+    flatfield_hash: str,
+    parameter_hash: str,
+):
+    # one process per core, so opencv and the numba kernels should not spawn threads of their own
+    cv2.setNumThreads(1)
+    numba.set_num_threads(1)
+
+    _worker_state["model"] = MaterialDetector(
+        contrast_dict=contrast_params,
+        **detector_kwargs,
+    )
+    _worker_state["prefilter"] = None
+    if use_prefilter:
+        _worker_state["prefilter"] = EmptyTilePrefilter(
+            contrast_dict=contrast_params,
+            **_get_prefilter_kwargs(detector_kwargs),
+        )
+    _worker_state["flatfield"] = flatfield
+    _worker_state["flatfield_mean"] = np.array(cv2.mean(flatfield)[:-1])
+    _worker_state["confidence_threshold"] = confidence_threshold
+    _worker_state["marked_image_directory"] = marked_image_directory
+    _worker_state["cache_directory"] = cache_directory
+    _worker_state["flatfield_hash"] = flatfield_hash
+    _worker_state["parameter_hash"] = parameter_hash
+
+
+def mark_detected_flakes(image, flake_dicts) -> np.ndarray:
+    """Draws the outline and the thickness of each flake onto the image
+
+    Args:
+        image (NxMx3 Array): The image, it is modified in place
+        flake_dicts (List[dict]): The dicts of the flakes to mark with the encoded masks
+
+    Returns:
+        (NxMx3 Array): The marked image
+    """
+    for flake_dict in flake_dicts:
+        outline_flake = cv2.morphologyEx(
+            decode_mask(flake_dict["mask"]),
+            cv2.MORPH_GRADIENT,
+            disk(1),
+        )
+        image[outline_flake != 0] = [0, 0, 255]
+
+        cv2.putText(
+            image,
+            f"{flake_dict['thickness']}",
+            tuple(int(coordinate) for coordinate in flake_dict["center"]),
+            cv2.FONT_HERSHEY_SIMPLEX,
+            thickness=1,
+            fontScale=1,
+            color=(0, 0, 0),
+        )
+    return image
+
+
+def _read_corrected_image(image_path: str, image_bytes: bytes = None) -> np.ndarray:
+    if image_bytes is None:
+        image = cv2.imread(image_path)
+    else:
+        image = cv2.imdecode(np.frombuffer(image_bytes, np.uint8), cv2.IMREAD_COLOR)
+
+    return remove_vignette_fast(
+        image,
+        _worker_state["flatfield"],
+        flatfield_mean=_worker_state["flatfield_mean"],
+    )
+
+
+def _detect_image(
+    task: Tuple[str, Optional[str]],
+) -> Tuple[List[dict], Optional[str], Optional[str], Optional[int]]:
+    image_path, image_hash = task
+    cache_directory = _worker_state["cache_directory"]
+
+    image = None
+    image_bytes = None
+    entry_key = None
+    entry_size = None
+    flake_dicts = None
+
+    if cache_directory is not None:
+        # the file is only read once, the same bytes are hashed and decoded
+        if image_hash is None:
+            with open(image_path, "rb") as f:
+                image_bytes = f.read()
+            image_hash = hash_bytes(image_bytes)
+
+        entry_key = create_entry_key(
+            image_hash,
+            _worker_state["flatfield_hash"],
+            _worker_state["parameter_hash"],
+        )
+        entry_path = os.path.join(cache_directory, f"{entry_key}.json")
+        flake_dicts = load_cache_entry(entry_path)
+        if flake_dicts is not None:
+            entry_size = os.path.getsize(entry_path)
+
+    if flake_dicts is None:
+        image = _read_corrected_image(image_path, image_bytes)
+
+        flake_dicts = []
+        prefilter = _worker_state["prefilter"]
+        if prefilter is None or prefilter(image):
+            for flake in _worker_state["model"](image):
+                flake_dict = flake.to_dict()
+                flake_dict["mask"] = encode_mask(flake.mask)
+                flake_dicts.append(flake_dict)
+
+        # all flakes are cached, the confidence threshold is applied afterwards
+        if cache_directory is not None:
+            entry_size = save_cache_entry(entry_path, flake_dicts)
+
+    flake_dicts = [
+        flake_dict
+        for flake_dict in flake_dicts
+        if 1 - flake_dict["false_positive_probability"]
+        >= _worker_state["confidence_threshold"]
+    ]
+
+    # the marked images are written by the workers, so the disk I/O runs in parallel as well
+    if len(flake_dicts) != 0 and _worker_state["marked_image_directory"]:
+        if image is None:
+            image = _read_corrected_image(image_path)
+        marked_image = mark_detected_flakes(image, flake_dicts)
+        write_image(
+            os.path.join(
+                _worker_state["marked_image_directory"],
+                os.path.basename(image_path),
+            ),
+            marked_image,
+            "eval_image",
+        )
+
+    return flake_dicts, image_hash, entry_key, entry_size
+
+
+def run_offline_detection(
+    image_paths: List[str],
+    contrast_params: dict,
+    flatfield: np.ndarray,
+    detector_kwargs: dict,
+    confidence_threshold: float = 0.5,
+    use_prefilter: bool = False,
+    marked_image_directory: str = None,
+    num_processes: int = None,
+    chunksize: int = 4,
+    cache: DetectionCache = None,
+) -> Generator[Tuple[int, List[dict]], None, None]:
+    """Runs the detection on the given images with a pool of worker processes\\
+    The images are read and corrected inside the workers, the pool always works ahead of the consumer.
+    The results are yielded in the order of the image paths.
+    If a cache is given, images which were already detected with the same flatfield and parameters are not detected again.
+
+    Args:
+        image_paths (List[str]): The paths to the images
+        contrast_params (dict): The GMM contrast parameters
+        flatfield (NxMx3 Array): The flatfield used to correct the images
+        detector_kwargs (dict): The keyword arguments of the MaterialDetector besides the contrast_dict
+        confidence_threshold (float, optional): Minimum confidence for a flake to be detected. Defaults to 0.5.
+        use_prefilter (bool, optional): Skip the detection on images without any candidate pixel. Defaults to False.
+        marked_image_directory (str, optional): If given, images with flakes are saved there with the flakes marked. Defaults to None.
+        num_processes (int, optional): The number of worker processes. Defaults to the number of cores.
+        chunksize (int, optional): The number of images sent to a worker at once. Defaults to 4.
+        cache (DetectionCache, optional): The cache of previous detection results. Defaults to None.
+
+    Yields:
+        Tuple (int, List[dict]): The index of the image and the dicts of the detected flakes with the encoded masks
+    """
+    if num_processes is None:
+        num_processes = os.cpu_count()
+
+    cache_directory = None
+    flatfield_hash = None
+    parameter_hash = None
+    tasks = [(image_path, None) for image_path in image_paths]
+    if cache is not None:
+        cache_directory = cache.cache_directory
+        flatfield_hash = hash_array(flatfield)
+        parameter_hash = hash_parameters(
+            {
+                "contrast_params": contrast_params,
+                "detector_kwargs": detector_kwargs,
+                "use_prefilter": use_prefilter,
+                "prefilter_kwargs": (
+                    _get_prefilter_kwargs(detector_kwargs) if use_prefilter else None
+                ),
+            }
+        )
+        # unchanged files are recognized by their size and modification time and are not hashed again
+        tasks = [
+            (image_path, cache.lookup_file_hash(image_path))
+            for image_path in image_paths
+        ]
+
+    try:
+        with multiprocessing.Pool(
+            processes=num_processes,
+            initializer=_initialize_worker,
+            initargs=(
+                contrast_params,
+                flatfield,
+                detector_kwargs,
+                confidence_threshold,
+                use_prefilter,
+                marked_image_directory,
+                cache_directory,
+                flatfield_hash,
+                parameter_hash,
+            ),
+        ) as pool:
+            for image_index, result in enumerate(
+                pool.imap(_detect_image, tasks, chunksize=chunksize)
+            ):
+                flake_dicts, image_hash, entry_key, entry_size = result
+
+                if cache is not None:
+                    cache.remember_file_hash(image_paths[image_index], image_hash)
+                    cache.touch(entry_key, entry_size)
+
+                yield image_index, flake_dicts
+    finally:
+        # the index is also saved if the consumer stops early
+        if cache is not None:
+            cache.save()
+
+
+def create_detector_grid(
+    size_thresholds: List[int],
+    standard_deviation_thresholds: List[float],
+    used_channels: List[str],
+) -> List[dict]:
+    """Creates every combination of the given detector parameters
+
+    Args:
+        size_thresholds (List[int]): The size thresholds in pixels
+        standard_deviation_thresholds (List[float]): The standard deviation thresholds
+        used_channels (List[str]): The used channels, e.g. "BGR" or "GR"
+
+    Returns:
+        List[dict]: The keyword arguments of the MaterialDetector for each combination
+    """
+    return [
+        {
+            "size_threshold": size_threshold,
+            "standard_deviation_threshold": standard_deviation_threshold,
+            "used_channels": channels,
+        }
+        for size_threshold, standard_deviation_threshold, channels in itertools.product(
+            size_thresholds, standard_deviation_thresholds, used_channels
+        )
+    ]
+
+
+def _initialize_sweep_worker(
+    contrast_params: dict,
+    flatfield: np.ndarray,
+    detector_grid: List[dict],
+    use_prefilter: bool,
+):
+    cv2.setNumThreads(1)
+    numba.set_num_threads(1)
+
+    _sweep_worker_state["models"] = [
+        MaterialDetector(contrast_dict=contrast_params, **detector_kwargs)
+        for detector_kwargs in detector_grid
+    ]
+
+    # configurations with the same threshold and channels share one prefilter
+    _sweep_worker_state["prefilter_keys"] = [
+        (
+            detector_kwargs["standard_deviation_threshold"],
+            detector_kwargs.get("used_channels", "BGR"),
+        )
+        for detector_kwargs in detector_grid
+    ]
+    _sweep_worker_state["prefilters"] = {}
+    if use_prefilter:
+        _sweep_worker_state["prefilters"] = {
+            key: EmptyTilePrefilter(
+                contrast_dict=contrast_params,
+                standard_deviation_threshold=key[0],
+                used_channels=key[1],
+            )
+            for key in set(_sweep_worker_state["prefilter_keys"])
+        }
+    _sweep_worker_state["flatfield"] = flatfield
+    _sweep_worker_state["flatfield_mean"] = np.array(cv2.mean(flatfield)[:-1])
+
+
+def _sweep_image(image_path: str) -> List[List[Tuple[str, float]]]:
+    image = cv2.imread(image_path)
+    image = remove_vignette_fast(
+        image,
+        _sweep_worker_state["flatfield"],
+        flatfield_mean=_sweep_worker_state["flatfield_mean"],
+    )
+
+    prefilter_results = {
+        key: prefilter(image)
+        for key, prefilter in _sweep_worker_state["prefilters"].items()
+    }
+
+    # only the thickness and the confidence are sent back, the masks are not needed for the statistics
+    results = []
+    for model, prefilter_key in zip(
+        _sweep_worker_state["models"], _sweep_worker_state["prefilter_keys"]
+    ):
+        if not prefilter_results.get(prefilter_key, True):
+            results.append([])
+            continue
+
+        results.append(
+            [
+                (str(flake.thickness), 1 - flake.false_positive_probability)
+                for flake in model(image)
+            ]
+        )
+    return results
+
+
+def run_parameter_sweep(
+    image_paths: List[str],
+    contrast_params: dict,
+    flatfield: np.ndarray,
+    detector_grid: List[dict],
+    use_prefilter: bool = False,
+    num_processes: int = None,
+    chunksize: int = 4,
+) -> Generator[Tuple[int, List[List[Tuple[str, float]]]], None, None]:
+    """Runs every detector configuration of the grid on the given images with a pool of worker processes\\
+    Each image is read and flatfield corrected only once, all configurations are evaluated on the same corrected image.
+
+    Args:
+        image_paths (List[str]): The paths to the images
+        contrast_params (dict): The GMM contrast parameters
+        flatfield (NxMx3 Array): The flatfield used to correct the images
+        detector_grid (List[dict]): The keyword arguments of the MaterialDetector for each configuration
+        use_prefilter (bool, optional): Skip the detection on images without any candidate pixel. Defaults to False.
+        num_processes (int, optional): The number of worker processes. Defaults to the number of cores.
+        chunksize (int, optional): The number of images sent to a worker at once. Defaults to 4.
+
+    Yields:
+        Tuple (int, List[List[Tuple[str, float]]]): The index of the image and for each configuration the thickness and confidence of the detected flakes
+    """
+    if num_processes is None:
+        num_processes = os.cpu_count()
+
+    with multiprocessing.Pool(
+        processes=num_processes,
+        initializer=_initialize_sweep_worker,
+        initargs=(contrast_params, flatfield, detector_grid, use_prefilter),
+    ) as pool:
+        for image_index, results in enumerate(
+            pool.imap(_sweep_image, image_paths, chunksize=chunksize)
+        ):
+            yield image_index, results
+
+
+def summarize_parameter_sweep(
+    sweep_results: Dict[int, List[List[Tuple[str, float]]]],
+    num_configurations: int,
+    confidence_thresholds: List[float],
+    thickness_classes: List[str],
+) -> List[dict]:
+    """Counts the detected flakes for each configuration and confidence threshold
+
+    Args:
+        sweep_results (Dict[int, List[List[Tuple[str, float]]]]): The results of the sweep by image index
+        num_configurations (int): The number of configurations in the grid
+        confidence_thresholds (List[float]): The confidence thresholds to evaluate, they are applied after the detection
+        thickness_classes (List[str]): The thickness classes of the contrast parameters
+
+    Returns:
+        List[dict]: One row per configuration and confidence threshold with the keys\\
+        "configuration", "confidence_threshold", "images_with_flakes", "flakes" and the count of each thickness class
+    """
+    rows = []
+    for configuration_index in range(num_configurations):
+        for confidence_threshold in confidence_thresholds:
+            row = {
+                "configuration": configuration_index,
+                "confidence_threshold": confidence_threshold,
+                "images_with_flakes": 0,
+                "flakes": 0,
+            }
+            row.update({thickness: 0 for thickness in thickness_classes})
+
+            for results in sweep_results.values():
+                confident_flakes = [
+                    thickness
+                    for thickness, confidence in results[configuration_index]
+                    if confidence >= confidence_threshold
+                ]
+                if len(confident_flakes) == 0:
+                    continue
+
+                row["images_with_flakes"] += 1
+                row["flakes"] += len(confident_flakes)
+                for thickness in confident_flakes:
+                    row[thickness] = row.get(thickness, 0) + 1
+
+            rows.append(row)
+    return rows
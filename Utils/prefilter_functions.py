@@ -0,0 +1,111 @@
+"""
+A cheap check run before the detection, to skip images which only show bare substrate
+"""
+
+import numpy as np
+
+CHANNEL_INDICES = {"B": 0, "G": 1, "R": 2}
+
+
+class EmptyTilePrefilter:
+    """A conservative color gate derived from the GMM contrast parameters\n
+    Checks a strided subset of the pixels against the same Mahalanobis threshold the detector uses, widened by a margin.
+    If no checked pixel could belong to any class, the detector can not find a flake and the image can be skipped.
+    """
+
+    def __init__(
+        self,
+        contrast_dict: dict,
+        standard_deviation_threshold: float,
+        used_channels: str = "BGR",
+        stride: int = 8,
+        contrast_margin: float = 0.01,
+        min_candidate_pixels: int = 1,
+    ):
+        """
+        Args:
+            contrast_dict (dict): The GMM contrast parameters as loaded from the GMM_Parameters
+            standard_deviation_threshold (float): The maximum Mahalanobis distance used by the detector
+            used_channels (str, optional): The channels which are used for the detection. Defaults to "BGR".
+            stride (int, optional): Only every n-th pixel in x and y is checked. Defaults to 8.
+            contrast_margin (float, optional): The maximum error of the background estimation per channel in contrast. Defaults to 0.01.
+            min_candidate_pixels (int, optional): The number of checked pixels which need to match a class to run the detection. Defaults to 1.
+        """
+        self.stride = stride
+        self.min_candidate_pixels = min_candidate_pixels
+        self.channels = [CHANNEL_INDICES[channel] for channel in used_channels.upper()]
+
+        self.class_means = []
+        self.class_inverse_covariances = []
+        self.class_thresholds = []
+        for class_parameters in contrast_dict.values():
+            contrast = np.array(
+                [
+                    class_parameters["contrast"]["b"],
+                    class_parameters["contrast"]["g"],
+                    class_parameters["contrast"]["r"],
+                ]
+            )[self.channels]
+            covariance_matrix = np.array(class_parameters["covariance_matrix"])[
+                np.ix_(self.channels, self.channels)
+            ]
+
+            # An error of the background shifts the Mahalanobis distance by at most
+            # the euclidean length of the error divided by the smallest standard deviation
+            smallest_standard_deviation = np.sqrt(
+                np.linalg.eigvalsh(covariance_matrix)[0]
+            )
+            threshold = (
+                standard_deviation_threshold
+                + contrast_margin
+                * np.sqrt(len(self.channels))
+                / smallest_standard_deviation
+            )
+
+            self.class_means.append(contrast.astype(np.float32))
+            self.class_inverse_covariances.append(
+                np.linalg.inv(covariance_matrix).astype(np.float32)
+            )
+            self.class_thresholds.append(threshold**2)
+
+    def count_candidate_pixels(self, image) -> int:
+        """Counts the checked pixels which could belong to any class
+
+        Args:
+            image (NxMx3 Array): The flatfield corrected image
+
+        Returns:
+            int: The number of candidate pixels in the strided image
+        """
+        strided_image = image[:: self.stride, :: self.stride]
+        pixels = strided_image.reshape(-1, image.shape[2])[:, self.channels]
+        pixels = pixels.astype(np.float32)
+
+        # the substrate covers most of the image, the median is a robust estimate
+        background = np.median(pixels, axis=0)
+        contrast = pixels / np.maximum(background, 1) - 1
+
+        is_candidate = np.zeros(len(contrast), dtype=bool)
+        for mean, inverse_covariance, threshold in zip(
+            self.class_means,
+            self.class_inverse_covariances,
+            self.class_thresholds,
+        ):
+            difference = contrast - mean
+            squared_distance = np.einsum(
+                "ij,jk,ik->i", difference, inverse_covariance, difference
+            )
+            is_candidate |= squared_distance <= threshold
+
+        return int(np.count_nonzero(is_candidate))
+
+    def __call__(self, image) -> bool:
+        """Checks if the image could contain a flake
+
+        Args:
+            image (NxMx3 Array): The flatfield corrected image
+
+        Returns:
+            bool: False if the image certainly contains no flake and the detection can be skipped
+        """
+        return self.count_candidate_pixels(image) >= self.min_candidate_pixels
@@ -2,6 +2,14 @@ import cv2
 import numpy as np
 from numba import jit, prange
 
+# OpenCV names the Bayer conversions after the second row of the pattern
+BAYER_CONVERSION_CODES = {
+    "RGGB": cv2.COLOR_BayerBG2BGR,
+    "BGGR": cv2.COLOR_BayerRG2BGR,
+    "GRBG": cv2.COLOR_BayerGB2BGR,
+    "GBRG": cv2.COLOR_BayerGR2BGR,
+}
+
 
 def remove_vignette_legacy(image, flatfield):
     """Removes the Vignette from the Image
@@ -37,7 +45,7 @@ def remove_vignette_legacy(image, flatfield):
     return image_no_vigentte
 
 
-@jit(nopython=True, parallel=True, fastmath=True, nogil=True)
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
 def remove_vignette_fast(
     image,
     flatfield,
@@ -65,3 +73,181 @@ def remove_vignette_fast(
                 image_no_vigentte[i, j, k] = val
 
     return image_no_vigentte
+
+
+class BufferPool:
+    """A small ring of preallocated image buffers\n
+    Hands out the buffers in a round robin fashion, so a buffer is only reused after `size` other requests.
+    Used to avoid allocating a new full frame for every tile.
+    """
+
+    def __init__(self, size: int = 2):
+        self.size = size
+        self._buffers = {}
+        self._index = {}
+
+    def get(self, shape, dtype=np.uint8):
+        """Returns a buffer with the given shape and dtype, the content is undefined
+
+        Args:
+            shape (tuple): The shape of the buffer
+            dtype (np.dtype, optional): The dtype of the buffer. Defaults to np.uint8.
+
+        Returns:
+            (NxMx3 Array): A preallocated buffer
+        """
+        key = (tuple(shape), np.dtype(dtype).str)
+        if key not in self._buffers:
+            self._buffers[key] = [
+                np.empty(shape, dtype=dtype) for _ in range(self.size)
+            ]
+            self._index[key] = 0
+
+        buffer = self._buffers[key][self._index[key]]
+        self._index[key] = (self._index[key] + 1) % self.size
+        return buffer
+
+
+def compute_flatfield_gain(flatfield):
+    """Precomputes the per pixel gain of a flatfield, so the correction becomes a single multiplication
+
+    Args:
+        flatfield (NxMx3 Array): the Flat Field in RGB
+
+    Returns:
+        (NxMx3 Array): The gain as float32, flatfield_mean / flatfield
+    """
+    flatfield_mean = np.array(cv2.mean(flatfield)[:-1], dtype=np.float32)
+    # guard against dead pixels in the flatfield
+    return flatfield_mean / np.maximum(flatfield, 1).astype(np.float32)
+
+
+@jit(nopython=True, parallel=True, fastmath=True, nogil=True, cache=True)
+def _ingest_kernel(
+    raw_image,
+    null_values,
+    flatfield_gain,
+    max_background_value,
+    corrected_image,
+    preview_image,
+    preview_step,
+):
+    height = raw_image.shape[0]
+    for i in prange(height):
+        # the raw buffer of the camera is upside down
+        source_row = height - 1 - i
+        for j in range(raw_image.shape[1]):
+            for k in range(raw_image.shape[2]):
+                val = int(raw_image[source_row, j, k]) - int(null_values[k])
+                if val < 0:
+                    val = 0
+                val = int(val * flatfield_gain[i, j, k])
+                if val > max_background_value:
+                    val = max_background_value
+                corrected_image[i, j, k] = val
+
+                if preview_step > 0 and i % preview_step == 0 and j % preview_step == 0:
+                    preview_image[i // preview_step, j // preview_step, k] = val
+
+
+def ingest_image(
+    raw_image,
+    null_values,
+    flatfield_gain,
+    out=None,
+    preview_step: int = 0,
+    preview_out=None,
+    max_background_value: int = 241,
+):
+    """Turns a raw camera buffer into a flatfield corrected image in a single pass\n
+    Flips the image, subtracts the dark level and applies the flatfield gain.
+    Yields the same result as `cv2.flip`, `cv2.subtract` and `remove_vignette_fast` in sequence.
+
+    Args:
+        raw_image (NxMx3 Array): The raw image as returned by `get_raw_image`
+        null_values (3 Array): The dark level of the camera in BGR
+        flatfield_gain (NxMx3 Array): The gain as returned by `compute_flatfield_gain`
+        out (NxMx3 Array, optional): The buffer to write the corrected image into, e.g. from a `BufferPool`. Defaults to None.
+        preview_step (int, optional): Emits a preview which is downsampled by this factor, 0 means no preview. Defaults to 0.
+        preview_out (NxMx3 Array, optional): The buffer to write the preview into. Defaults to None.
+        max_background_value (int, optional): the maximum value of the background. Defaults to 241.
+
+    Returns:
+        (NxMx3 Array, NxMx3 Array): The corrected image and the preview, the preview is None if no preview is requested
+    """
+    if out is None:
+        out = np.empty(raw_image.shape, dtype=np.uint8)
+
+    if preview_step > 0:
+        preview_shape = (
+            -(-raw_image.shape[0] // preview_step),
+            -(-raw_image.shape[1] // preview_step),
+            raw_image.shape[2],
+        )
+        if preview_out is None:
+            preview_out = np.empty(preview_shape, dtype=np.uint8)
+        preview = preview_out
+    else:
+        preview = np.empty((1, 1, raw_image.shape[2]), dtype=np.uint8)
+
+    _ingest_kernel(
+        raw_image,
+        np.asarray(null_values, dtype=np.uint8),
+        flatfield_gain,
+        max_background_value,
+        out,
+        preview,
+        preview_step,
+    )
+
+    return out, (preview_out if preview_step > 0 else None)
+
+
+def restore_image(raw_image, null_values):
+    """Turns a raw camera buffer into the image returned by `get_image`, i.e. flipped and without the dark level
+
+    Args:
+        raw_image (NxMx3 Array): The raw image as returned by `get_raw_image`
+        null_values (3 Array): The dark level of the camera in BGR
+
+    Returns:
+        (NxMx3 Array): The uncorrected image
+    """
+    null_image = np.full(
+        raw_image.shape, np.asarray(null_values, dtype=np.uint8), dtype=np.uint8
+    )
+    return cv2.subtract(cv2.flip(raw_image, 0), null_image)
+
+
+def create_white_balance_lut(white_balance):
+    """Creates the lookup table which applies a white balance to a demosaiced image
+
+    Args:
+        white_balance (tuple): The RGB white balance like the camera property, 64 is a gain of 1
+
+    Returns:
+        (256x1x3 Array): The lookup table in BGR for `cv2.LUT`
+    """
+    gains = np.array(white_balance[::-1], dtype=np.float32) / 64
+    values = np.arange(256, dtype=np.float32)[:, None] * gains[None, :]
+    return np.clip(np.round(values), 0, 255).astype(np.uint8).reshape(256, 1, 3)
+
+
+def demosaic_image(bayer_image, bayer_pattern: str, white_balance_lut=None, out=None):
+    """Interpolates the full color image of a raw 8 bit Bayer frame\n
+    Receiving the raw frame transfers a third of the data of an RGB frame, the interpolation takes a few milliseconds on the host.
+
+    Args:
+        bayer_image (NxM or NxMx1 Array): The raw frame of the sensor
+        bayer_pattern (str): The color filters of the top left 2x2 pixels of the frame, e.g. "RGGB"
+        white_balance_lut (256x1x3 Array, optional): The lookup table from `create_white_balance_lut`, None keeps the raw colors. Defaults to None.
+        out (NxMx3 Array, optional): The buffer to write the color image into. Defaults to None.
+
+    Returns:
+        (NxMx3 Array): The color image in BGR
+    """
+    bayer_image = bayer_image.reshape(bayer_image.shape[:2])
+    out = cv2.cvtColor(bayer_image, BAYER_CONVERSION_CODES[bayer_pattern], dst=out)
+    if white_balance_lut is not None:
+        cv2.LUT(out, white_balance_lut, dst=out)
+    return out
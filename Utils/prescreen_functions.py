@@ -0,0 +1,307 @@
+"""
+Scores the footprint of every tile in the 2.5x overview, to skip or postpone tiles which most likely contain no flake\n
+Thin flakes are exfoliated together with thick ones, which are visible in the overview as a contrast to the substrate.
+The score is the fraction of the footprint (and its neighbourhood) with such a contrast, its threshold is calibrated on recorded scans for a recall target.
+"""
+import json
+import os
+
+import cv2
+import numpy as np
+
+from Utils.stitcher_functions import get_tile_edges, sum_over_tiles
+from Utils.transform_functions import create_grid_to_stage_transform
+
+# The file with the scores of the tiles with flakes on recorded scans, written by Debug/evaluate_prescreen.py
+CALIBRATION_PATH = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    "Parameters",
+    "prescreen_calibration.json",
+)
+
+
+def compute_contrast_mask(
+    overview_image: np.ndarray,
+    overview_mask: np.ndarray = None,
+    contrast_threshold: float = 0.06,
+    background_downsample: int = 8,
+    background_kernel: int = 21,
+    strip_height: int = 1024,
+) -> np.ndarray:
+    """Marks the pixels of the overview which differ from the surrounding substrate\n
+    The substrate is estimated with a median filter on a downsampled copy, the contrast is computed in strips to limit the memory of the full overview.
+    The edge of the chip is not marked, as the median window of the substrate estimate reaches across it.
+
+    Args:
+        overview_image (NxMx3 Array): The stitched overview
+        overview_mask (NxM Array, optional): The chip mask of the overview, pixels outside and on its edge are never marked. Defaults to None.
+        contrast_threshold (float, optional): The minimum relative difference to the substrate in any channel. Defaults to 0.06.
+        background_downsample (int, optional): The downsampling of the substrate estimate. Defaults to 8.
+        background_kernel (int, optional): The size of the median filter on the downsampled overview, should be larger than the thick flakes. Defaults to 21.
+        strip_height (int, optional): The number of rows processed at once. Defaults to 1024.
+
+    Returns:
+        (NxM Array): 1 where there is a contrast, uint8
+    """
+    height, width = overview_image.shape[:2]
+    small_overview = cv2.resize(
+        overview_image,
+        (
+            max(width // background_downsample, 1),
+            max(height // background_downsample, 1),
+        ),
+        interpolation=cv2.INTER_AREA,
+    )
+    small_background = cv2.medianBlur(small_overview, background_kernel)
+
+    # the minimum absolute difference per pixel of the background, compared in uint8 to stay fast on the full overview
+    small_threshold = np.clip(
+        np.ceil(small_background * contrast_threshold), 1, 255
+    ).astype(np.uint8)
+
+    # only pixels whose whole median window lies on the chip have a valid substrate estimate
+    small_chip_mask = np.ones(small_background.shape[:2], dtype=np.uint8)
+    if overview_mask is not None:
+        small_chip_mask = cv2.resize(
+            overview_mask,
+            small_background.shape[1::-1],
+            interpolation=cv2.INTER_AREA,
+        )
+        small_chip_mask = cv2.erode(
+            (small_chip_mask == 255).astype(np.uint8),
+            np.ones((background_kernel, background_kernel)),
+        )
+
+    # the row of the downsampled background each row of the overview falls into
+    background_rows = np.arange(height) * small_background.shape[0] // height
+
+    contrast_mask = np.zeros((height, width), dtype=np.uint8)
+    for start in range(0, height, strip_height):
+        end = min(start + strip_height, height)
+        background = cv2.resize(
+            small_background[background_rows[start:end]],
+            (width, end - start),
+            interpolation=cv2.INTER_NEAREST,
+        )
+        threshold = cv2.resize(
+            small_threshold[background_rows[start:end]],
+            (width, end - start),
+            interpolation=cv2.INTER_NEAREST,
+        )
+        chip_mask = cv2.resize(
+            small_chip_mask[background_rows[start:end]],
+            (width, end - start),
+            interpolation=cv2.INTER_NEAREST,
+        )
+        difference = cv2.absdiff(overview_image[start:end], background)
+        contrast_mask[start:end] = np.any(difference >= threshold, axis=2) & (
+            chip_mask != 0
+        )
+
+    return contrast_mask
+
+
+def compute_tile_scores(
+    overview_image: np.ndarray,
+    scan_area_map: np.ndarray,
+    x_offset: float,
+    y_offset: float,
+    overview_mask: np.ndarray = None,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    neighbourhood: int = 1,
+    contrast_threshold: float = 0.06,
+    **kwargs,
+) -> np.ndarray:
+    """Scores every tile of the scan area map by the contrast in its footprint in the overview\n
+    The score is the fraction of the footprint with a contrast to the substrate, the maximum over the neighbouring tiles.
+    The neighbourhood keeps tiles next to thick flakes, where the thin flakes usually are.
+
+    Args:
+        overview_image (NxMx3 Array): The full resolution stitched overview
+        scan_area_map (NxM Array): The scan area map
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        overview_mask (NxM Array, optional): The chip mask of the overview. Defaults to None.
+        view_field_x (float, optional): the x View Field of the scanning magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the scanning magnification in mm. Defaults to 0.4613.
+        neighbourhood (int, optional): The radius in tiles of the maximum. Defaults to 1.
+        contrast_threshold (float, optional): The minimum relative difference to the substrate. Defaults to 0.06.
+
+    Returns:
+        (NxM Array): The score of each tile between 0 and 1, 0 outside of the scan area map
+    """
+    contrast_mask = compute_contrast_mask(
+        overview_image,
+        overview_mask=overview_mask,
+        contrast_threshold=contrast_threshold,
+    )
+
+    x_edges, y_edges = get_tile_edges(
+        contrast_mask.shape,
+        view_field_x=view_field_x,
+        view_field_y=view_field_y,
+        x_offset=x_offset,
+        y_offset=y_offset,
+    )
+    contrast_pixels = sum_over_tiles(contrast_mask, x_edges, y_edges)
+    tile_pixels = np.diff(y_edges)[:, np.newaxis] * np.diff(x_edges)[np.newaxis, :]
+    tile_scores = np.divide(
+        contrast_pixels,
+        tile_pixels,
+        out=np.zeros(contrast_pixels.shape),
+        where=tile_pixels != 0,
+    ).astype(np.float32)
+
+    if neighbourhood > 0:
+        kernel_size = 2 * neighbourhood + 1
+        tile_scores = cv2.dilate(tile_scores, np.ones((kernel_size, kernel_size)))
+
+    # the scan area map may be cut to a smaller grid
+    tile_scores = tile_scores[: scan_area_map.shape[0], : scan_area_map.shape[1]]
+    tile_scores[scan_area_map[: tile_scores.shape[0], : tile_scores.shape[1]] == 0] = 0
+    return tile_scores
+
+
+def get_flake_tiles(
+    flake_positions: np.ndarray,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    **kwargs,
+) -> np.ndarray:
+    """The tile indices of the images the flakes were found in
+
+    Args:
+        flake_positions (Nx2 Array): The stage positions of the flakes in mm
+        view_field_x (float, optional): the x View Field of the scanning magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the scanning magnification in mm. Defaults to 0.4613.
+
+    Returns:
+        (Nx2 Array): The (row, column) of each flake
+    """
+    stage_to_grid = create_grid_to_stage_transform(view_field_x, view_field_y).inverse()
+    grid_positions = np.round(stage_to_grid(np.asarray(flake_positions).reshape(-1, 2)))
+    return grid_positions[:, ::-1].astype(int)
+
+
+def get_score_threshold(
+    flake_tile_scores,
+    recall_target: float,
+) -> float:
+    """The highest score threshold which keeps the recall target of the flake tiles
+
+    Args:
+        flake_tile_scores (Array): The scores of the tiles with flakes on recorded scans
+        recall_target (float): The fraction of flakes which should still be found
+
+    Returns:
+        float: The threshold, 0 keeps every tile
+    """
+    flake_tile_scores = np.sort(np.asarray(flake_tile_scores, dtype=np.float64))
+    if len(flake_tile_scores) == 0 or recall_target >= 1:
+        return 0.0
+
+    # the number of flakes which may be lost
+    num_lost = int(np.floor(len(flake_tile_scores) * (1 - recall_target)))
+    return float(flake_tile_scores[num_lost])
+
+
+def load_score_threshold(
+    recall_target: float,
+    calibration_path: str = CALIBRATION_PATH,
+) -> float:
+    """Loads the calibration of recorded scans and returns the threshold for the recall target\n
+    Without a calibration no tile is skipped.
+
+    Args:
+        recall_target (float): The fraction of flakes which should still be found
+        calibration_path (str, optional): The calibration file. Defaults to CALIBRATION_PATH.
+
+    Returns:
+        float: The score threshold
+    """
+    if not os.path.exists(calibration_path):
+        print(
+            f"No prescreen calibration at {calibration_path}, run Debug/evaluate_prescreen.py first. No tile is skipped"
+        )
+        return 0.0
+
+    with open(calibration_path, "r") as f:
+        calibration = json.load(f)
+    return get_score_threshold(calibration["flake_tile_scores"], recall_target)
+
+
+def prescreen_scan_area_map(
+    scan_area_map: np.ndarray,
+    tile_scores: np.ndarray,
+    score_threshold: float,
+) -> np.ndarray:
+    """Removes the tiles below the score threshold from the scan area map
+
+    Args:
+        scan_area_map (NxM Array): The scan area map
+        tile_scores (NxM Array): The scores from compute_tile_scores
+        score_threshold (float): The minimum score of a scanned tile
+
+    Returns:
+        (NxM Array): The thinned scan area map, with the same chip labels
+    """
+    thinned_scan_area_map = scan_area_map.copy()
+    thinned_scan_area_map[tile_scores < score_threshold] = 0
+    return thinned_scan_area_map
+
+
+def prioritize_tiles(
+    scan_area_map: np.ndarray,
+    tile_scores: np.ndarray,
+    num_bands: int = None,
+):
+    """Orders the tiles of the scan area map by decreasing score\n
+    With bands the tiles are split into groups of equal size by their score, each group is scanned in a snake pattern.
+    This keeps most of the gain of the ordering without moving across the whole plate between two tiles.
+
+    Args:
+        scan_area_map (NxM Array): The scan area map
+        tile_scores (NxM Array): The scores from compute_tile_scores
+        num_bands (int, optional): The number of score bands, None orders every tile by its score. Defaults to None.
+
+    Returns:
+        (y_indices, x_indices): The tile indices, the most promising first
+    """
+    y_indices, x_indices = np.nonzero(scan_area_map)
+    order = np.argsort(-tile_scores[y_indices, x_indices], kind="stable")
+    if num_bands is None:
+        return y_indices[order], x_indices[order]
+
+    # the band of each tile by the rank of its score
+    bands = np.empty(len(order), dtype=int)
+    bands[order] = np.arange(len(order)) * num_bands // max(len(order), 1)
+
+    snake_order = np.lexsort(
+        (np.where(y_indices % 2 == 1, -x_indices, x_indices), y_indices, bands)
+    )
+    return y_indices[snake_order], x_indices[snake_order]
+
+
+def report_prescreen(
+    scan_area_map: np.ndarray,
+    thinned_scan_area_map: np.ndarray,
+    seconds_per_tile: float = 0.5,
+) -> float:
+    """Prints how many tiles the prescreening skips and the estimated time saved
+
+    Args:
+        scan_area_map (NxM Array): The full scan area map
+        thinned_scan_area_map (NxM Array): The scan area map after the prescreening
+        seconds_per_tile (float, optional): The time to move, capture and detect a single tile. Defaults to 0.5.
+
+    Returns:
+        float: The estimated time saved in seconds
+    """
+    num_tiles = np.count_nonzero(scan_area_map)
+    num_kept = np.count_nonzero(thinned_scan_area_map)
+    time_saved = (num_tiles - num_kept) * seconds_per_tile
+    print(
+        f"Prescreening keeps {num_kept} of {num_tiles} tiles ({num_kept / max(num_tiles, 1):.1%}), saving about {time_saved / 60:.1f} min"
+    )
+    return time_saved
@@ -1,3 +1,4 @@
+import itertools
 import json
 import os
 from typing import Type, List, Tuple, Generator, Optional
@@ -13,13 +14,27 @@ from Drivers import (
 from GMMDetector import MaterialDetector
 from GMMDetector.structures import Flake
 
+from .budget_functions import ScanBudget
+from .catalog_functions import FlakeCatalog
 from .etc_functions import (
-    walk_flake_directories,
     set_microscope_and_camera_settings,
     reformat_flake_dict,
 )
 from .marker_functions import mark_on_overview, mark_flake
-from .preprocessor_functions import remove_vignette_fast
+from .codec_functions import ImageWriter, write_image
+from .flatfield_functions import FlatfieldEstimator
+from .flyscan_functions import fly_scan_generator
+from .focus_functions import FocusMap
+from .upload_functions import BackgroundUploader
+from .mask_functions import encode_mask
+from .transform_functions import create_grid_to_stage_transform
+from .prefilter_functions import EmptyTilePrefilter
+from .preprocessor_functions import (
+    BufferPool,
+    compute_flatfield_gain,
+    ingest_image,
+    restore_image,
+)
 import Utils.conversion_functions as conversion
 
 
@@ -43,6 +58,29 @@ def _create_folder_structure(
     return magnification_path, picture_path, meta_path
 
 
+def is_wafer_frame(
+    image: np.ndarray,
+    intensity_threshold: float = 120,
+    min_wafer_fraction: float = 0.05,
+    downsample: int = 8,
+) -> bool:
+    """Classifies a 2.5x frame as wafer or empty plate, the substrate is much brighter than the plate
+
+    Args:
+        image (NxMx3 Array): The 2.5x image
+        intensity_threshold (float, optional): The minimum gray value of the substrate. Defaults to 120.
+        min_wafer_fraction (float, optional): The minimum fraction of the frame covered by substrate. Defaults to 0.05.
+        downsample (int, optional): Only every n-th pixel is looked at. Defaults to 8.
+
+    Returns:
+        bool: True if the frame shows a part of a wafer
+    """
+    gray = cv2.cvtColor(image[::downsample, ::downsample], cv2.COLOR_BGR2GRAY)
+    return (
+        np.count_nonzero(gray > intensity_threshold) >= min_wafer_fraction * gray.size
+    )
+
+
 def raster_plate_low_magnification(
     scan_directory: str,
     motor_driver: Type[MotorDriverInterface],
@@ -50,9 +88,15 @@ def raster_plate_low_magnification(
     camera_driver: Type[CameraDriverInterface],
     camera_settings: dict,
     microscope_settings: dict,
+    adaptive: bool = False,
+    margin: int = 1,
 ) -> Tuple[str, str]:
     """Running the algorithm to raster the plate at low magnification to get pictures of the wafers at all positions\n
-    Later used to stitch the overview image
+    Later used to stitch the overview image\n
+    The adaptive raster classifies every frame with is_wafer_frame and only covers the region around the wafers.
+    Lines are searched completely until the first wafer frame, afterwards each line only spans the columns of the wafer seen so far plus the margin.
+    It stops once the margin is passed in the line direction, the neighbours of the wafer frames the lines cut off are taken at the end.
+    A wafer separated from the first one by more than the margin in the line direction is missed.
 
     Args:
         scan_path (str): The path to the scan directory
@@ -61,6 +105,8 @@ def raster_plate_low_magnification(
         camera_driver (CameraDriverInterface): The camera driver
         camera_settings (dict): The settings of the camera
         microscope_settings (dict): The settings of the microscope
+        adaptive (bool, optional): Only raster the region around the wafers. Defaults to False.
+        margin (int, optional): The number of background frames taken around the wafers by the adaptive raster. Defaults to 1.
 
     Returns:
         Tuple[str, str]: The path to the image directory and the path to the metadata directory
@@ -98,44 +144,104 @@ def raster_plate_low_magnification(
     camera_properties = camera_driver.get_properties()
     microscope_properties = microscope_driver.get_properties()
 
+    # the images are encoded in the background while the stage moves to the next position
+    image_writer = ImageWriter()
+
+    # which frames are taken and which show a wafer, indexed by (row, column)
+    is_captured = np.zeros((ROWS, COLUMNS), dtype=bool)
+    is_wafer = np.zeros((ROWS, COLUMNS), dtype=bool)
+
     curr_idx = 0
     start_time = time.time()
+
+    def capture(row_idx: int, col_idx: int) -> bool:
+        nonlocal curr_idx
+        curr_idx += 1
+        motor_driver.abs_move(row_idx * X_STEP, col_idx * Y_STEP)
+        time.sleep(WAIT_TIME)
+
+        # give a status update, the adaptive raster takes at most all images
+        seconds_to_go = (NUM_IMAGES - curr_idx) * (time.time() - start_time) / curr_idx
+        formatted_time = time.strftime("%H:%M:%S", time.gmtime(seconds_to_go))
+        print(
+            f"\r{curr_idx:4}/{NUM_IMAGES:4} scanned | Time to go : {formatted_time:15}",
+            end="\r",
+        )
+
+        image = camera_driver.get_image()
+        is_captured[row_idx, col_idx] = True
+        is_wafer[row_idx, col_idx] = is_wafer_frame(image)
+
+        motor_pos = motor_driver.get_pos()
+        all_props = {
+            **camera_properties,
+            **microscope_properties,
+            "motor_pos": motor_pos,
+            "grid_index": (int(row_idx), int(col_idx)),
+            "is_wafer": bool(is_wafer[row_idx, col_idx]),
+        }
+
+        # Save all the metadata for later reference
+        json_path = os.path.join(metadata_dir, f"{curr_idx}.json")
+        with open(json_path, "w") as fp:
+            json.dump(all_props, fp, sort_keys=True, indent=4)
+
+        image_path = os.path.join(image_dir, f"{curr_idx}.png")
+        image_writer.write(image_path, image, "raw_tile", copy=False)
+        return is_wafer[row_idx, col_idx]
+
     for row_idx in range(ROWS):
+        wafer_rows = np.nonzero(is_wafer.any(axis=1))[0]
+        wafer_cols = np.nonzero(is_wafer.any(axis=0))[0]
+
+        # the lines are past the wafers by more than the margin
+        if adaptive and len(wafer_rows) != 0 and row_idx - wafer_rows[-1] > margin:
+            break
+
+        start, end = 0, COLUMNS - 1
+        if adaptive and len(wafer_cols) != 0:
+            start = max(wafer_cols[0] - margin, 0)
+            end = min(wafer_cols[-1] + margin, COLUMNS - 1)
+
         # this implements a snake-like pattern, its faster
-        col = range(COLUMNS)
-        if row_idx % 2 == 1:
-            col = reversed(col)
-
-        for col_idx in col:
-            curr_idx += 1
-            motor_driver.abs_move(row_idx * X_STEP, col_idx * Y_STEP)
-            time.sleep(WAIT_TIME)
-
-            # give a status update
-            seconds_to_go = (
-                (NUM_IMAGES - curr_idx) * (time.time() - start_time) / curr_idx
-            )
-            formatted_time = time.strftime("%H:%M:%S", time.gmtime(seconds_to_go))
-            print(
-                f"\r{curr_idx:4}/{NUM_IMAGES:4} scanned | Time to go : {formatted_time:15}",
-                end="\r",
-            )
+        step = 1 if row_idx % 2 == 0 else -1
+        col_idx = start if step == 1 else end
+        while start <= col_idx <= end:
+            # the wafer reaches further than in the lines before, extend the line
+            if capture(row_idx, col_idx) and adaptive:
+                if step == 1:
+                    end = min(max(end, col_idx + margin), COLUMNS - 1)
+                else:
+                    start = max(min(start, col_idx - margin), 0)
+            col_idx += step
+
+    # take the neighbours of the wafer frames the shortened lines missed
+    while adaptive:
+        missing = (
+            cv2.dilate(
+                is_wafer.astype(np.uint8),
+                np.ones((2 * margin + 1, 2 * margin + 1), dtype=np.uint8),
+            ).astype(bool)
+            & ~is_captured
+        )
+        if not missing.any():
+            break
 
-            motor_pos = motor_driver.get_pos()
-            all_props = {
-                **camera_properties,
-                **microscope_properties,
-                "motor_pos": motor_pos,
-            }
+        missing_rows, missing_cols = np.nonzero(missing)
+        snake_order = np.lexsort(
+            (np.where(missing_rows % 2 == 1, -missing_cols, missing_cols), missing_rows)
+        )
+        for row_idx, col_idx in zip(
+            missing_rows[snake_order], missing_cols[snake_order]
+        ):
+            capture(int(row_idx), int(col_idx))
 
-            # Save all the metadata for later reference
-            json_path = os.path.join(metadata_dir, f"{curr_idx}.json")
-            with open(json_path, "w") as fp:
-                json.dump(all_props, fp, sort_keys=True, indent=4)
+    image_writer.close()
 
-            image = camera_driver.get_image()
-            image_path = os.path.join(image_dir, f"{curr_idx}.png")
-            cv2.imwrite(image_path, image)
+    if adaptive:
+        print(
+            f"\nThe adaptive raster took {curr_idx} of {NUM_IMAGES} images, {np.count_nonzero(is_wafer)} show a wafer"
+        )
 
     return image_dir, metadata_dir
 
@@ -151,6 +257,10 @@ def image_generator(
     view_field_y: float = 0.4613,
     magnification_index: int = 3,
     wait_time: float = 0.1,
+    raw_images: bool = False,
+    focus_map: FocusMap = None,
+    refocus_interval: int = 0,
+    tile_order: Tuple[np.ndarray, np.ndarray] = None,
 ) -> Generator[Tuple[Optional[np.ndarray], Optional[np.ndarray]], None, None]:
     """
     Image Generator\\
@@ -168,6 +278,10 @@ def image_generator(
         view_field_y (float, optional): the y Dimension of the Picture. Defaults to 0.4613.
         magnification_index (int, optional): the used magnification index to generate time images with, default is 3.
         wait_time (float, optional): The time to wait after moving before taking a picture in seconds. Defaults to 0.2.
+        raw_images (bool, optional): Yield the raw camera buffers instead of the processed images, the buffers are only valid until the next yield. Defaults to False.
+        focus_map (FocusMap, optional): Moves the focus drive to the predicted height while the stage moves, the hardware AF has to be off. Defaults to None.
+        refocus_interval (int, optional): Every n-th tile is focused and added to the focus map, 0 never refocuses. Defaults to 0.
+        tile_order (Tuple[Array, Array], optional): The y and x indices of the tiles in the order they are scanned, e.g. from prioritize_tiles. Defaults to None, a snake pattern over the whole map.
 
     Yields:
         Tuple (NxMx3 Array, Dict): The Image and the Metadata as a Dict. The First Yield will be None.\n
@@ -199,65 +313,88 @@ def image_generator(
     cam_props = camera_driver.get_properties()
     mic_props = microscope_driver.get_properties()
 
-    num_images = cv2.countNonZero(scan_area_map)
+    if tile_order is not None:
+        y_indices, x_indices = (np.asarray(indices) for indices in tile_order)
+    else:
+        # Dont scan anything is the areamap is 0 as only 1s are beeing scanned
+        y_indices, x_indices = np.nonzero(scan_area_map)
+
+        # this implements a snake-like pattern, its faster
+        snake_order = np.lexsort(
+            (np.where(y_indices % 2 == 1, -x_indices, x_indices), y_indices)
+        )
+        y_indices, x_indices = y_indices[snake_order], x_indices[snake_order]
+
+    # the stage positions of all tiles at once
+    grid_to_stage = create_grid_to_stage_transform(view_field_x, view_field_y)
+    positions = grid_to_stage(np.stack([x_indices, y_indices], axis=1))
+
+    num_images = len(positions)
 
     # Some Default Values
     curr_idx = 0
     image = None
     all_props = None
+    z_height = None
     start_time = time.time()
 
-    for y_idx in range(scan_area_map.shape[0]):
-        # this implements a snake-like pattern, its faster
-        row = range(scan_area_map.shape[1])
-        if y_idx % 2 == 1:
-            row = reversed(row)
-
-        for x_idx in row:
-            # Dont scan anything is the areamap is 0 as only 1s are beeing scanned
-            if scan_area_map[y_idx, x_idx] == 0:
-                continue
-
-            x_pos = view_field_x * x_idx
-            y_pos = view_field_y * y_idx
+    for (x_pos, y_pos), y_idx, x_idx in zip(positions.tolist(), y_indices, x_indices):
+        if x_pos < 0 or y_pos < 0:
+            continue
 
-            if x_pos < 0 or y_pos < 0:
-                continue
+        # move to the new Position
+        motor_driver.abs_move(x_pos, y_pos)
+        if focus_map is not None:
+            z_height = focus_map.move_to_focus(
+                microscope_driver, x_pos, y_pos, magnification_index
+            )
 
-            # move to the new Position
-            motor_driver.abs_move(x_pos, y_pos)
+        # Yields the Image
+        yield image, all_props
 
-            # Yields the Image
-            yield image, all_props
+        # just for Logging
+        curr_idx += 1
 
-            # just for Logging
-            curr_idx += 1
+        time_to_go = (
+            (time.time() - start_time) / (curr_idx + 1) * (num_images - (curr_idx + 1))
+        )
+        time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
+        print(
+            f"\r{curr_idx:>5}/{num_images:<5} scanned | Time to go : ~ {time_string:15}",
+            end="\r",
+        )
 
-            time_to_go = (
-                (time.time() - start_time)
-                / (curr_idx + 1)
-                * (num_images - (curr_idx + 1))
-            )
-            time_string = time.strftime("%H:%M:%S", time.gmtime(time_to_go))
-            print(
-                f"\r{curr_idx:>5}/{num_images:<5} scanned | Time to go : ~ {time_string:15}",
-                end="\r",
+        # Wait for move to finish
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+        # refine the focus map from time to time, the drive then stays at the measured height
+        if focus_map is not None and (
+            focus_map.needs_samples(magnification_index)
+            or (refocus_interval > 0 and curr_idx % refocus_interval == 0)
+        ):
+            z_height = (
+                focus_map.measure(
+                    microscope_driver, camera_driver, x_pos, y_pos, magnification_index
+                )
+                or z_height
             )
 
-            # Wait for move to finish
-            if wait_time > 0:
-                time.sleep(wait_time)
-
-            # get the motor props
-            motor_pos = motor_driver.get_pos()
-            all_props = {
-                **cam_props,
-                **mic_props,
-                "motor_pos": motor_pos,
-                "chip_id": int(scan_area_map[y_idx, x_idx]),
-            }
-
-            # take the image
+        # get the motor props
+        motor_pos = motor_driver.get_pos()
+        all_props = {
+            **cam_props,
+            **mic_props,
+            "motor_pos": motor_pos,
+            "chip_id": int(scan_area_map[y_idx, x_idx]),
+        }
+        if z_height is not None:
+            all_props["z_height"] = z_height
+
+        # take the image
+        if raw_images:
+            image = camera_driver.get_raw_image()
+        else:
             image = camera_driver.get_image()
 
     yield image, all_props
@@ -275,6 +412,8 @@ def raster_scan_area_map(
     view_field_y: float = 0.4613,
     magnification_index: float = 3,
     wait_time: float = 0.2,
+    focus_map: FocusMap = None,
+    refocus_interval: int = 0,
     **kwargs,
 ) -> Tuple[str, str]:
     """
@@ -291,6 +430,8 @@ def raster_scan_area_map(
         view_field_y (float, optional): the y Dimension of the Picture. Defaults to 0.4613.
         wait_time (float, optional): The time to wait after moving before taking a picture in seconds. Defaults to 0.2.
         magnification_index (int, optional): The used magnification index. Defaults to 3.
+        focus_map (FocusMap, optional): Predicts the focus height of every tile, the hardware AF has to be off. Defaults to None.
+        refocus_interval (int, optional): Every n-th tile is focused and added to the focus map, 0 never refocuses. Defaults to 0.
 
     Returns:
         Tuple: Returns the Picture Directory and the Meta Directorey where the Image data is saved
@@ -312,16 +453,24 @@ def raster_scan_area_map(
         camera_settings=camera_settings,
         microscope_settings=microscope_settings,
         wait_time=wait_time,
+        focus_map=focus_map,
+        refocus_interval=refocus_interval,
     )
 
+    image_writer = ImageWriter()
+
     for image_index, (image, prop_dict) in enumerate(image_gen):
         if image is None:
             continue
 
-        cv2.imwrite(os.path.join(image_dir, f"{image_index}.png"), image)
+        image_writer.write(
+            os.path.join(image_dir, f"{image_index}.png"), image, "raw_tile", copy=False
+        )
         with open(os.path.join(meta_dir, f"{image_index}.json"), "w") as fp:
             json.dump(prop_dict, fp, sort_keys=True, indent=4)
 
+    image_writer.close()
+
     return image_dir, meta_dir
 
 
@@ -337,9 +486,23 @@ def search_scan_area_map(
     magnification_index: int,
     view_field_x: float,
     view_field_y: float,
+    x_offset: float,
+    y_offset: float,
     flatfield=None,
     overview_image=None,
     wait_time: float = 0.2,
+    flatfield_estimator: FlatfieldEstimator = None,
+    flatfield_update_interval: int = 5,
+    flatfield_refresh_interval: int = 100,
+    prefilter: EmptyTilePrefilter = None,
+    background_uploader: BackgroundUploader = None,
+    focus_map: FocusMap = None,
+    refocus_interval: int = 0,
+    tile_order: Tuple[np.ndarray, np.ndarray] = None,
+    scan_budget: ScanBudget = None,
+    fly_scan: bool = False,
+    fly_scan_exposure: float = 0.0005,
+    fly_scan_max_blur: float = 2,
     **kwargs,
 ) -> None:
     """
@@ -356,30 +519,101 @@ def search_scan_area_map(
         overview (NxMx1 Array, optional): an overview image which is beeing saved for every detected flake. Defaults to None.
         x_step (float, optional): the x Dimension of the 20x Picture. Defaults to 0.7380.
         y_step (float, optional): the y Dimension of the 20x Picture. Defaults to 0.4613.
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
         wait_time (float, optional): The time to wait after moving before taking a picture in seconds. Defaults to 0.2.
+        flatfield_estimator (FlatfieldEstimator, optional): Estimates the flatfield from the scanned images and replaces the active flatfield once ready. Defaults to None.
+        flatfield_update_interval (int, optional): Every n-th image is added to the flatfield estimate. Defaults to 5.
+        flatfield_refresh_interval (int, optional): After how many images the active flatfield is replaced by the current estimate. Defaults to 100.
+        prefilter (EmptyTilePrefilter, optional): A cheap check to skip the detection on images without any flake. Defaults to None.
+        background_uploader (BackgroundUploader, optional): Uploads each flake directory once all its files are written. Defaults to None.
+        focus_map (FocusMap, optional): Predicts the focus height of every tile, the hardware AF has to be off. Defaults to None.
+        refocus_interval (int, optional): Every n-th tile is focused and added to the focus map, 0 never refocuses. Defaults to 0.
+        tile_order (Tuple[Array, Array], optional): The y and x indices of the tiles in the order they are scanned, e.g. the most promising first. Defaults to None.
+        scan_budget (ScanBudget, optional): Stops the search once its target is met or its deadline is reached. Defaults to None.
+        fly_scan (bool, optional): Capture the tiles while the stage sweeps each row, see fly_scan_generator. The rows are swept in order, the tile order and the refocusing are not used. Defaults to False.
+        fly_scan_exposure (float, optional): The exposure of the fly scan in seconds, the gain compensates the shorter exposure. Defaults to 0.0005.
+        fly_scan_max_blur (float, optional): The motion blur in pixels the velocity of the fly scan allows. Defaults to 2.
     """
 
+    use_raw_images = flatfield is not None or flatfield_estimator is not None
+
     # Initializing the Generator, we fetch images from it
-    image_gen = image_generator(
-        scan_area_map=scan_area_map,
-        motor_driver=motor_driver,
-        microscope_driver=microscope_driver,
-        camera_driver=camera_driver,
-        view_field_x=view_field_x,
-        view_field_y=view_field_y,
-        magnification_index=magnification_index,
-        camera_settings=camera_settings,
-        microscope_settings=microscope_settings,
-        wait_time=wait_time,
-    )
+    # With a flatfield we read the raw camera buffer and correct it in a single pass
+    if fly_scan:
+        # the tiles the fly scan misses are taken stop and go afterwards
+        # the second generator only reads the missed tiles once the fly scan is exhausted
+        missed_scan_area_map = np.zeros_like(scan_area_map)
+        fly_scan_gen = fly_scan_generator(
+            scan_area_map=scan_area_map,
+            motor_driver=motor_driver,
+            microscope_driver=microscope_driver,
+            camera_driver=camera_driver,
+            view_field_x=view_field_x,
+            view_field_y=view_field_y,
+            magnification_index=magnification_index,
+            camera_settings=camera_settings,
+            microscope_settings=microscope_settings,
+            wait_time=wait_time,
+            raw_images=use_raw_images,
+            focus_map=focus_map,
+            exposure=fly_scan_exposure,
+            max_blur=fly_scan_max_blur,
+            missed_scan_area_map=missed_scan_area_map,
+        )
+        image_gen = itertools.chain(
+            fly_scan_gen,
+            image_generator(
+                scan_area_map=missed_scan_area_map,
+                motor_driver=motor_driver,
+                microscope_driver=microscope_driver,
+                camera_driver=camera_driver,
+                view_field_x=view_field_x,
+                view_field_y=view_field_y,
+                magnification_index=magnification_index,
+                camera_settings=camera_settings,
+                microscope_settings=microscope_settings,
+                wait_time=wait_time,
+                raw_images=use_raw_images,
+                focus_map=focus_map,
+            ),
+        )
+    else:
+        image_gen = image_generator(
+            scan_area_map=scan_area_map,
+            motor_driver=motor_driver,
+            microscope_driver=microscope_driver,
+            camera_driver=camera_driver,
+            view_field_x=view_field_x,
+            view_field_y=view_field_y,
+            magnification_index=magnification_index,
+            camera_settings=camera_settings,
+            microscope_settings=microscope_settings,
+            wait_time=wait_time,
+            raw_images=use_raw_images,
+            focus_map=focus_map,
+            refocus_interval=refocus_interval,
+            tile_order=tile_order,
+        )
 
-    # get the flatfield mean to speed up the calculations
+    # precompute the flatfield gain to speed up the calculations
+    flatfield_gain = None
     if flatfield is not None:
-        flatfield_mean = np.array(cv2.mean(flatfield)[:-1])
+        flatfield_gain = compute_flatfield_gain(flatfield)
+    if use_raw_images:
+        null_values = camera_driver.get_null_values()
+        buffer_pool = BufferPool()
+
+    # the flake images are encoded in the background, the scan does not wait for the disk
+    image_writer = ImageWriter()
+
+    # every saved flake is appended to the index of the scan
+    flake_catalog = FlakeCatalog(scan_directory)
 
     # Autoincrementing Flake IDss
     flake_ids = {}
     original_image = None
+    image_index = 0
 
     # 1. Scan the entire Area for flakes and save them in their respective folders
     for image, image_props in image_gen:
@@ -388,17 +622,51 @@ def search_scan_area_map(
         if image is None:
             continue
 
-        original_image = image.copy()
+        image_index += 1
+        raw_image = image
+        original_image = image
+
+        if use_raw_images:
+            if flatfield_gain is not None:
+                original_image = None
+                image, _ = ingest_image(
+                    raw_image,
+                    null_values=null_values,
+                    flatfield_gain=flatfield_gain,
+                    out=buffer_pool.get(raw_image.shape),
+                )
+            else:
+                original_image = image = restore_image(raw_image, null_values)
 
-        if flatfield is not None:
-            image = remove_vignette_fast(
-                image,
-                flatfield=flatfield,
-                flatfield_mean=flatfield_mean,
-            )
+        # run the Detection Algorithm, skip it if the image only shows substrate
+        detected_flakes: List[Flake] = []
+        if prefilter is None or prefilter(image):
+            detected_flakes = model(image)
 
-        # run the Detection Algorithm
-        detected_flakes: List[Flake] = model(image)
+        update_flatfield = (
+            flatfield_estimator is not None
+            and image_index % flatfield_update_interval == 0
+        )
+
+        # the uncorrected image is only needed when we save a flake or update the flatfield
+        if original_image is None and (len(detected_flakes) != 0 or update_flatfield):
+            original_image = restore_image(raw_image, null_values)
+
+        if update_flatfield:
+            flake_pixels = None
+            if len(detected_flakes) != 0:
+                flake_pixels = np.any(
+                    [flake.mask != 0 for flake in detected_flakes], axis=0
+                )
+            flatfield_estimator.update(original_image, exclusion_mask=flake_pixels)
+
+        # swap in the estimated flatfield, this follows the drift of the lamp
+        if (
+            flatfield_estimator is not None
+            and flatfield_estimator.is_ready
+            and image_index % flatfield_refresh_interval == 0
+        ):
+            flatfield_gain = compute_flatfield_gain(flatfield_estimator.get_flatfield())
 
         # this is just ordering flakes into their repective folders
         if len(detected_flakes) != 0:
@@ -420,18 +688,28 @@ def search_scan_area_map(
                 )
 
                 os.makedirs(flake_directory)
+                flake_writes = []
 
                 # mark the Flake on the overview and save it
                 if overview_image is not None:
                     overview_marked = mark_on_overview(
                         overview_image,
                         image_props["motor_pos"],
-                        flake_ids[chip_id],
+                        x_offset,
+                        y_offset,
+                        flake_number=flake_ids[chip_id],
                     )
                     overview_marked_path = os.path.join(
                         flake_directory, "overview_marked.jpg"
                     )
-                    cv2.imwrite(overview_marked_path, overview_marked)
+                    flake_writes.append(
+                        image_writer.write(
+                            overview_marked_path,
+                            overview_marked,
+                            "overview",
+                            copy=False,
+                        )
+                    )
 
                 # reformat the Flake dict to make it easier to save to the DB
                 flake_meta_data = reformat_flake_dict(
@@ -441,25 +719,48 @@ def search_scan_area_map(
                     magnification_index,
                 )
 
+                # the mask is stored compactly in the metadata, full frame masks are only written on export
+                flake_meta_data["mask"] = encode_mask(flake.mask)
+
                 # Now save the Flake Metadata in the Directory
                 meta_path = os.path.join(flake_directory, "meta.json")
                 with open(meta_path, "w") as fp:
                     json.dump(flake_meta_data, fp, sort_keys=True, indent=4)
+                flake_entry = flake_catalog.add(flake_directory, flake_meta_data)
+                if scan_budget is not None:
+                    scan_budget.add(flake_entry)
 
                 # mark the flake on the image
                 marked_image = mark_flake(image, flake.mask)
 
-                # Save the original Flake Mask
-                mask_path = os.path.join(flake_directory, "flake_mask.png")
-                cv2.imwrite(mask_path, flake.mask)
-
                 # save a raw copy of the image
                 raw_image_path = os.path.join(flake_directory, "raw_img.png")
-                cv2.imwrite(raw_image_path, original_image)
+                flake_writes.append(
+                    image_writer.write(
+                        raw_image_path, original_image, "raw_tile", copy=False
+                    )
+                )
 
                 # Save the Original eval Image
                 image_path = os.path.join(flake_directory, "eval_img.jpg")
-                cv2.imwrite(image_path, marked_image)
+                flake_writes.append(
+                    image_writer.write(
+                        image_path, marked_image, "eval_image", copy=False
+                    )
+                )
+
+                # publish the flake while the scan is still running
+                if background_uploader is not None:
+                    background_uploader.submit([flake_directory], wait_for=flake_writes)
+
+        if scan_budget is not None and scan_budget.should_stop_search():
+            break
+
+    # after an early stop this restores the velocity and the exposure
+    if fly_scan:
+        fly_scan_gen.close()
+
+    image_writer.close()
 
 
 def read_meta_and_center_flakes(
@@ -470,7 +771,26 @@ def read_meta_and_center_flakes(
     camera_settings: dict,
     microscope_settings: dict,
     magnification_index: int = 3,
+    focus_map: FocusMap = None,
+    flake_directories: List[str] = None,
+    deadline: float = None,
 ) -> None:
+    """Revisits every flake of the scan and saves an image of it with the given magnification\n
+    With a focus map the focus drive is pre-positioned for every flake, so only the stage has to settle.
+    The first flake at a new objective is focused to learn its offset.
+
+    Args:
+        scan_directory (str): The Directory where the Scan is Located
+        motor_driver (Type[MotorDriverInterface]): The Motordriver
+        microscope_driver (Type[MicroscopeDriverInterface]): The Microscope Driver
+        camera_driver (Type[CameraDriverInterface]): The Camera Driver
+        camera_settings (dict): The settings for the camera.
+        microscope_settings (dict): The settings for the microscope.
+        magnification_index (int, optional): The used magnification index. Defaults to 3.
+        focus_map (FocusMap, optional): Predicts the focus height at each flake, the hardware AF has to be off. Defaults to None.
+        flake_directories (List[str], optional): The flakes to revisit in this order, e.g. from select_revisit_flakes. Defaults to None, every flake of the scan.
+        deadline (float, optional): The unix time after which no more flakes are revisited. Defaults to None.
+    """
     # The offset in mm from the center of the 20x image as reference
     MAG_OFFSET = {
         1: (0.0406, -0.4534),
@@ -488,6 +808,15 @@ def read_meta_and_center_flakes(
         5: 1,
     }
 
+    # With a focus map the focus is already set when the stage arrives
+    FOCUS_MAP_WAITTIME = {
+        1: 0.2,
+        2: 0.2,
+        3: 0.2,
+        4: 0.3,
+        5: 0.3,
+    }
+
     set_microscope_and_camera_settings(
         microscope_settings_dict=microscope_settings,
         camera_settings_dict=camera_settings,
@@ -511,16 +840,27 @@ def read_meta_and_center_flakes(
         current_image_key = f"{magnification}x"
         xy_offset = MAG_OFFSET[magnification_index]
         wait_time = MAG_WAITTIME[magnification_index]
+        if focus_map is not None:
+            wait_time = FOCUS_MAP_WAITTIME[magnification_index]
     except KeyError as e:
         print(
             f"Wrong Magnification you need an int between 1 and 5, got {e}; defaulting to 3 (20x)"
         )
+        magnification_index = 3
         current_image_key = "20x"
         xy_offset = MAG_OFFSET[3]
         wait_time = MAG_WAITTIME[3]
 
-    flake_directories = walk_flake_directories(scan_directory)
+    if flake_directories is None:
+        flake_directories = FlakeCatalog(scan_directory).walk_flake_directories()
+
     for flake_directory in flake_directories:
+        if deadline is not None and time.time() > deadline:
+            print(
+                f"The deadline is reached, skipping the remaining flakes at {current_image_key}"
+            )
+            break
+
         image_path = os.path.join(flake_directory, f"{current_image_key}.png")
         meta_path = os.path.join(flake_directory, "meta.json")
 
@@ -531,11 +871,27 @@ def read_meta_and_center_flakes(
         flake_position_y = meta_data["flake"]["position_y"] + xy_offset[1]
 
         motor_driver.abs_move(flake_position_x, flake_position_y)
+        if focus_map is not None:
+            focus_map.move_to_focus(
+                microscope_driver,
+                flake_position_x,
+                flake_position_y,
+                magnification_index,
+            )
 
         time.sleep(wait_time)
 
+        if focus_map is not None and focus_map.needs_samples(magnification_index):
+            focus_map.measure(
+                microscope_driver,
+                camera_driver,
+                flake_position_x,
+                flake_position_y,
+                magnification_index,
+            )
+
         image = camera_driver.get_image()
-        cv2.imwrite(image_path, image)
+        write_image(image_path, image, "raw_tile")
 
         # update the meta data file
         meta_data["images"][current_image_key] = full_image_properties
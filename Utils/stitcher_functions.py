@@ -1,13 +1,19 @@
 """
 A collection of helper functions to stitch a collection of images together
 """
+import json
 import os
 
 import cv2
 import numpy as np
 from skimage import measure
 
+from Utils.codec_functions import write_image
 from Utils.etc_functions import sorted_alphanumeric
+from Utils.transform_functions import (
+    create_grid_to_stage_transform,
+    create_stage_to_overview_transform,
+)
 
 
 def create_overview_image_and_map(
@@ -20,27 +26,33 @@ def create_overview_image_and_map(
 ):
     print("Creating Overview Image and corresponding Map...")
 
+    metadata_directory = os.path.join(os.path.dirname(image_directory), "Meta")
+
     print("1. Compressing 2.5x Images...", end="")
-    compressed_image_directory = compress_images(image_directory)
+    compressed_image_directory = compress_images(
+        image_directory,
+        metadata_directory=metadata_directory,
+    )
     print("Done")
 
     print("2. Stitching Images...", end="")
-    overview_image = stitch_image(compressed_image_directory)
-    cv2.imwrite(overview_path, overview_image)
+    overview_image = stitch_image(
+        compressed_image_directory,
+        metadata_directory=metadata_directory,
+    )
+    write_image(overview_path, overview_image, "overview")
     print("Done")
 
     print("3. Compressing Overview Image...", end="")
     overview_image_compressed = cv2.resize(overview_image, (2000, 2000))
-    cv2.imwrite(
-        overview_compressed_path,
-        overview_image_compressed,
-        [int(cv2.IMWRITE_JPEG_QUALITY), 80],
+    write_image(
+        overview_compressed_path, overview_image_compressed, "overview_compressed"
     )
     print("Done")
 
     print("4. Creating mask... ", end="")
     overview_mask = create_mask_from_stitched_image(overview_image)
-    cv2.imwrite(overview_mask_path, overview_mask)
+    write_image(overview_mask_path, overview_mask, "mask")
     print("Done")
 
     print("5. Creating scan area map... ", end="")
@@ -49,7 +61,7 @@ def create_overview_image_and_map(
         erode_iterations=1,
         **magnification_params,
     )
-    cv2.imwrite(scan_area_path, scan_area_map)
+    write_image(scan_area_path, scan_area_map, "mask")
     print("Done")
 
     return overview_image_compressed, scan_area_map
@@ -60,10 +72,14 @@ def compress_images(
     compressed_directory_name: str = "Compressed",
     factor: int = 4,
     quality: int = 80,
+    metadata_directory: str = None,
 ):
     """
     takes the absolut path of the picture_directory and creates a new Folder which holds all the compressed images.\n
     Images have the same name.\n
+    The size of the compressed images is relative to the sensor pixels, each image is scaled by the 'binning' of its metadata, so binned images end up with the same size.
+    A region of interest keeps its pixel size and is not stretched to the full field of view.
+    Without a metadata directory or for older scans the images are expected to be unbinned.\n
     returns the compressed image dir path
     """
 
@@ -76,15 +92,6 @@ def compress_images(
     if not os.path.exists(compressed_directory):
         os.makedirs(compressed_directory)
 
-    # Getting the old dimensions
-    img = cv2.imread(os.path.join(image_directory, image_names[0]))
-    height = img.shape[1]
-    width = img.shape[0]
-
-    # The new dimensions
-    new_width = int(width / factor)
-    new_height = int(height / factor)
-
     for idx, image_name in enumerate(image_names):
         print(
             f"\rCurrent Image: {idx+1} / {num_pics}\r",
@@ -95,14 +102,19 @@ def compress_images(
         single_img_path = os.path.join(image_directory, image_name)
         img = cv2.imread(single_img_path)
 
-        small_img = cv2.resize(img, (new_height, new_width))
+        # The new dimensions in sensor pixels
+        binning = _read_tile_meta_data(image_name, metadata_directory).get("binning", 1)
+        new_width = int(img.shape[1] * binning / factor)
+        new_height = int(img.shape[0] * binning / factor)
+
+        small_img = cv2.resize(img, (new_width, new_height))
 
         # extracte the raw image name without .png
         new_file_name = ".".join(image_name.split(".")[:-1])
         new_img_path = os.path.join(compressed_directory, f"{new_file_name}.jpg")
 
         # Write the image with a given quality
-        cv2.imwrite(new_img_path, small_img, [int(cv2.IMWRITE_JPEG_QUALITY), quality])
+        write_image(new_img_path, small_img, "compressed_tile", jpeg_quality=quality)
 
     print("")
     return compressed_directory
@@ -114,50 +126,77 @@ def stitch_image(
     y_rows: int = 31,
     x_pix_offset: int = 403,
     y_pix_offset: int = 273,
+    metadata_directory: str = None,
 ):
     """
     Stitches images together with the given pixel offsets and given number of rows and columns.\n
     Default Params are for 2.5x Magnificication and 5mm x-movement and 3.3333 mm y-movement\n
+    With a metadata directory each image is placed at the 'grid_index' of its metadata, so sparse rasters can be stitched.
+    Missing images are filled with the median color of the images without a wafer, so the mask of the overview is not affected.
+    Without it or for older scans the images are expected in the snake order of the full raster.\n
     Returns a stitched image and path\n
     """
 
     # getting all the pictures in the directory sorted!
     pic_files = sorted_alphanumeric(os.listdir(picture_directory))
 
-    full_pic_arr_y = [None] * x_rows
     full_pic = None
+    is_placed = np.zeros((x_rows, y_rows), dtype=bool)
+    background_pixels = []
+    for file_idx, pic_file in enumerate(pic_files):
+        meta_data = _read_tile_meta_data(pic_file, metadata_directory)
+        i, j = meta_data.get("grid_index", _get_snake_index(file_idx, y_rows))
+        img = cv2.imread(os.path.join(picture_directory, pic_file))
 
-    for i in range(x_rows):
-        y_row = range(y_rows)
-
-        # Compenstate the Snaking pattern during the rastering
-        if i % 2 == 1:
-            y_row = reversed(y_row)
+        if full_pic is None:
+            full_pic = np.zeros(
+                (y_rows * y_pix_offset, x_rows * x_pix_offset, img.shape[2]),
+                dtype=img.dtype,
+            )
 
-        for j in y_row:
-            curr_idx = i * y_rows + j
-            full_path = os.path.join(picture_directory, pic_files[curr_idx])
-            img = cv2.imread(full_path)
+        full_pic[
+            j * y_pix_offset : (j + 1) * y_pix_offset,
+            i * x_pix_offset : (i + 1) * x_pix_offset,
+        ] = img[:y_pix_offset, :x_pix_offset]
+        is_placed[i, j] = True
 
-            if full_pic_arr_y[i] is None:
-                full_pic_arr_y[i] = img[:y_pix_offset, :, :].copy()
-            else:
-                full_pic_arr_y[i] = np.concatenate(
-                    (full_pic_arr_y[i], img[:y_pix_offset, :, :]),
-                    axis=0,
-                )
+        if not meta_data.get("is_wafer", True):
+            background_pixels.append(img[::8, ::8].reshape(-1, img.shape[2]))
 
-        if full_pic is None:
-            full_pic = full_pic_arr_y[i][:, :x_pix_offset, :].copy()
-        else:
-            full_pic = np.concatenate(
-                (full_pic, full_pic_arr_y[i][:, :x_pix_offset, :]),
-                axis=1,
-            )
+    # the missing tiles of a sparse raster only show the plate
+    if len(background_pixels) != 0 and not is_placed.all():
+        fill_color = np.median(np.concatenate(background_pixels), axis=0)
+        is_missing = np.repeat(
+            np.repeat(~is_placed.T, y_pix_offset, axis=0), x_pix_offset, axis=1
+        )
+        full_pic[is_missing] = fill_color.astype(full_pic.dtype)
 
     return full_pic
 
 
+def _read_tile_meta_data(pic_file: str, metadata_directory: str = None) -> dict:
+    """The metadata of an image of the low magnification raster, empty if there is none"""
+    if metadata_directory is None:
+        return {}
+
+    file_name = ".".join(pic_file.split(".")[:-1])
+    meta_path = os.path.join(metadata_directory, f"{file_name}.json")
+    if not os.path.exists(meta_path):
+        return {}
+
+    with open(meta_path, "r") as f:
+        return json.load(f)
+
+
+def _get_snake_index(file_idx: int, y_rows: int):
+    """The (row, column) of the n-th image of the full raster"""
+    # Compenstate the Snaking pattern during the rastering
+    i, j = divmod(file_idx, y_rows)
+    if i % 2 == 1:
+        j = y_rows - 1 - j
+    return i, j
+
+
 def create_mask_from_stitched_image(
     overview_image,
     blur_kernel: int = 5,
@@ -185,10 +224,10 @@ def create_mask_from_stitched_image(
 
 def create_scan_area_map_from_mask(
     overview_mask,
+    x_offset: float,
+    y_offset: float,
     view_field_x: float = 0.7380,
     view_field_y: float = 0.4613,
-    x_offset: float = 2.6121,
-    y_offset: float = 1.1672,
     overview_image_y_dimension: float = 103.333,
     overview_image_x_dimension: float = 105,
     percentage_threshold: float = 0.95,
@@ -199,6 +238,8 @@ def create_scan_area_map_from_mask(
 
     Args:
         mask_path (str): The path to the saved black and white mask
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
         view_field_x (float, optional): the x View Field of the 20x in mm. Defaults to 0.7380.
         view_field_y (float, optional): the y View Field of the 20x in mm. Defaults to 0.4613.
         percentage_threshold (float,optional): The threshold for when a part of the map should still be considered as a part of the flake. Defaults to 0.9.
@@ -210,52 +251,34 @@ def create_scan_area_map_from_mask(
         labeled_scan_area (NxMx1 Array) : The scan area map
     """
 
-    X_MOTOR_RANGE = 100
-    Y_MOTOR_RANGE = 100
-
     # Load the mask
     # copy the image to make sure not to fuck up a reference
     mask = overview_mask.copy()
 
-    height = mask.shape[0]
-    width = mask.shape[1]
-
-    # here we calculate the Resolution of pixels in x and y
-    pixel_resolution_x = width / overview_image_x_dimension
-    pixel_resolution_y = height / overview_image_y_dimension
+    x_edges, y_edges = get_tile_edges(
+        mask.shape,
+        view_field_x=view_field_x,
+        view_field_y=view_field_y,
+        x_offset=x_offset,
+        y_offset=y_offset,
+        overview_image_y_dimension=overview_image_y_dimension,
+        overview_image_x_dimension=overview_image_x_dimension,
+    )
 
-    # Real 20x area (0.7380 x 0.4613)
-    x_pixels = pixel_resolution_x * view_field_x
-    y_pixels = pixel_resolution_y * view_field_y
+    # count the non background pixels of all tiles at once
+    non_zero_pixels = sum_over_tiles((mask != 0).astype(np.uint8), x_edges, y_edges)
+    tile_pixels = np.diff(y_edges)[:, np.newaxis] * np.diff(x_edges)[np.newaxis, :]
 
-    # Create an array which saves the points where we can raster to
-    scan_area = np.zeros(
-        (
-            int(Y_MOTOR_RANGE / view_field_y),
-            int(X_MOTOR_RANGE / view_field_x),
-        )
+    # find the percentage of non background pixels
+    percentage_non_background = np.divide(
+        non_zero_pixels,
+        tile_pixels,
+        out=np.zeros(non_zero_pixels.shape),
+        where=tile_pixels != 0,
     )
-    ctr = 0
-    for i in range(scan_area.shape[1]):
-        for j in range(scan_area.shape[0]):
-            ctr += 1
-            # Crop to the part of the Image which would be seen by the 20x scope
-            x_start = int(i * x_pixels + x_offset * pixel_resolution_x)
-            y_start = int(j * y_pixels + y_offset * pixel_resolution_y)
-            x_end = int((i + 1) * x_pixels + x_offset * pixel_resolution_x)
-            y_end = int((j + 1) * y_pixels + y_offset * pixel_resolution_y)
-            crop_arr = mask[y_start:y_end, x_start:x_end]
-
-            non_zero_pixels = cv2.countNonZero(crop_arr)
-
-            # find the percentage of non background pixels
-            percentage_non_background = non_zero_pixels / (
-                crop_arr.shape[0] * crop_arr.shape[1]
-            )
 
-            # Save the Image only if a certain percantage of the image is not background
-            if percentage_non_background >= percentage_threshold:
-                scan_area[j, i] = 1
+    # Use the tile only if a certain percantage of the image is not background
+    scan_area = (percentage_non_background >= percentage_threshold).astype(np.float64)
 
     # Small adjustments
     scan_area = cv2.erode(scan_area, np.ones((3, 3)), iterations=1 + erode_iterations)
@@ -267,5 +290,83 @@ def create_scan_area_map_from_mask(
     return labeled_scan_area.astype(np.uint8)
 
 
+def get_tile_edges(
+    overview_shape,
+    x_offset: float,
+    y_offset: float,
+    view_field_x: float = 0.7380,
+    view_field_y: float = 0.4613,
+    overview_image_y_dimension: float = 103.333,
+    overview_image_x_dimension: float = 105,
+):
+    """
+    Returns the pixel edges of the footprints of the tiles of the scan area map in the overview
+
+    Args:
+        overview_shape (tuple): The shape of the overview image
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        view_field_x (float, optional): the x View Field of the scanning magnification in mm. Defaults to 0.7380.
+        view_field_y (float, optional): the y View Field of the scanning magnification in mm. Defaults to 0.4613.
+        overview_image_y_dimension (float, optional): The total y dimension of the overview Image in mm. Defaults to 103.333.
+        overview_image_x_dimension (float, optional): The total x dimension of the overview Image in mm. Defaults to 105.
+
+    Returns:
+        (x_edges, y_edges): The column and row edges, tile (i, j) spans the rows y_edges[i]:y_edges[i+1] and columns x_edges[j]:x_edges[j+1]
+    """
+    X_MOTOR_RANGE = 100
+    Y_MOTOR_RANGE = 100
+
+    height = overview_shape[0]
+    width = overview_shape[1]
+
+    # maps the tile indices to the pixels of the overview
+    grid_to_overview = create_stage_to_overview_transform(
+        overview_shape,
+        x_offset=x_offset,
+        y_offset=y_offset,
+        x_motor_range=overview_image_x_dimension,
+        y_motor_range=overview_image_y_dimension,
+    ) @ create_grid_to_stage_transform(view_field_x, view_field_y)
+
+    num_rows = int(Y_MOTOR_RANGE / view_field_y)
+    num_columns = int(X_MOTOR_RANGE / view_field_x)
+
+    # The edges of the part of the Image which would be seen by the scope for every tile
+    x_edges = grid_to_overview(
+        np.stack([np.arange(num_columns + 1), np.zeros(num_columns + 1)], axis=1)
+    )[:, 0].astype(int)
+    y_edges = grid_to_overview(
+        np.stack([np.zeros(num_rows + 1), np.arange(num_rows + 1)], axis=1)
+    )[:, 1].astype(int)
+    x_edges = np.clip(x_edges, 0, width)
+    y_edges = np.clip(y_edges, 0, height)
+
+    return x_edges, y_edges
+
+
+def sum_over_tiles(values, x_edges, y_edges):
+    """
+    Sums an image over the footprint of every tile at once with the summed area table
+
+    Args:
+        values (NxM Array): A single channel image, uint8 or float
+        x_edges (Array): The column edges of the tiles
+        y_edges (Array): The row edges of the tiles
+
+    Returns:
+        (len(y_edges)-1 x len(x_edges)-1 Array): The sum of each tile
+    """
+    summed_area = cv2.integral(values)
+    x_start, x_end = x_edges[np.newaxis, :-1], x_edges[np.newaxis, 1:]
+    y_start, y_end = y_edges[:-1, np.newaxis], y_edges[1:, np.newaxis]
+    return (
+        summed_area[y_end, x_end]
+        - summed_area[y_start, x_end]
+        - summed_area[y_end, x_start]
+        + summed_area[y_start, x_start]
+    )
+
+
 if __name__ == "__main__":
     pass
@@ -0,0 +1,144 @@
+"""
+Conversions between the coordinate frames of the scan\n
+image pixels: (x, y) in pixels of a single camera image\\
+stage: (x, y) motor position in mm\\
+overview pixels: (x, y) in pixels of the stitched overview image\\
+grid: (x_idx, y_idx) index of a tile in the scan area map
+"""
+from typing import Tuple
+
+import numpy as np
+
+import Utils.conversion_functions as conversion
+
+# The stage area covered by the stitched overview in mm, see raster_plate_low_magnification
+OVERVIEW_X_MOTOR_RANGE = 105
+OVERVIEW_Y_MOTOR_RANGE = 103.333
+
+
+class AffineTransform:
+    """A 2D affine transform which maps many points at once\n
+    Transforms are composed with `@`, `(a @ b)(points)` is the same as `a(b(points))`.
+    """
+
+    def __init__(self, matrix: np.ndarray):
+        """
+        Args:
+            matrix (3x3 Array): The transform in homogeneous coordinates
+        """
+        self.matrix = np.asarray(matrix, dtype=np.float64)
+
+    @classmethod
+    def from_scale_and_offset(
+        cls,
+        scale_x: float,
+        scale_y: float,
+        offset_x: float = 0,
+        offset_y: float = 0,
+    ) -> "AffineTransform":
+        """Creates the transform `(x * scale_x + offset_x, y * scale_y + offset_y)`"""
+        return cls(
+            [
+                [scale_x, 0, offset_x],
+                [0, scale_y, offset_y],
+                [0, 0, 1],
+            ]
+        )
+
+    @classmethod
+    def identity(cls) -> "AffineTransform":
+        return cls(np.eye(3))
+
+    def __call__(self, points) -> np.ndarray:
+        """Transforms the points
+
+        Args:
+            points (Nx2 Array or Tuple[float, float]): The points as (x, y)
+
+        Returns:
+            (Nx2 Array or 2 Array): The transformed points, in the shape of the input
+        """
+        points = np.asarray(points, dtype=np.float64)
+        flat_points = points.reshape(-1, 2)
+        transformed = flat_points @ self.matrix[:2, :2].T + self.matrix[:2, 2]
+        return transformed.reshape(points.shape)
+
+    def __matmul__(self, other: "AffineTransform") -> "AffineTransform":
+        return AffineTransform(self.matrix @ other.matrix)
+
+    def inverse(self) -> "AffineTransform":
+        return AffineTransform(np.linalg.inv(self.matrix))
+
+    def __repr__(self) -> str:
+        return f"AffineTransform({self.matrix[:2].tolist()})"
+
+
+def create_pixel_to_stage_transform(
+    magnification_index: int,
+    motor_pos: Tuple[float, float],
+    image_shape: Tuple[int, int],
+) -> AffineTransform:
+    """Maps the pixels of an image to the stage position in mm, the center of the image is at the motor position
+
+    Args:
+        magnification_index (int): The magnification index of the image
+        motor_pos (Tuple[float, float]): The motor position when the image was taken in mm
+        image_shape (Tuple[int, int]): The shape of the image, only the height and width are used
+
+    Returns:
+        AffineTransform: The transform from image pixels to stage mm
+    """
+    millimeter_per_pixel = conversion.MICROMETER_PER_PIXEL[magnification_index] / 1000
+    height, width = image_shape[:2]
+    return AffineTransform.from_scale_and_offset(
+        millimeter_per_pixel,
+        millimeter_per_pixel,
+        motor_pos[0] - width / 2 * millimeter_per_pixel,
+        motor_pos[1] - height / 2 * millimeter_per_pixel,
+    )
+
+
+def create_stage_to_overview_transform(
+    overview_shape: Tuple[int, int],
+    x_offset: float,
+    y_offset: float,
+    x_motor_range: float = OVERVIEW_X_MOTOR_RANGE,
+    y_motor_range: float = OVERVIEW_Y_MOTOR_RANGE,
+) -> AffineTransform:
+    """Maps stage positions in mm to pixels of the overview image
+
+    Args:
+        overview_shape (Tuple[int, int]): The shape of the overview image, only the height and width are used
+        x_offset (float): The x offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        y_offset (float): The y offset of the stage origin in the overview in mm, from the Scan_Magnification parameters
+        x_motor_range (float, optional): The stage range covered by the width of the overview in mm. Defaults to OVERVIEW_X_MOTOR_RANGE.
+        y_motor_range (float, optional): The stage range covered by the height of the overview in mm. Defaults to OVERVIEW_Y_MOTOR_RANGE.
+
+    Returns:
+        AffineTransform: The transform from stage mm to overview pixels
+    """
+    height, width = overview_shape[:2]
+    pixel_per_millimeter_x = width / x_motor_range
+    pixel_per_millimeter_y = height / y_motor_range
+    return AffineTransform.from_scale_and_offset(
+        pixel_per_millimeter_x,
+        pixel_per_millimeter_y,
+        x_offset * pixel_per_millimeter_x,
+        y_offset * pixel_per_millimeter_y,
+    )
+
+
+def create_grid_to_stage_transform(
+    view_field_x: float,
+    view_field_y: float,
+) -> AffineTransform:
+    """Maps the tile indices of a scan area map to the stage position of the tile in mm
+
+    Args:
+        view_field_x (float): The x dimension of a tile in mm
+        view_field_y (float): The y dimension of a tile in mm
+
+    Returns:
+        AffineTransform: The transform from grid indices to stage mm
+    """
+    return AffineTransform.from_scale_and_offset(view_field_x, view_field_y)
@@ -1,5 +1,19 @@
+import hashlib
+import json
+import os
+import queue
 import shutil
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import List
+from urllib.parse import quote
+
 import requests
+from requests.adapters import HTTPAdapter
+
+# The per file upload state of a scan, kept in the scan directory
+MANIFEST_NAME = "upload_manifest.json"
 
 
 def upload_directory(scan_dir: str, url: str) -> None:
@@ -15,3 +29,449 @@ def upload_directory(scan_dir: str, url: str) -> None:
 
     with open(scan_dir + ".zip", "rb") as f:
         requests.post(url, files={"zip": f})
+
+
+class ChunkedUploader:
+    """Uploads the files of a scan directory in chunks, the files are sent as they are without recompression\n
+    The protocol, relative to the server url:\\
+    `POST {url}/{scan_name}/{path}?offset=N&size=S` appends the body to a file at offset N, offset 0 starts the file over,
+    the server answers with {"size": ...} and with status 409 if the offset does not match its size\\
+    `POST {url}/blobs/missing` with {"hashes": [...]} returns {"missing": [...]}, the sha256 hashes the server does not have\\
+    `POST {url}/blobs/{hash}?offset=N&size=S` uploads a file by its content in the same way\\
+    `POST {url}/{scan_name}/manifest` with {"files": {path: hash}} assembles the scan from the blobs and returns {"missing": [...]}\n
+    Files uploaded by path are registered as blobs by the server as well.
+    The progress of each file is saved in a manifest in the scan directory, so an interrupted upload resumes where it stopped.
+    """
+
+    def __init__(
+        self,
+        scan_directory: str,
+        url: str,
+        scan_name: str = None,
+        chunk_size: int = 8 * 1024**2,
+        max_retries: int = 5,
+        timeout: float = 60,
+        max_parallel_uploads: int = 4,
+    ):
+        """
+        Args:
+            scan_directory (str): The directory to upload
+            url (str): The url of the server
+            scan_name (str, optional): The name of the scan on the server. Defaults to the name of the directory.
+            chunk_size (int, optional): The size of each request in bytes. Defaults to 8 MB.
+            max_retries (int, optional): How often a failed chunk is retried before giving up. Defaults to 5.
+            timeout (float, optional): The timeout of each request in seconds. Defaults to 60.
+            max_parallel_uploads (int, optional): The number of files uploaded at the same time by `upload`. Defaults to 4.
+        """
+        self.scan_directory = scan_directory
+        self.url = url.rstrip("/")
+        self.scan_name = scan_name or os.path.basename(os.path.normpath(scan_directory))
+        self.chunk_size = chunk_size
+        self.max_retries = max_retries
+        self.timeout = timeout
+        self.max_parallel_uploads = max_parallel_uploads
+        self.manifest_path = os.path.join(scan_directory, MANIFEST_NAME)
+
+        # one pooled session, the connections are reused for all chunks
+        self.session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=max_parallel_uploads, pool_maxsize=max_parallel_uploads
+        )
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+        self._manifest_lock = threading.Lock()
+        self._last_manifest_save = 0
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r") as f:
+                self.manifest = json.load(f)
+        for key in ("files", "hashes", "blobs"):
+            self.manifest.setdefault(key, {})
+
+    def _save_manifest(self, force: bool = False):
+        # rewriting the manifest after every small file would dominate the upload time
+        with self._manifest_lock:
+            if not force and time.time() - self._last_manifest_save < 2:
+                return
+            self._last_manifest_save = time.time()
+
+            temporary_path = f"{self.manifest_path}.tmp"
+            with open(temporary_path, "w") as f:
+                json.dump(self.manifest, f, indent=4, sort_keys=True)
+            os.replace(temporary_path, self.manifest_path)
+
+    def _request(self, method: str, url: str, **kwargs) -> requests.Response:
+        # retry connection errors and server errors with an exponential backoff, a 409 is an answer and not an error
+        for attempt in range(self.max_retries + 1):
+            try:
+                response = self.session.request(
+                    method, url, timeout=self.timeout, **kwargs
+                )
+            except requests.RequestException:
+                if attempt == self.max_retries:
+                    raise
+                time.sleep(min(2**attempt, 30))
+                continue
+
+            if response.status_code == 409 or response.ok:
+                return response
+
+            # any other client error is not going away by sending the request again
+            if response.status_code < 500 or attempt == self.max_retries:
+                response.raise_for_status()
+            time.sleep(min(2**attempt, 30))
+
+    def _send_chunks(self, path: str, url: str, entry: dict) -> int:
+        # sends the file from the last confirmed offset, the entry keeps the progress
+        size = os.path.getsize(path)
+        bytes_sent = 0
+        offset = entry["uploaded"]
+        with open(path, "rb") as f:
+            while not entry["complete"]:
+                f.seek(offset)
+                chunk = f.read(self.chunk_size)
+                response = self._request(
+                    "POST", url, params={"offset": offset, "size": size}, data=chunk
+                )
+
+                # the server knows a different state, continue from there or start over
+                if response.status_code == 409:
+                    server_size = response.json()["size"]
+                    offset = server_size if server_size <= size else 0
+                    entry["uploaded"] = offset
+                    entry["complete"] = offset >= size
+                    continue
+
+                bytes_sent += len(chunk)
+                offset = response.json()["size"]
+                entry["uploaded"] = offset
+                entry["complete"] = offset >= size
+                self._save_manifest()
+
+        return bytes_sent
+
+    def list_files(self) -> List[str]:
+        """Returns the relative paths of all files in the scan directory, with forward slashes"""
+        relative_paths = []
+        for root, _, file_names in os.walk(self.scan_directory):
+            for file_name in file_names:
+                path = os.path.join(root, file_name)
+                relative_path = os.path.relpath(path, self.scan_directory)
+                relative_path = relative_path.replace(os.sep, "/")
+                if relative_path in (MANIFEST_NAME, f"{MANIFEST_NAME}.tmp"):
+                    continue
+                relative_paths.append(relative_path)
+        return sorted(relative_paths)
+
+    def hash_file(self, relative_path: str) -> str:
+        """Returns the sha256 hash of a file, unchanged files are not read again"""
+        path = os.path.join(self.scan_directory, relative_path)
+        stat = os.stat(path)
+
+        known_hash = self.manifest["hashes"].get(relative_path)
+        if known_hash is not None and [known_hash["size"], known_hash["mtime_ns"]] == [
+            stat.st_size,
+            stat.st_mtime_ns,
+        ]:
+            return known_hash["sha256"]
+
+        file_hash = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024**2), b""):
+                file_hash.update(block)
+
+        self.manifest["hashes"][relative_path] = {
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "sha256": file_hash.hexdigest(),
+        }
+        return file_hash.hexdigest()
+
+    def upload_file(self, relative_path: str) -> int:
+        """Uploads a single file by its path, resuming at the last uploaded chunk
+
+        Args:
+            relative_path (str): The path of the file relative to the scan directory, with forward slashes
+
+        Returns:
+            int: The number of bytes sent
+        """
+        stat = os.stat(os.path.join(self.scan_directory, relative_path))
+
+        entry = self.manifest["files"].get(relative_path)
+        if (
+            entry is None
+            or entry["size"] != stat.st_size
+            or entry["mtime_ns"] != stat.st_mtime_ns
+        ):
+            # a new or changed file starts over
+            entry = {
+                "size": stat.st_size,
+                "mtime_ns": stat.st_mtime_ns,
+                "uploaded": 0,
+                "complete": False,
+            }
+            self.manifest["files"][relative_path] = entry
+
+        return self._send_chunks(
+            os.path.join(self.scan_directory, relative_path),
+            f"{self.url}/{quote(self.scan_name)}/{quote(relative_path)}",
+            entry,
+        )
+
+    def _upload_blob(self, file_hash: str, relative_path: str) -> int:
+        return self._send_chunks(
+            os.path.join(self.scan_directory, relative_path),
+            f"{self.url}/blobs/{file_hash}",
+            self.manifest["blobs"][file_hash],
+        )
+
+    def _find_missing_blobs(self, file_hashes: List[str]) -> List[str]:
+        # asks the server which content it does not have yet
+        response = self._request(
+            "POST", f"{self.url}/blobs/missing", json={"hashes": file_hashes}
+        )
+        missing_hashes = response.json()["missing"]
+
+        for file_hash in missing_hashes:
+            entry = self.manifest["blobs"].get(file_hash)
+            if entry is None or entry["complete"]:
+                # a blob the server lost has to be sent again
+                self.manifest["blobs"][file_hash] = {"uploaded": 0, "complete": False}
+        return missing_hashes
+
+    def _assemble(self, file_hashes: dict):
+        # places the files in the scan on the server, the files are written in the given order
+        response = self._request(
+            "POST",
+            f"{self.url}/{quote(self.scan_name)}/manifest",
+            json={"files": file_hashes},
+        )
+        missing_paths = response.json()["missing"]
+        if len(missing_paths) != 0:
+            raise IOError(
+                f"The server is missing {len(missing_paths)} files after the upload, e.g. {missing_paths[0]}"
+            )
+
+    def upload_files(self, relative_paths: List[str]) -> int:
+        """Uploads some files of the scan by their content, the server only receives the content it does not have yet\n
+        Identical files, e.g. the same image copied into several flakes, are sent only once.
+
+        Args:
+            relative_paths (List[str]): The paths of the files relative to the scan directory, with forward slashes, in the order they are placed on the server
+
+        Returns:
+            int: The number of bytes sent
+        """
+        file_hashes = {
+            relative_path: self.hash_file(relative_path)
+            for relative_path in relative_paths
+        }
+
+        # one file for each distinct content
+        blob_paths = {}
+        for relative_path, file_hash in file_hashes.items():
+            blob_paths.setdefault(file_hash, relative_path)
+
+        bytes_sent = 0
+        for file_hash in self._find_missing_blobs(list(blob_paths)):
+            bytes_sent += self._upload_blob(file_hash, blob_paths[file_hash])
+
+        self._assemble(file_hashes)
+        return bytes_sent
+
+    def upload(self, verbose: bool = True) -> int:
+        """Synchronizes the scan directory with the server, only the content the server does not have yet is sent\n
+        Identical files, e.g. the overview copies, are sent only once.
+
+        Args:
+            verbose (bool, optional): Print the progress. Defaults to True.
+
+        Returns:
+            int: The number of bytes sent
+        """
+        relative_paths = self.list_files()
+        file_hashes = {
+            relative_path: self.hash_file(relative_path)
+            for relative_path in relative_paths
+        }
+
+        # one file for each distinct content
+        blob_paths = {}
+        for relative_path, file_hash in file_hashes.items():
+            blob_paths.setdefault(file_hash, relative_path)
+
+        missing_hashes = self._find_missing_blobs(list(blob_paths))
+        total_size = sum(
+            os.path.getsize(os.path.join(self.scan_directory, blob_paths[file_hash]))
+            for file_hash in missing_hashes
+        )
+        if verbose:
+            print(
+                f"{len(relative_paths)} files, {len(blob_paths)} distinct, {len(missing_hashes)} missing on the server ({total_size / 1024**2:.1f} MB)"
+            )
+
+        bytes_sent = 0
+        start_time = time.time()
+        try:
+            with ThreadPoolExecutor(max_workers=self.max_parallel_uploads) as executor:
+                uploads = executor.map(
+                    lambda file_hash: self._upload_blob(
+                        file_hash, blob_paths[file_hash]
+                    ),
+                    missing_hashes,
+                )
+                for idx, blob_bytes_sent in enumerate(uploads):
+                    bytes_sent += blob_bytes_sent
+                    if verbose:
+                        rate = (
+                            bytes_sent / max(time.time() - start_time, 1e-9) / 1024**2
+                        )
+                        print(
+                            f"{idx + 1} / {len(missing_hashes)} files | {bytes_sent / 1024**2:.1f} / {total_size / 1024**2:.1f} MB | {rate:.1f} MB/s",
+                            end="\r",
+                        )
+        finally:
+            # keep the progress, even if the upload was interrupted
+            self._save_manifest(force=True)
+        if verbose and len(missing_hashes) != 0:
+            print("")
+
+        self._assemble(file_hashes)
+        return bytes_sent
+
+
+def _lower_thread_priority():
+    # only possible on windows, elsewhere the throttling has to be enough
+    try:
+        import win32api
+        import win32process
+
+        win32process.SetThreadPriority(
+            win32api.GetCurrentThread(), win32process.THREAD_PRIORITY_IDLE
+        )
+    except ImportError:
+        pass
+
+
+class BackgroundUploader:
+    """Uploads files of a running scan in a background thread, e.g. each flake directory once it is saved\n
+    The thread runs at idle priority and is throttled, so it does not compete with the acquisition.
+    Failed uploads are not fatal, `finish` sends everything which is still missing.
+    """
+
+    def __init__(
+        self,
+        scan_directory: str,
+        url: str,
+        max_bytes_per_second: float = 10 * 1024**2,
+        chunk_size: int = 1024**2,
+    ):
+        """
+        Args:
+            scan_directory (str): The directory of the scan
+            url (str): The url of the server
+            max_bytes_per_second (float, optional): The upload rate limit, None for no limit. Defaults to 10 MB/s.
+            chunk_size (int, optional): The size of each request in bytes. Defaults to 1 MB.
+        """
+        self.scan_directory = scan_directory
+        self.max_bytes_per_second = max_bytes_per_second
+        self.uploader = ChunkedUploader(scan_directory, url, chunk_size=chunk_size)
+
+        self.bytes_sent = 0
+        self.failed_paths = []
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, paths: List[str], wait_for: List[Future] = None):
+        """Queues files or directories for the upload
+
+        Args:
+            paths (List[str]): Absolute paths of files or directories in the scan directory, the files of a directory are uploaded with meta.json last
+            wait_for (List[Future], optional): Writes which have to finish before the files are complete, e.g. from the ImageWriter. Defaults to None.
+        """
+        self._queue.put((paths, wait_for or []))
+
+    def _expand_paths(self, paths: List[str]) -> List[str]:
+        relative_paths = []
+        for path in paths:
+            if os.path.isdir(path):
+                # the server sees a flake as complete once its metadata arrives
+                file_names = sorted(
+                    os.listdir(path), key=lambda file_name: file_name == "meta.json"
+                )
+                relative_paths += self._expand_paths(
+                    [os.path.join(path, file_name) for file_name in file_names]
+                )
+            else:
+                relative_path = os.path.relpath(path, self.scan_directory)
+                relative_paths.append(relative_path.replace(os.sep, "/"))
+        return relative_paths
+
+    def _run(self):
+        _lower_thread_priority()
+
+        while True:
+            item = self._queue.get()
+            if item is None:
+                return
+
+            paths, wait_for = item
+            try:
+                for future in wait_for:
+                    future.result()
+                relative_paths = self._expand_paths(paths)
+            except Exception as e:
+                print(f"Background upload skipped {paths}: {e}")
+                continue
+
+            # the files are deduplicated by their content like in the final upload
+            start_time = time.time()
+            try:
+                bytes_sent = self.uploader.upload_files(relative_paths)
+            except Exception as e:
+                self.failed_paths += relative_paths
+                print(f"Background upload of {paths} failed: {e}")
+                continue
+            self.bytes_sent += bytes_sent
+
+            # sleep until the average rate is below the limit
+            if self.max_bytes_per_second:
+                minimum_duration = bytes_sent / self.max_bytes_per_second
+                time.sleep(max(minimum_duration - (time.time() - start_time), 0))
+
+    def finish(self, verbose: bool = True) -> int:
+        """Waits for the queued uploads and sends everything which is still missing
+
+        Args:
+            verbose (bool, optional): Print the progress. Defaults to True.
+
+        Returns:
+            int: The number of bytes sent in the final step
+        """
+        self._queue.put(None)
+        self._thread.join()
+
+        if verbose:
+            print(
+                f"{self.bytes_sent / 1024**2:.1f} MB were uploaded during the scan, sending the remaining files"
+            )
+        return self.uploader.upload(verbose=verbose)
+
+
+def upload_directory_chunked(scan_dir: str, url: str, verbose: bool = True) -> int:
+    """
+    Uploads a directory in chunks, only files whose content the server does not have are sent\n
+    An interrupted upload resumes when called again
+
+    Args:
+        scan_dir (str): The directory to upload
+        url (str): The url to upload to
+        verbose (bool, optional): Print the progress. Defaults to True.
+
+    Returns:
+        int: The number of bytes sent
+    """
+    return ChunkedUploader(scan_dir, url).upload(verbose=verbose)
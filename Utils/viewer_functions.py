@@ -0,0 +1,445 @@
+"""
+A live view of the camera where capturing, processing and displaying the images run independently of each other
+"""
+import threading
+import time
+from typing import Optional, Tuple, Type
+
+import cv2
+import numpy as np
+from Drivers import CameraDriverInterface
+from GMMDetector import MaterialDetector
+
+from .marker_functions import mark_flake
+from .preprocessor_functions import remove_vignette_fast
+
+# remove_vignette_fast is a parallel numba kernel, the default workqueue threading layer aborts if two threads run it at once
+_vignette_lock = threading.Lock()
+
+
+class RateMeter:
+    """Measures the rate of an event as an exponential moving average"""
+
+    def __init__(self, smoothing: float = 0.9):
+        self.smoothing = smoothing
+        self.rate = 0.0
+        self._last_time = None
+
+    def tick(self):
+        now = time.time()
+        if self._last_time is not None and now > self._last_time:
+            rate = 1 / (now - self._last_time)
+            self.rate = self.smoothing * self.rate + (1 - self.smoothing) * rate
+        self._last_time = now
+
+
+class LiveDetector:
+    """Runs the detector on the live image in a background thread\n
+    Only the newest frame is detected, frames arriving while the detector is busy replace each other instead of queueing up.
+    If a detection takes longer than the latency budget, the following frames are detected at a lower resolution.
+    """
+
+    def __init__(
+        self,
+        detector_kwargs: dict,
+        flatfield: np.ndarray = None,
+        latency_budget: float = 0.5,
+        min_scale: float = 0.25,
+    ):
+        """
+        Args:
+            detector_kwargs (dict): The arguments of the MaterialDetector, the size threshold in pixels of the full resolution image
+            flatfield (NxMx3 Array, optional): The flatfield applied before the detection. Defaults to None.
+            latency_budget (float, optional): The maximum time of a detection in seconds. Defaults to 0.5.
+            min_scale (float, optional): The lowest resolution relative to the full image used to stay within the budget. Defaults to 0.25.
+        """
+        self.detector_kwargs = detector_kwargs
+        self.flatfield = flatfield
+        self.latency_budget = latency_budget
+        self.min_scale = min_scale
+
+        self.scale = 1.0
+        self.detection_time = 0.0
+        self.detection_rate = RateMeter()
+
+        # (frame index, list of (full resolution mask, thickness)) of the last detection
+        self.result = (0, [])
+
+        self._detectors = {}
+        self._flatfields = {}
+        self._frame_condition = threading.Condition()
+        self._frame = None
+        self._frame_index = 0
+        self._running = False
+        self._thread = None
+
+    def start(self) -> "LiveDetector":
+        self._running = True
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._frame_condition:
+            self._frame_condition.notify_all()
+        if self._thread is not None:
+            self._thread.join()
+
+    def update_detector(self, **detector_kwargs):
+        """Changes arguments of the detector, e.g. the size threshold after switching the magnification"""
+        self.detector_kwargs = {**self.detector_kwargs, **detector_kwargs}
+        self._detectors = {}
+
+    def submit(self, image: np.ndarray, frame_index: int):
+        """Hands the newest frame to the detector, a frame which was not detected yet is dropped"""
+        with self._frame_condition:
+            self._frame = image
+            self._frame_index = frame_index
+            self._frame_condition.notify_all()
+
+    def _get_detector(self, scale: float) -> MaterialDetector:
+        # update_detector replaces the dict from the UI thread, so only local references are used
+        # a detector built from outdated arguments then ends up in the discarded dict
+        detectors = self._detectors
+        detector = detectors.get(scale)
+        if detector is None:
+            # the flakes shrink with the image, so the size threshold has to shrink as well
+            detector_kwargs = dict(self.detector_kwargs)
+            detector_kwargs["size_threshold"] = (
+                detector_kwargs.get("size_threshold", 0) * scale**2
+            )
+            detector = MaterialDetector(**detector_kwargs)
+            detectors[scale] = detector
+        return detector
+
+    def _correct(self, image_small: np.ndarray, scale: float) -> np.ndarray:
+        if self.flatfield is None:
+            return image_small
+
+        if scale not in self._flatfields:
+            flatfield_small = cv2.resize(
+                self.flatfield,
+                (image_small.shape[1], image_small.shape[0]),
+                interpolation=cv2.INTER_AREA,
+            )
+            self._flatfields[scale] = (
+                flatfield_small,
+                np.array(cv2.mean(self.flatfield)[:-1]),
+            )
+        flatfield_small, flatfield_mean = self._flatfields[scale]
+        with _vignette_lock:
+            return remove_vignette_fast(image_small, flatfield_small, flatfield_mean)
+
+    def detect(self, image: np.ndarray, scale: float = 1.0) -> list:
+        """Detects the flakes in an image at the given resolution
+
+        Args:
+            image (NxMx3 Array): The full resolution image
+            scale (float, optional): The resolution used for the detection relative to the image. Defaults to 1.0.
+
+        Returns:
+            list: A list of (mask, thickness) with the masks at the size of the detected image
+        """
+        image_small = image
+        if scale != 1.0:
+            image_small = cv2.resize(
+                image, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA
+            )
+        image_small = self._correct(image_small, scale)
+
+        return [
+            (flake.mask, flake.thickness)
+            for flake in self._get_detector(scale)(image_small)
+        ]
+
+    def _adapt_scale(self):
+        # halve the resolution when over budget
+        if (
+            self.detection_time > self.latency_budget
+            and self.scale / 2 >= self.min_scale
+        ):
+            self.scale /= 2
+
+        # doubling the resolution makes the detection about four times slower, so leave some headroom
+        elif self.scale < 1.0 and self.detection_time * 4 < self.latency_budget * 0.75:
+            self.scale *= 2
+
+    def _run(self):
+        last_frame_index = 0
+        while self._running:
+            with self._frame_condition:
+                while self._running and self._frame_index == last_frame_index:
+                    self._frame_condition.wait(timeout=0.5)
+                if not self._running:
+                    return
+                image = self._frame
+                last_frame_index = self._frame_index
+
+            start_time = time.time()
+            try:
+                detected_flakes = self.detect(image, self.scale)
+            except Exception as e:
+                print(f"Live detection failed: {e}")
+                detected_flakes = []
+            self.detection_time = time.time() - start_time
+            self.detection_rate.tick()
+
+            self.result = (last_frame_index, detected_flakes)
+            self._adapt_scale()
+
+    def draw(self, image: np.ndarray) -> np.ndarray:
+        """Draws the flakes of the last detection onto an image of any size
+
+        Args:
+            image (NxMx3 Array): The image to draw on, e.g. the downsampled live image
+
+        Returns:
+            (NxMx3 Array): The marked image
+        """
+        _, detected_flakes = self.result
+        height, width = image.shape[:2]
+        for mask, thickness in detected_flakes:
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+            if cv2.countNonZero(mask) == 0:
+                continue
+            image = mark_flake(image, mask)
+
+            moments = cv2.moments(mask, binaryImage=True)
+            label_position = (
+                int(moments["m10"] / moments["m00"]),
+                int(moments["m01"] / moments["m00"]),
+            )
+            cv2.putText(
+                image,
+                str(thickness),
+                label_position,
+                cv2.FONT_HERSHEY_DUPLEX,
+                0.6,
+                [0, 0, 255],
+                thickness=2,
+            )
+        return image
+
+
+class LiveViewer:
+    """Shows the live image of the camera\n
+    A capture thread always keeps the newest frame, older frames are dropped instead of queued.
+    A processing thread downsamples the newest frame to the window size before correcting and annotating it.
+    `show` only displays the last processed frame, so the key handling never waits for the camera or the correction.
+    Calls to the camera from other threads have to hold `camera_lock`.
+    """
+
+    def __init__(
+        self,
+        camera_driver: Type[CameraDriverInterface],
+        window_name: str = "Live Viewer Window",
+        window_size: Tuple[int, int] = (960, 600),
+        flatfield: np.ndarray = None,
+        guide_style: str = "lines",
+        show_hud: bool = True,
+        live_detector: LiveDetector = None,
+    ):
+        """
+        Args:
+            camera_driver (Type[CameraDriverInterface]): The camera driver
+            window_name (str, optional): The name of the window. Defaults to "Live Viewer Window".
+            window_size (Tuple[int, int], optional): The width and height of the shown image. Defaults to (960, 600).
+            flatfield (NxMx3 Array, optional): The flatfield used when `use_flatfield` is set. Defaults to None.
+            guide_style (str, optional): "lines" for a cross through the center, "circle" for a circle in the center or None. Defaults to "lines".
+            show_hud (bool, optional): Show the frame rates and the latency in the image. Defaults to True.
+            live_detector (LiveDetector, optional): Overlays the detected flakes while `use_detection` is set. Defaults to None.
+        """
+        self.camera_driver = camera_driver
+        self.window_name = window_name
+        self.window_size = window_size
+        self.guide_style = guide_style
+        self.show_hud = show_hud
+        self.live_detector = live_detector
+        self.use_flatfield = False
+        self.use_detection = False
+
+        # the flatfield is only ever applied to the downsampled image
+        self.flatfield_small = None
+        if flatfield is not None:
+            self.flatfield_small = cv2.resize(
+                flatfield, window_size, interpolation=cv2.INTER_AREA
+            )
+            self.flatfield_mean = np.array(cv2.mean(flatfield)[:-1])
+
+        self.camera_lock = threading.Lock()
+        self.capture_rate = RateMeter()
+        self.processing_rate = RateMeter()
+        self.display_rate = RateMeter()
+        self.latency = 0.0
+
+        self._frame_condition = threading.Condition()
+        self._frame = None
+        self._frame_time = 0.0
+        self._frame_index = 0
+        self._processed_frame = None
+        self._processed_frame_index = 0
+        self._shown_frame_index = 0
+
+        self._running = False
+        self._threads = []
+
+    def start(self) -> "LiveViewer":
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._capture_loop, daemon=True),
+            threading.Thread(target=self._processing_loop, daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+        if self.live_detector is not None:
+            self.live_detector.start()
+
+        cv2.namedWindow(self.window_name, cv2.WINDOW_NORMAL)
+        cv2.resizeWindow(self.window_name, *self.window_size)
+        return self
+
+    def stop(self):
+        self._running = False
+        with self._frame_condition:
+            self._frame_condition.notify_all()
+        for thread in self._threads:
+            thread.join()
+        if self.live_detector is not None:
+            self.live_detector.stop()
+        cv2.destroyWindow(self.window_name)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def _capture_loop(self):
+        while self._running:
+            with self.camera_lock:
+                image = self.camera_driver.get_image()
+            capture_time = time.time()
+            self.capture_rate.tick()
+
+            # replace the newest frame, a frame which was not processed yet is dropped
+            with self._frame_condition:
+                self._frame = image
+                self._frame_time = capture_time
+                self._frame_index += 1
+                self._frame_condition.notify_all()
+
+            if self.use_detection and self.live_detector is not None:
+                self.live_detector.submit(image, self._frame_index)
+
+    def _processing_loop(self):
+        last_frame_index = 0
+        while self._running:
+            with self._frame_condition:
+                while self._running and self._frame_index == last_frame_index:
+                    self._frame_condition.wait(timeout=0.5)
+                if not self._running:
+                    return
+                image = self._frame
+                capture_time = self._frame_time
+                last_frame_index = self._frame_index
+
+            self._processed_frame = self.process(image)
+            self._processed_frame_index = last_frame_index
+            self.latency = time.time() - capture_time
+            self.processing_rate.tick()
+
+    def process(self, image: np.ndarray) -> np.ndarray:
+        """Downsamples the image to the window size, applies the flatfield and draws the guides
+
+        Args:
+            image (NxMx3 Array): The full resolution image
+
+        Returns:
+            (NxMx3 Array): The image to show
+        """
+        image_small = cv2.resize(image, self.window_size, interpolation=cv2.INTER_AREA)
+
+        if self.use_flatfield and self.flatfield_small is not None:
+            with _vignette_lock:
+                image_small = remove_vignette_fast(
+                    image_small, self.flatfield_small, self.flatfield_mean
+                )
+
+        if self.use_detection and self.live_detector is not None:
+            image_small = self.live_detector.draw(image_small)
+
+        height, width = image_small.shape[:2]
+        if self.guide_style == "lines":
+            cv2.line(image_small, (width // 2, 0), (width // 2, height), [255, 0, 0], 2)
+            cv2.line(
+                image_small, (0, height // 2), (width, height // 2), [255, 0, 0], 2
+            )
+        elif self.guide_style == "circle":
+            cv2.circle(
+                image_small,
+                (width // 2, height // 2),
+                10,
+                color=[255, 0, 0],
+                thickness=3,
+            )
+
+        return image_small
+
+    def get_latest_frame(self) -> Optional[np.ndarray]:
+        """Returns a copy of the newest full resolution frame, None if no frame was captured yet"""
+        with self._frame_condition:
+            if self._frame is None:
+                return None
+            return self._frame.copy()
+
+    def _draw_hud(self, image: np.ndarray) -> np.ndarray:
+        hud_lines = [
+            f"camera  {self.capture_rate.rate:5.1f} fps",
+            f"process {self.processing_rate.rate:5.1f} fps",
+            f"display {self.display_rate.rate:5.1f} fps",
+            f"latency {self.latency * 1000:5.0f} ms",
+        ]
+        if self.use_detection and self.live_detector is not None:
+            detected_frame_index, _ = self.live_detector.result
+            hud_lines += [
+                f"detect  {self.live_detector.detection_time * 1000:5.0f} ms at {self.live_detector.scale:.2f}x",
+                f"overlay {self._frame_index - detected_frame_index:5d} frames old",
+            ]
+        for idx, hud_line in enumerate(hud_lines):
+            cv2.putText(
+                image,
+                hud_line,
+                (10, 20 + 20 * idx),
+                cv2.FONT_HERSHEY_SIMPLEX,
+                0.5,
+                [0, 255, 255],
+                thickness=1,
+            )
+        return image
+
+    def show(self, wait_time: int = 1) -> int:
+        """Shows the last processed frame and handles the window events
+
+        Args:
+            wait_time (int, optional): The time to wait for a key in milliseconds. Defaults to 1.
+
+        Returns:
+            int: The pressed key as returned by cv2.waitKey, -1 if no key was pressed
+        """
+        # only new frames are drawn, the window events are handled either way
+        processed_frame = self._processed_frame
+        if (
+            processed_frame is not None
+            and self._processed_frame_index != self._shown_frame_index
+        ):
+            self._shown_frame_index = self._processed_frame_index
+            if self.show_hud:
+                processed_frame = self._draw_hud(processed_frame.copy())
+            cv2.imshow(self.window_name, processed_frame)
+            self.display_rate.tick()
+
+        return cv2.waitKey(wait_time)
+
+    def set_title(self, title: str):
+        cv2.setWindowTitle(self.window_name, title)
@@ -0,0 +1,198 @@
+"""
+Compiles the numba kernels ahead of time, so the first image of a scan does not pay for the JIT compilation
+"""
+import threading
+import time
+
+import numba
+import numpy as np
+
+from .flatfield_functions import _update_background_estimate
+from .mask_functions import _count_transitions, _fill_runs, _write_transitions
+from .preprocessor_functions import _ingest_kernel, remove_vignette_fast
+
+
+def _remove_vignette_fast_args(image_shape):
+    image = np.zeros(image_shape, dtype=np.uint8)
+    flatfield = np.ones(image_shape, dtype=np.uint8)
+    flatfield_mean = np.ones(image_shape[2], dtype=np.float64)
+    return (image, flatfield, flatfield_mean), {}
+
+
+def _ingest_kernel_args(image_shape):
+    raw_image = np.zeros(image_shape, dtype=np.uint8)
+    null_values = np.zeros(image_shape[2], dtype=np.uint8)
+    flatfield_gain = np.ones(image_shape, dtype=np.float32)
+    corrected_image = np.empty(image_shape, dtype=np.uint8)
+    preview_image = np.empty((1, 1, image_shape[2]), dtype=np.uint8)
+    return (
+        raw_image,
+        null_values,
+        flatfield_gain,
+        241,
+        corrected_image,
+        preview_image,
+        0,
+    ), {}
+
+
+def _update_background_estimate_args(image_shape):
+    estimate = np.zeros(image_shape, dtype=np.float32)
+    update_counts = np.zeros(image_shape[:2], dtype=np.uint16)
+    image = np.zeros(image_shape, dtype=np.uint8)
+    exclusion_mask = np.zeros(image_shape[:2], dtype=np.uint8)
+    return (
+        estimate,
+        update_counts,
+        image,
+        exclusion_mask,
+        5,
+        np.float32(0.25),
+        np.float32(0.08),
+    ), {}
+
+
+def _count_transitions_args(image_shape):
+    crop = np.zeros(image_shape[:2], dtype=np.uint8)
+    return (crop,), {}
+
+
+def _write_transitions_args(image_shape):
+    crop = np.zeros(image_shape[:2], dtype=np.uint8)
+    row_offsets = np.zeros(image_shape[0], dtype=np.int64)
+    transitions = np.empty(0, dtype=np.int64)
+    return (crop, row_offsets, transitions), {}
+
+
+def _fill_runs_args(image_shape):
+    run_starts = np.zeros(1, dtype=np.int64)
+    run_lengths = np.ones(1, dtype=np.int64)
+    flat_crop = np.zeros(1, dtype=np.uint8)
+    return (run_starts, run_lengths, flat_crop), {}
+
+
+# All numba kernels in Utils with a function creating arguments of the dtypes used during a scan
+NUMBA_KERNELS = {
+    "remove_vignette_fast": (remove_vignette_fast, _remove_vignette_fast_args),
+    "ingest_kernel": (_ingest_kernel, _ingest_kernel_args),
+    "update_background_estimate": (
+        _update_background_estimate,
+        _update_background_estimate_args,
+    ),
+    "count_transitions": (_count_transitions, _count_transitions_args),
+    "write_transitions": (_write_transitions, _write_transitions_args),
+    "fill_runs": (_fill_runs, _fill_runs_args),
+}
+
+
+def warmup_numba_kernels(
+    image_shape: tuple = (1200, 1920, 3),
+    verbose: bool = True,
+) -> dict:
+    """Compiles all numba kernels for the given image shape\n
+    The kernels are cached on disk, so only the first run after a code change has to compile them.
+    The kernels are only compiled for the argument types of the scan and never run,
+    the default workqueue threading layer of numba does not allow parallel kernels to run from two threads at once.
+
+    Args:
+        image_shape (tuple, optional): The shape of the images. Defaults to (1200, 1920, 3).
+        verbose (bool, optional): Print a report of the latencies. Defaults to True.
+
+    Returns:
+        dict: The report for each kernel with the keys\\n
+        'compile_time' : the time to compile the kernel or load it from the cache in seconds\\n
+        'from_cache' : whether the kernel was loaded from the cache instead of being compiled
+    """
+    report = {}
+    for kernel_name, (kernel, create_arguments) in NUMBA_KERNELS.items():
+        args, kwargs = create_arguments(image_shape)
+        cache_hits_before = sum(kernel.stats.cache_hits.values())
+
+        # the signature a call with these arguments compiles, including the omitted defaults
+        _, argument_types = kernel.fold_argument_types(
+            [numba.typeof(arg) for arg in args],
+            {key: numba.typeof(value) for key, value in kwargs.items()},
+        )
+
+        start_time = time.time()
+        kernel.compile(tuple(argument_types))
+        compile_time = time.time() - start_time
+
+        report[kernel_name] = {
+            "compile_time": compile_time,
+            "from_cache": sum(kernel.stats.cache_hits.values()) > cache_hits_before,
+        }
+
+    if verbose:
+        print("Numba Kernel Warmup")
+        for kernel_name, kernel_report in report.items():
+            source = "cache" if kernel_report["from_cache"] else "compiled"
+            print(
+                f"{kernel_name:>28} | {kernel_report['compile_time'] * 1000:8.1f}ms ({source})"
+            )
+
+    return report
+
+
+def measure_first_call_latency(
+    image_shape: tuple = (1200, 1920, 3),
+    verbose: bool = True,
+) -> dict:
+    """Calls each numba kernel twice on the calling thread and measures the latency of the first and of a warm call\n
+    Run it after the warmup, the first call should then be as fast as the warm one.
+    No other thread may run the kernels at the same time.
+
+    Args:
+        image_shape (tuple, optional): The shape of the images. Defaults to (1200, 1920, 3).
+        verbose (bool, optional): Print a report of the latencies. Defaults to True.
+
+    Returns:
+        dict: The report for each kernel with the keys\n
+        'first_call' : the time of the first call in seconds\n
+        'warm_call' : the time of the second call in seconds
+    """
+    report = {}
+    for kernel_name, (kernel, create_arguments) in NUMBA_KERNELS.items():
+        args, kwargs = create_arguments(image_shape)
+
+        start_time = time.time()
+        kernel(*args, **kwargs)
+        first_call = time.time() - start_time
+
+        start_time = time.time()
+        kernel(*args, **kwargs)
+        warm_call = time.time() - start_time
+
+        report[kernel_name] = {"first_call": first_call, "warm_call": warm_call}
+
+    if verbose:
+        print("Numba Kernel Latency")
+        for kernel_name, kernel_report in report.items():
+            print(
+                f"{kernel_name:>28} | first call: {kernel_report['first_call'] * 1000:8.1f}ms | warm call: {kernel_report['warm_call'] * 1000:6.1f}ms"
+            )
+
+    return report
+
+
+def start_warmup_thread(
+    image_shape: tuple = (1200, 1920, 3),
+    verbose: bool = False,
+) -> threading.Thread:
+    """Compiles all numba kernels in a background thread, e.g. while the overview is taken\n
+    Nothing is run in the thread, so the scan can call the kernels at the same time.
+
+    Args:
+        image_shape (tuple, optional): The shape of the images. Defaults to (1200, 1920, 3).
+        verbose (bool, optional): Print a report of the latencies. Defaults to False.
+
+    Returns:
+        threading.Thread: The started thread, join it to wait for the compilation
+    """
+    warmup_thread = threading.Thread(
+        target=warmup_numba_kernels,
+        kwargs={"image_shape": image_shape, "verbose": verbose},
+        daemon=True,
+    )
+    warmup_thread.start()
+    return warmup_thread
@@ -1,15 +1,20 @@
+import json
 import os
 import time
 
 import cv2
-import numpy as np
 
+import Utils.conversion_functions as conversion
 from Drivers import CameraDriver, MicroscopeDriver
-from Utils.preprocessor_functions import remove_vignette_fast
+from Utils.codec_functions import write_image
+from Utils.viewer_functions import LiveDetector, LiveViewer
+from Utils.warmup_functions import start_warmup_thread
 
 file_path = os.path.dirname(os.path.abspath(__file__))
 ff_path = "Path/To/The/Flatfield.png"
 
+start_warmup_thread()
+
 microscope = MicroscopeDriver()
 camera = CameraDriver()
 
@@ -20,6 +25,14 @@ GAIN = 0
 WHITE_BALANCE = (127, 64, 90)
 GAMMA = 100
 
+# The live detection, toggled with T
+EXFOLIATED_MATERIAL = "Graphene"
+CHIP_THICKNESS = "90nm"
+USED_CHANNELS = "BGR"
+STANDARD_DEVIATION_THRESHOLD = 5
+SIZE_THRESHOLD = 200  # in square micrometers (μm²)
+DETECTION_LATENCY_BUDGET = 0.5  # in seconds, slower detections use a lower resolution
+
 MAG_KEYS = {
     1: "2.5x",
     2: "5x",
@@ -29,8 +42,15 @@ MAG_KEYS = {
 }
 
 flatfield = cv2.imread(ff_path)
-if flatfield is not None:
-    flatfield_mean = np.array(cv2.mean(flatfield)[:-1])
+
+contrast_params_path = os.path.join(
+    file_path,
+    "Parameters",
+    "GMM_Parameters",
+    f"{EXFOLIATED_MATERIAL.lower()}_{CHIP_THICKNESS}.json",
+)
+with open(contrast_params_path) as f:
+    contrast_params = json.load(f)
 
 microscope.set_lamp_voltage(VOLTAGE)
 microscope.set_lamp_aperture_stop(APERTURE)
@@ -42,49 +62,63 @@ camera.set_properties(
     gamma=GAMMA,
 )
 
-cv2.namedWindow("Live Viewer Window", cv2.WINDOW_NORMAL)
-cv2.resizeWindow("Live Viewer Window", 1920 // 2, 1080 // 2)
-curr_mag = MAG_KEYS[microscope.get_properties()["nosepiece"]]
-cv2.setWindowTitle("Live Viewer Window", f"Live Viewer Window: {curr_mag}")
-
-use_ff = False
-show_guide_lines = True
 
-while True:
-    original_image = camera.get_image()
-    img = original_image.copy()
-    if use_ff and flatfield is not None:
-        img = remove_vignette_fast(img, flatfield, flatfield_mean)
+# the size threshold in pixels depends on the magnification
+def get_size_threshold():
+    magnification_index = microscope.get_properties()["nosepiece"]
+    return conversion.micrometers_to_pixels_IDX(SIZE_THRESHOLD, magnification_index)
 
-    if show_guide_lines:
-        h, w, d = img.shape
 
-        cv2.line(img, (w // 2, 0), (w // 2, h), [255, 0, 0], 2)
-        cv2.line(img, (0, h // 2), (w, h // 2), [255, 0, 0], 2)
+live_detector = LiveDetector(
+    detector_kwargs={
+        "contrast_dict": contrast_params,
+        "size_threshold": get_size_threshold(),
+        "standard_deviation_threshold": STANDARD_DEVIATION_THRESHOLD,
+        "used_channels": USED_CHANNELS,
+    },
+    flatfield=flatfield,
+    latency_budget=DETECTION_LATENCY_BUDGET,
+)
 
-    cv2.imshow("Live Viewer Window", img)
+# capturing and processing run in their own threads, the loop only handles the keys
+viewer = LiveViewer(camera, flatfield=flatfield, live_detector=live_detector)
+viewer.start()
+curr_mag = MAG_KEYS[microscope.get_properties()["nosepiece"]]
+viewer.set_title(f"Live Viewer Window: {curr_mag}")
 
-    key = cv2.waitKey(1)
+while True:
+    key = viewer.show()
     if key == ord("q"):
         break
 
     # Get the current information about the image
     elif key == ord("i"):
-        cam_props = camera.get_properties()
+        with viewer.camera_lock:
+            cam_props = camera.get_properties()
         mic_props = microscope.get_properties()
         all_props = {**cam_props, **mic_props}
         print("Properties of the camera and microscope")
         print(all_props)
-        new_img = camera.get_image()
 
     elif key == ord("k"):
-        use_ff = not use_ff
+        viewer.use_flatfield = not viewer.use_flatfield
 
     elif key == ord("l"):
-        show_guide_lines = not show_guide_lines
+        viewer.guide_style = None if viewer.guide_style else "lines"
+
+    elif key == ord("h"):
+        viewer.show_hud = not viewer.show_hud
+
+    elif key == ord("t"):
+        viewer.use_detection = not viewer.use_detection
 
     elif key == ord("s"):
-        cam_props = camera.get_properties()
+        original_image = viewer.get_latest_frame()
+        if original_image is None:
+            print("No frame received yet, nothing was saved")
+            continue
+        with viewer.camera_lock:
+            cam_props = camera.get_properties()
         mic_props = microscope.get_properties()
         all_props = {**cam_props, **mic_props}
         print(all_props)
@@ -93,14 +127,15 @@ while True:
             file_path,
             f"live_viewer_images/{VOLTAGE:.1f}_{APERTURE:.1f}_{EXPOSURE:.2f}_{GAIN:.0f}_{int(time.time())}.png",
         )
-        cv2.imwrite(picture_path, original_image)
+        write_image(picture_path, original_image, "raw_tile")
 
     elif key == ord("e"):
         microscope.rotate_nosepiece_forward()
         microscope.set_lamp_voltage(VOLTAGE)
         microscope.set_lamp_aperture_stop(APERTURE)
         curr_mag = MAG_KEYS[microscope.get_properties()["nosepiece"]]
-        cv2.setWindowTitle("Live Viewer Window", f"Live Viewer Window: {curr_mag}")
+        viewer.set_title(f"Live Viewer Window: {curr_mag}")
+        live_detector.update_detector(size_threshold=get_size_threshold())
 
     elif key == ord("o"):
         VOLTAGE += 0.2
@@ -127,7 +162,9 @@ while True:
         microscope.set_lamp_voltage(VOLTAGE)
         microscope.set_lamp_aperture_stop(APERTURE)
         curr_mag = MAG_KEYS[microscope.get_properties()["nosepiece"]]
-        cv2.setWindowTitle("Live Viewer Window", f"Live Viewer Window: {curr_mag}")
+        viewer.set_title(f"Live Viewer Window: {curr_mag}")
+        live_detector.update_detector(size_threshold=get_size_threshold())
 
 
+viewer.stop()
 cv2.destroyAllWindows()